@@ -1,3 +1,5 @@
 #-*- coding: utf-8 -*-
 # version string following pep-0396 and pep-0386
 __version__ = '0.9pbs.58'  # pragma: nocover
+
+default_app_config = 'filer.apps.FilerConfig'
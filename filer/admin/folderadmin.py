@@ -11,10 +11,8 @@ from django.contrib.admin.utils import quote, unquote, capfirst
 from django.contrib import messages
 from filer.admin.patched.admin_utils import get_deleted_objects
 from django.core.exceptions import PermissionDenied
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.core.urlresolvers import reverse
 from django.db import router
-from django.db.models import Q
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth import get_permission_codename
@@ -35,12 +33,16 @@ from filer.views import (popup_status, popup_param, selectfolder_status,
 from filer.admin.tools import (folders_available, files_available,
                                get_admin_sites_for_user,
                                has_multi_file_action_permission,
-                               is_valid_destination,)
+                               is_valid_destination,
+                               prefetch_listing_items,)
 from filer.models import (Folder, FolderRoot, UnfiledImages, File, tools,
                           ImagesWithMissingData,
-                          Archive, Image, DummyFolder)
+                          Archive, Image, DummyFolder, FolderJob)
 from filer.settings import FILER_STATICMEDIA_PREFIX, FILER_PAGINATE_BY
-from filer.utils.multi_model_qs import MultiMoldelQuerysetChain
+from filer.utils.jobs import submit_job
+from filer.utils.multi_model_qs import (MultiModelQuerysetChain,
+                                        MultiModelPaginator, get_page)
+from filer.utils.search import get_search_backend
 
 
 ELEM_ID = re.compile(r'.*<a href=".*/(?P<file_id>[0-9]+)/".*a>$')
@@ -189,6 +191,9 @@ class FolderAdmin(FolderPermissionModelAdmin):
             url(r'^destination_folders/$',
                 self.admin_site.admin_view(self.destination_folders),
                 name='filer-destination_folders'),
+            url(r'^jobs/(?P<job_id>\d+)/$',
+                self.admin_site.admin_view(self.folder_job_status),
+                name='filer-folder_job_status'),
         )
         url_patterns.extend(urls)
         return url_patterns
@@ -317,42 +322,25 @@ class FolderAdmin(FolderPermissionModelAdmin):
                 folder_qs = _filter_folders(Folder.objects.all())
                 file_qs = _filter_files(all_file_qs)
 
-            def folder_search_qs(qs, terms=[]):
-                for term in terms:
-                    qs = qs.filter(Q(name__icontains=term) |
-                                   Q(owner__username__icontains=term) |
-                                   Q(owner__first_name__icontains=term) |
-                                   Q(owner__last_name__icontains=term))
-                return qs
-
-            def file_search_qs(qs, terms=[]):
-                for term in terms:
-                    qs = qs.filter(Q(name__icontains=term) |
-                                   Q(description__icontains=term) |
-                                   Q(original_filename__icontains=term) |
-                                   Q(owner__username__icontains=term) |
-                                   Q(owner__first_name__icontains=term) |
-                                   Q(owner__last_name__icontains=term))
-                return qs
-
-            folder_qs = folder_search_qs(folder_qs, search_terms)
-            file_qs = file_search_qs(file_qs, search_terms)
+            search_backend = get_search_backend()
+            folder_qs = search_backend.search(folder_qs, search_terms)
+            file_qs = search_backend.search(file_qs, search_terms)
             show_result_count = True
         else:
-            folder_qs = _filter_folders(folder.children.all())
-            file_qs = _filter_files(folder_file_qs)
+            folder_qs = _filter_folders(folder.children.all()).order_by('name')
+            file_qs = _filter_files(folder_file_qs).order_by('name')
             show_result_count = False
 
-        folder_qs = folder_qs.order_by('name')
-        file_qs = file_qs.order_by('name')
+        folder_qs = folder_qs.select_related('owner', 'site')
+        file_qs = file_qs.select_related('owner')
+        items = MultiModelQuerysetChain([folder_qs, file_qs])
         if show_result_count:
+            folders_found, files_found = items.counts
             show_result_count = {
-                'files_found': file_qs.count(),
-                'folders_found': folder_qs.count(),
+                'files_found': files_found,
+                'folders_found': folders_found,
             }
-
-        items = MultiMoldelQuerysetChain([folder_qs, file_qs])
-        paginator = Paginator(items, FILER_PAGINATE_BY)
+        paginator = MultiModelPaginator(items, FILER_PAGINATE_BY)
 
         # Are we moving to clipboard?
         if request.method == 'POST' and '_save' not in request.POST:
@@ -390,6 +378,13 @@ class FolderAdmin(FolderPermissionModelAdmin):
                 if response:
                     return response
 
+        # show the results of the jobs that finished in the meantime
+        FolderJob.objects.fail_stale(
+            FolderJob.objects.unfinished().filter(owner=user))
+        for job in FolderJob.objects.to_notify(user):
+            job.notify(request)
+        folder_jobs = FolderJob.objects.unfinished().filter(owner=user)
+
         # Build the action form and populate it with available actions.
         if actions:
             action_form = self.action_form(auto_id=None)
@@ -400,17 +395,8 @@ class FolderAdmin(FolderPermissionModelAdmin):
         selection_note_all = ungettext('%(total_count)s selected',
             'All %(total_count)s selected', paginator.count)
 
-        # Make sure page request is an int. If not, deliver first page.
-        try:
-            page = int(request.GET.get('page', '1'))
-        except ValueError:
-            page = 1
-
-        # If page request (9999) is out of range, deliver last page of results.
-        try:
-            paginated_items = paginator.page(page)
-        except (EmptyPage, InvalidPage):
-            paginated_items = paginator.page(paginator.num_pages)
+        paginated_items = get_page(request, paginator)
+        prefetch_listing_items(paginated_items.object_list, user)
         context = RequestContext(request)
         context.update(self.admin_site.each_context(request))
         response = render_to_response(
@@ -418,6 +404,8 @@ class FolderAdmin(FolderPermissionModelAdmin):
                 'folder': folder,
                 'user_clipboard': clipboard,
                 'clipboard_files': clipboard.files.distinct(),
+                'clipboard_file_ids': set(
+                    clipboard.files.values_list('id', flat=True)),
                 'current_site': get_param_from_request(request, 'current_site'),
                 'paginator': paginator,
                 'paginated_items': paginated_items,
@@ -441,6 +429,7 @@ class FolderAdmin(FolderPermissionModelAdmin):
                     'total_count': paginator.count},
                 'media': self.media,
                 'file_type': file_type,
+                'folder_jobs': folder_jobs,
             }, context_instance=context)
         return response
 
@@ -668,18 +657,17 @@ class FolderAdmin(FolderPermissionModelAdmin):
                 raise PermissionDenied
             total_count = files_count + folders_count
             if total_count:
-                # delete all explicitly selected files
+                file_ids = list(files_queryset.values_list('id', flat=True))
+                folder_ids = list(
+                    folders_queryset.values_list('id', flat=True))
                 for file_obj in files_queryset:
                     self.log_deletion(request, file_obj, force_text(file_obj))
-                    file_obj.delete()
-                # delete all folders
-                for file_id in folders_queryset.values_list('id', flat=True):
-                    file_obj = Folder.objects.get(id=file_id)
+                for file_obj in Folder.objects.filter(id__in=folder_ids):
                     self.log_deletion(request, file_obj, force_text(file_obj))
-                    file_obj.delete()
-                self.message_user(request,
-                    _("Successfully deleted %(count)d files "
-                      "and/or folders.") % {"count": total_count, })
+                self._submit_folder_job(
+                    request, FolderJob.DELETE, current_folder,
+                    len(file_ids) + len(folder_ids),
+                    files=file_ids, folders=folder_ids, count=total_count)
             # Return None to display the change list page again.
             return None
 
@@ -713,6 +701,25 @@ class FolderAdmin(FolderPermissionModelAdmin):
     delete_files_or_folders.short_description = ugettext_lazy(
         "Delete selected files and/or folders")
 
+    def run_delete_job(self, job):
+        arguments = job.get_arguments()
+        # delete all explicitly selected files
+        for file_obj in File.objects.filter(id__in=arguments['files']):
+            file_obj.delete()
+            job.advance()
+        # delete all folders
+        for folder_id in arguments['folders']:
+            try:
+                folder = Folder.objects.get(id=folder_id)
+            except Folder.DoesNotExist:
+                # deleted in the meantime
+                pass
+            else:
+                folder.delete()
+            job.advance()
+        job.add_message(_("Successfully deleted %(count)d files "
+                          "and/or folders.") % {"count": arguments['count']})
+
     # Copied from django.contrib.admin.util
     def _format_callback(self, obj, user, admin_site, perms_needed):
         has_admin = obj.__class__ in admin_site._registry
@@ -774,14 +781,18 @@ class FolderAdmin(FolderPermissionModelAdmin):
         return to_copy_or_move
 
     def _move_files_and_folders_impl(self, files_queryset, folders_queryset,
-                                     destination):
+                                     destination, progress=None):
         for f in files_queryset:
             f.folder = destination
             f.save()
+            if progress:
+                progress()
         for f_id in folders_queryset.values_list('id', flat=True):
             f = Folder.objects.get(id=f_id)
             f.parent = destination
             f.save()
+            if progress:
+                progress()
 
     def _as_folder(self, request_data, param):
         try:
@@ -913,16 +924,14 @@ class FolderAdmin(FolderPermissionModelAdmin):
                 return
 
             # We count only topmost files and folders here
-            n = selected_files.count() + selected_folders.count()
+            file_ids = list(selected_files.values_list('id', flat=True))
+            folder_ids = list(selected_folders.values_list('id', flat=True))
+            n = len(file_ids) + len(folder_ids)
             if n:
-                self._move_files_and_folders_impl(
-                    selected_files, selected_folders, destination)
-                self.message_user(request,
-                     _("Successfully moved %(count)d files and/or "
-                       "folders to folder '%(destination)s'.") % {
-                            "count": n,
-                            "destination": destination,
-                        })
+                self._submit_folder_job(
+                    request, FolderJob.MOVE, current_folder, n,
+                    files=file_ids, folders=folder_ids,
+                    destination=destination.pk)
             return None
 
         context = {
@@ -946,9 +955,20 @@ class FolderAdmin(FolderPermissionModelAdmin):
     move_files_and_folders.short_description = ugettext_lazy(
         "Move selected files and/or folders")
 
-    def extract_files(self, request, files_queryset, folder_queryset):
-        success_format = "Successfully extracted archive {}."
+    def run_move_job(self, job):
+        arguments = job.get_arguments()
+        destination = Folder.objects.get(id=arguments['destination'])
+        self._move_files_and_folders_impl(
+            File.objects.filter(id__in=arguments['files']),
+            Folder.objects.filter(id__in=arguments['folders']),
+            destination, progress=job.advance)
+        job.add_message(_("Successfully moved %(count)d files and/or "
+                          "folders to folder '%(destination)s'.") % {
+                              "count": job.total,
+                              "destination": destination,
+                          })
 
+    def extract_files(self, request, files_queryset, folder_queryset):
         files_queryset = files_queryset.filter(
             polymorphic_ctype=ContentType.objects.get_for_model(Archive).id)
         # cannot extract in unfiled files folder
@@ -959,12 +979,26 @@ class FolderAdmin(FolderPermissionModelAdmin):
                 Folder.objects.none()):
             raise PermissionDenied
 
+        file_ids = list(files_queryset.values_list('id', flat=True))
+        if file_ids:
+            self._submit_folder_job(
+                request, FolderJob.EXTRACT,
+                self._get_current_action_folder(
+                    request, files_queryset, folder_queryset),
+                len(file_ids), files=file_ids)
+
+    extract_files.short_description = ugettext_lazy(
+        "Extract selected zip files")
+
+    def run_extract_job(self, job):
+        success_format = "Successfully extracted archive {}."
+
         def is_valid_archive(filer_file):
             is_valid = filer_file.is_valid()
             if not is_valid:
                 error_format = "{} is not a valid zip file"
                 message = error_format.format(filer_file.clean_actual_name)
-                messages.error(request, _(message))
+                job.add_message(_(message), level=messages.ERROR)
             return is_valid
 
         def has_collisions(filer_file):
@@ -978,23 +1012,20 @@ class FolderAdmin(FolderPermissionModelAdmin):
                     archive=archive,
                     names=names,
                 )
-                messages.error(request, _(message))
+                job.add_message(_(message), level=messages.ERROR)
             return len(collisions) > 0
 
-        for f in files_queryset:
-            if not is_valid_archive(f) or has_collisions(f):
-                continue
-            f.extract()
-            message = success_format.format(f.actual_name)
-            self.message_user(request, _(message))
-            for err_msg in f.extract_errors:
-                messages.warning(
-                    request,
-                    _("%s: %s" % (f.actual_name, err_msg))
-                )
-
-    extract_files.short_description = ugettext_lazy(
-        "Extract selected zip files")
+        archives = Archive.objects.filter(id__in=job.get_arguments()['files'])
+        for f in archives:
+            if is_valid_archive(f) and not has_collisions(f):
+                f.extract()
+                message = success_format.format(f.actual_name)
+                job.add_message(_(message))
+                for err_msg in f.extract_errors:
+                    job.add_message(
+                        _("%s: %s" % (f.actual_name, err_msg)),
+                        level=messages.WARNING)
+            job.advance()
 
     def _copy_file(self, file_obj, destination, suffix, overwrite):
         if overwrite:
@@ -1018,14 +1049,20 @@ class FolderAdmin(FolderPermissionModelAdmin):
             file_obj.name = self._generate_name(file_obj.name, suffix)
         new_path = file_obj.file.field.upload_to(file_obj, file_obj.actual_name)
         file_obj.file = file_obj._copy_file(new_path)
+        # the copy has the same content so size and sha1 are still valid
+        file_obj.file.mark_content_stored()
         file_obj.save()
 
-    def _copy_files(self, files, destination, suffix, overwrite):
+    def _copy_files(self, files, destination, suffix, overwrite,
+                    progress=None):
         for f in files:
             self._copy_file(f, destination, suffix, overwrite)
+            if progress:
+                progress()
         return len(files)
 
-    def _copy_folder(self, folder, destination, suffix, overwrite):
+    def _copy_folder(self, folder, destination, suffix, overwrite,
+                     progress=None):
         if overwrite:
             # Not yet implemented as we have to find a portable
             #   (for different storage backends) way to overwrite files
@@ -1043,23 +1080,39 @@ class FolderAdmin(FolderPermissionModelAdmin):
         folder.name = foldername
         folder.parent = destination
         folder.save()
+        if progress:
+            progress()
 
         return 1 + self._copy_files_and_folders_impl(
             old_folder.files.all(), old_folder.children.all(),
-            folder, suffix, overwrite)
+            folder, suffix, overwrite, progress)
 
     def _copy_files_and_folders_impl(self, files_queryset, folders_queryset,
-                                     destination, suffix, overwrite):
+                                     destination, suffix, overwrite,
+                                     progress=None):
 
-        n = self._copy_files(files_queryset, destination, suffix, overwrite)
+        n = self._copy_files(files_queryset, destination, suffix, overwrite,
+                             progress)
 
         for f_id in folders_queryset.values_list('id', flat=True):
             f = Folder.objects.get(id=f_id)
             destination = Folder.objects.get(id=destination.id)
-            n += self._copy_folder(f, destination, suffix, overwrite)
+            n += self._copy_folder(f, destination, suffix, overwrite,
+                                   progress)
 
         return n
 
+    def _count_files_and_folders(self, files_queryset, folders_queryset):
+        """
+        Counts the selected files and folders together with all the files
+            and folders from the selected folders' subtrees.
+        """
+        subtrees = Folder._tree_manager.get_queryset_descendants(
+            folders_queryset, include_self=True).filter(
+            deleted_at__isnull=True)
+        return (files_queryset.count() + subtrees.count() +
+                File.objects.filter(folder__in=subtrees).count())
+
     def _generate_name(self, filename, suffix):
         if not suffix:
             return filename
@@ -1114,16 +1167,15 @@ class FolderAdmin(FolderPermissionModelAdmin):
                     destination, suffix): return
 
                 if files_queryset.count() + folders_queryset.count():
-                    # We count all files and folders here (recursivelly)
-                    n = self._copy_files_and_folders_impl(
-                        files_queryset, folders_queryset, destination,
-                        suffix, False)
-                    self.message_user(request,
-                        _("Successfully copied %(count)d files and/or "
-                          "folders to folder '%(destination)s'.") % {
-                                "count": n,
-                                "destination": destination,
-                            })
+                    self._submit_folder_job(
+                        request, FolderJob.COPY, current_folder,
+                        self._count_files_and_folders(
+                            files_queryset, folders_queryset),
+                        files=list(files_queryset.values_list(
+                            'id', flat=True)),
+                        folders=list(folders_queryset.values_list(
+                            'id', flat=True)),
+                        destination=destination.pk, suffix=suffix)
                 return None
         else:
             form = CopyFilesAndFoldersForm()
@@ -1159,6 +1211,61 @@ class FolderAdmin(FolderPermissionModelAdmin):
     copy_files_and_folders.short_description = ugettext_lazy(
         "Copy selected files and/or folders")
 
+    def run_copy_job(self, job):
+        arguments = job.get_arguments()
+        destination = Folder.objects.get(id=arguments['destination'])
+        # We count all files and folders here (recursivelly)
+        n = self._copy_files_and_folders_impl(
+            File.objects.filter(id__in=arguments['files']),
+            Folder.objects.filter(id__in=arguments['folders']),
+            destination, arguments['suffix'], False, progress=job.advance)
+        job.add_message(_("Successfully copied %(count)d files and/or "
+                          "folders to folder '%(destination)s'.") % {
+                              "count": n,
+                              "destination": destination,
+                          })
+
+    def _submit_folder_job(self, request, action, current_folder, total,
+                           **arguments):
+        """
+        Creates a job for a long running folder action and hands it to the
+            job executor. The request doesn't wait for the job to finish:
+            progress is shown in the directory listing and the job messages
+            are shown once it's done.
+        """
+        if not isinstance(current_folder, Folder):
+            # virtual folders (root, unfiled files)
+            current_folder = None
+        job = FolderJob(action=action, owner=request.user,
+                        folder=current_folder, total=total)
+        job.set_arguments(**arguments)
+        job.save()
+        submit_job(job)
+        job = FolderJob.objects.get(pk=job.pk)
+        if job.is_finished:
+            job.notify(request)
+        else:
+            self.message_user(request,
+                _("%(action)s of %(count)d files and/or folders started. "
+                  "You can follow its progress in the folder listing.") % {
+                      "action": job.get_action_display(),
+                      "count": total,
+                  })
+        return job
+
+    def folder_job_status(self, request, job_id):
+        try:
+            job = FolderJob.objects.get(id=job_id)
+        except FolderJob.DoesNotExist:
+            raise Http404
+        if job.owner_id != request.user.pk and not request.user.is_superuser:
+            raise PermissionDenied
+        if not job.is_finished:
+            FolderJob.objects.fail_stale([job.pk])
+            job = FolderJob.objects.get(id=job_id)
+        return HttpResponse(
+            json.dumps(job.as_dict()), content_type="application/json")
+
     def files_toggle_restriction(self, request, restriction,
                                  files_qs, folders_qs):
         """
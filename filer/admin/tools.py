@@ -1,9 +1,17 @@
 #-*- coding: utf-8 -*-
+import bisect
+import operator
+from collections import defaultdict
+from functools import reduce
+
 from django.conf import settings
+from django.contrib.auth import models as auth_models
+from django.contrib.sites.models import Site
 from django.core.exceptions import PermissionDenied
-from django.db.models import Q
+from django.db.models import Q, Case, When, Value, IntegerField
 from filer.utils.cms_roles import *
-from filer.models.foldermodels import Folder
+from filer.models.filemodels import File
+from filer.models.foldermodels import Folder, FolderVisibleSite
 
 
 def is_valid_destination(request, folder):
@@ -32,6 +40,14 @@ def _filter_available_sites(current_site, user):
     return available_sites
 
 
+def _visible_on_sites(sites):
+    """
+    The ids of the folders visible on the given sites (as a subquery).
+    """
+    return FolderVisibleSite.objects.filter(
+        site__in=sites).values('folder')
+
+
 def folders_available(current_site, user, folders_qs):
     """
     Returns a queryset with folders that current user can see
@@ -45,19 +61,18 @@ def folders_available(current_site, user, folders_qs):
         site for all users, even superusers
     """
     if user.is_superuser and not current_site:
-        return folders_qs.distinct()
+        return folders_qs
 
     available_sites = _filter_available_sites(current_site, user)
 
     sites_q = Q(Q(folder_type=Folder.CORE_FOLDER) |
-                Q(site__in=available_sites) |
-                Q(shared__in=available_sites))
+                Q(pk__in=_visible_on_sites(available_sites)))
 
     if (getattr(settings, 'FILER_INCLUDE_SITELESS_FOLDERS', True) and
         has_admin_role(user) and not current_site):
         sites_q |= Q(site__pk__isnull=True)
 
-    return folders_qs.filter(sites_q).distinct()
+    return folders_qs.filter(sites_q)
 
 
 def files_available(current_site, user, files_qs):
@@ -78,13 +93,12 @@ def files_available(current_site, user, files_qs):
                              ~Q(clipboarditem__isnull=True))
 
     if user.is_superuser and not current_site:
-        return files_qs.exclude(unfiled_in_clipboard).distinct()
+        return files_qs.exclude(unfiled_in_clipboard)
 
     available_sites = _filter_available_sites(current_site, user)
 
     sites_q = Q(Q(folder__folder_type=Folder.CORE_FOLDER) |
-                Q(folder__site__in=available_sites) |
-                Q(folder__shared__in=available_sites))
+                Q(folder__in=_visible_on_sites(available_sites)))
 
     if not current_site:
         sites_q |= Q(folder__isnull=True)
@@ -95,43 +109,205 @@ def files_available(current_site, user, files_qs):
         # never show unfiled in popup
         sites_q &= Q(folder__isnull=False)
 
-    return files_qs.exclude(unfiled_in_clipboard).filter(sites_q).distinct()
+    return files_qs.exclude(unfiled_in_clipboard).filter(sites_q)
 
 
-def has_multi_file_action_permission(request, files, folders):
-    # unfiled files can be moved/deleted so better to just exclude them
-    #   from checking permissions for them
-    files = files.exclude(folder__isnull=True)
-    user = request.user
+class MultiActionPermission(object):
+    """
+    Checks whether a user can move/delete the given files and folders (the
+        folders together with their subtrees).
 
-    if files.readonly(user).exists() or folders.readonly(user).exists():
-        return False
-    if user.is_superuser:
-        return True
+    Runs at most three queries: one for the selected folders, one for the
+        restricted folders from their trees and one for the files. Besides
+        the verdict (is_allowed) it can return the offending items grouped
+        by the reason they can't be moved/deleted (denials).
+    """
+    READONLY = 'readonly'
+    RESTRICTED = 'restricted'
+    NO_SITE = 'no_site'
+    ROOT_FOLDER = 'root_folder'
+    OTHER_SITE = 'other_site'
 
-    if files.restricted(user).exists():
-        return False
+    def __init__(self, user, files, folders):
+        self.user = user
+        # unfiled files can be moved/deleted so better to just exclude them
+        #   from checking permissions for them
+        self.files = files.exclude(folder__isnull=True)
+        self.folders = folders
 
-    if folders.restricted_descendants(user).exists():
-        return False
+    def _shared_on_available_sites(self):
+        available_sites = get_sites_for_user(self.user)
+        if not available_sites:
+            return Value(0, output_field=IntegerField())
+        return Case(
+            When(pk__in=_visible_on_sites(available_sites), then=Value(1)),
+            default=Value(0), output_field=IntegerField())
 
-    # only superusers can move/delete files/folders with no site ownership
-    if (files.filter(folder__site__isnull=True).exists() or
-            folders.filter(site__isnull=True).exists()):
-        return False
+    def _restricted_nodes(self, trees):
+        """
+        The (tree_id, lft) of the alive folders, from the given trees, that
+            are restricted or contain restricted files.
+        """
+        sites = get_sites_without_restriction_perm(self.user)
+        if not sites or not trees:
+            return {}
+        restricted_files = File.objects.filter(restricted=True).values(
+            'folder')
+        nodes = defaultdict(list)
+        for tree_id, lft in Folder.objects.filter(
+                tree_id__in=trees, site__in=sites).filter(
+                Q(restricted=True) | Q(pk__in=restricted_files)
+                ).values_list('tree_id', 'lft'):
+            nodes[tree_id].append(lft)
+        for lfts in nodes.values():
+            lfts.sort()
+        return nodes
+
+    def _folder_denials(self):
+        """
+        Returns the ids of the offending folders by reason and the sites
+            whose files/folders the user can move/delete.
+        """
+        available_sites = get_sites_for_user(self.user)
+        rows = list(self.folders.annotate(
+            shared_on_available=self._shared_on_available_sites()
+        ).values_list('pk', 'tree_id', 'lft', 'rght', 'parent_id',
+                      'folder_type', 'site_id', 'shared_on_available'))
+        denials = defaultdict(set)
+        for pk, _, _, _, _, folder_type, site_id, shared in rows:
+            if (folder_type == Folder.CORE_FOLDER or
+                    (site_id not in available_sites and shared)):
+                denials[self.READONLY].add(pk)
+        if self.user.is_superuser:
+            return denials, None
+
+        restricted_nodes = self._restricted_nodes(
+            set(row[1] for row in rows))
+        has_root_folders = any(row[4] is None for row in rows)
+        if has_root_folders and has_admin_role(self.user):
+            # allow site admins to move/delete root files/folders that
+            #   belong to the site where is admin
+            sites_allowed = set(
+                site.id for site in get_admin_sites_for_user(self.user))
+        else:
+            sites_allowed = set(get_sites_for_user(self.user))
+        for pk, tree_id, lft, rght, parent_id, _, site_id, _ in rows:
+            lfts = restricted_nodes.get(tree_id, [])
+            index = bisect.bisect_left(lfts, lft)
+            if index < len(lfts) and lfts[index] <= rght:
+                denials[self.RESTRICTED].add(pk)
+            if site_id is None:
+                # only superusers can move/delete files/folders with no
+                #   site ownership
+                denials[self.NO_SITE].add(pk)
+            elif site_id not in sites_allowed:
+                denials[self.OTHER_SITE].add(pk)
+            if parent_id is None and not has_admin_role(self.user):
+                denials[self.ROOT_FOLDER].add(pk)
+        return denials, sites_allowed
+
+    def _file_conditions(self, sites_allowed):
+        conditions = {
+            self.READONLY: Q(folder__folder_type=Folder.CORE_FOLDER)}
+        if self.user.is_superuser:
+            return conditions
+        sites = get_sites_without_restriction_perm(self.user)
+        if sites:
+            conditions[self.RESTRICTED] = Q(
+                restricted=True, folder__site__in=sites)
+        conditions[self.NO_SITE] = Q(folder__site__isnull=True)
+        conditions[self.OTHER_SITE] = Q(folder__site__isnull=False)
+        if sites_allowed:
+            conditions[self.OTHER_SITE] &= ~Q(folder__site__in=sites_allowed)
+        return conditions
 
-    _exists_root_folders = folders.filter(parent__isnull=True).exists()
-    if _exists_root_folders:
-        if not has_admin_role(user):
+    def is_allowed(self):
+        folder_denials, sites_allowed = self._folder_denials()
+        if folder_denials:
             return False
-        # allow site admins to move/delete root files/folders that belong
-        #   to the site where is admin
-        sites_allowed = [s.id for s in get_admin_sites_for_user(user)]
-    else:
-        sites_allowed = get_sites_for_user(user)
+        conditions = self._file_conditions(sites_allowed)
+        return not self.files.filter(
+            reduce(operator.or_, conditions.values())).exists()
 
-    if (files.exclude(folder__site__in=sites_allowed).exists() or
-            folders.exclude(site__in=sites_allowed).exists()):
-        return False
+    def denials(self):
+        """
+        Returns the ids of the items that can't be moved/deleted by reason:
+            {reason: {'files': [...], 'folders': [...]}}
+        """
+        folder_denials, sites_allowed = self._folder_denials()
+        conditions = self._file_conditions(sites_allowed)
+        reasons = list(conditions.keys())
+        flag_names = ['denied_%s' % reason for reason in reasons]
+        flags = dict((name, Case(
+            When(conditions[reason], then=Value(1)), default=Value(0),
+            output_field=IntegerField()))
+            for name, reason in zip(flag_names, reasons))
+        file_denials = defaultdict(set)
+        for row in self.files.filter(
+                reduce(operator.or_, conditions.values())).annotate(
+                **flags).values_list('pk', *flag_names):
+            for reason, flag in zip(reasons, row[1:]):
+                if flag:
+                    file_denials[reason].add(row[0])
+        return dict(
+            (reason, {'files': sorted(file_denials[reason]),
+                      'folders': sorted(folder_denials[reason])})
+            for reason in set(file_denials) | set(folder_denials))
+
+
+def has_multi_file_action_permission(request, files, folders):
+    return MultiActionPermission(request.user, files, folders).is_allowed()
+
+
+def _fill_fk_cache(objs, field_name, related_qs):
+    """
+    Fetches the related objects of `field_name` that are not cached yet on
+        the given objects with only one query.
+    """
+    field = objs[0]._meta.get_field(field_name) if objs else None
+    if field is None:
+        return
+    cache_name = field.get_cache_name()
+    missing = [obj for obj in objs
+               if not hasattr(obj, cache_name) and
+               getattr(obj, field.attname) is not None]
+    related = related_qs.in_bulk(
+        set(getattr(obj, field.attname) for obj in missing))
+    for obj in missing:
+        related_obj = related.get(getattr(obj, field.attname))
+        if related_obj is not None:
+            setattr(obj, cache_name, related_obj)
+
+
+def prefetch_listing_items(items, user):
+    """
+    Fetches in bulk everything that the directory listing rows need
+        (owners, sites, the folders of the files, shared sites, children and
+        files counts) and precomputes the readonly/restricted flags of the
+        items for the given user. Without this, rendering each row runs
+        several queries.
+    """
+    folders = [item for item in items if isinstance(item, Folder)]
+    files = [item for item in items if isinstance(item, File)]
+
+    # polymorphic querysets lose select_related when downcasting
+    _fill_fk_cache(files, 'folder', Folder.objects.all())
+    files_folders = [f.folder for f in files
+                     if hasattr(f, '_folder_cache')]
+    all_folders = list(dict(
+        (folder.pk, folder) for folder in folders + files_folders).values())
+    _fill_fk_cache(folders + files, 'owner', auth_models.User.objects.all())
+    _fill_fk_cache(all_folders, 'site', Site.objects.all())
+
+    shared = defaultdict(set)
+    for folder_id, site_id in Folder.shared.through.objects.filter(
+            folder__in=all_folders).values_list('folder_id', 'site_id'):
+        shared[folder_id].add(site_id)
+    for folder in folders + files_folders:
+        folder._shared_site_ids_cache = shared[folder.pk]
 
-    return True
+    for item in folders + files:
+        item._readonly_for_user_cache = (
+            user.pk, item.is_readonly_for_user(user))
+        item._restricted_for_user_cache = (
+            user.pk, item.is_restricted_for_user(user))
@@ -1,13 +1,13 @@
 from django.db import models
 from django.contrib import admin
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.core.urlresolvers import reverse
 from django.core.exceptions import PermissionDenied
 from django.db.models import Q
 from django.shortcuts import render_to_response, redirect
 from django.template import RequestContext
 from django.http import HttpResponse, Http404
-from filer.utils.multi_model_qs import MultiMoldelQuerysetChain
+from filer.utils.multi_model_qs import (MultiModelQuerysetChain,
+                                        MultiModelPaginator, get_page)
 from filer.settings import FILER_PAGINATE_BY
 import filer
 import json
@@ -71,7 +71,7 @@ class TrashAdmin(admin.ModelAdmin):
 
         file_qs = filer.models.filemodels.File.trash.filter(files_q)
         folder_qs = filer.models.foldermodels.Folder.trash.filter(folders_q)
-        return MultiMoldelQuerysetChain([
+        return MultiModelQuerysetChain([
             folder_qs.order_by('-deleted_at'),
             file_qs.order_by('-deleted_at')])
 
@@ -207,19 +207,8 @@ class TrashAdmin(admin.ModelAdmin):
                               for bit in search_q])
 
         items = self.get_queryset(request)
-        paginator = Paginator(items, FILER_PAGINATE_BY)
-
-        # Make sure page request is an int. If not, deliver first page.
-        try:
-            page = int(request.GET.get('page', '1'))
-        except ValueError:
-            page = 1
-
-        # If page request is out of range, deliver last page of results.
-        try:
-            paginated_items = paginator.page(page)
-        except (EmptyPage, InvalidPage):
-            paginated_items = paginator.page(paginator.num_pages)
+        paginator = MultiModelPaginator(items, FILER_PAGINATE_BY)
+        paginated_items = get_page(request, paginator)
 
         context = {
             'model_name': opts.verbose_name_plural,
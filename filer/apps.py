@@ -0,0 +1,10 @@
+#-*- coding: utf-8 -*-
+from django.apps import AppConfig
+
+
+class FilerConfig(AppConfig):
+    name = 'filer'
+
+    def ready(self):
+        from filer.utils import cms_roles
+        cms_roles.connect_signals()
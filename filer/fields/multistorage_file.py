@@ -1,9 +1,11 @@
 #-*- coding: utf-8 -*-
+from django.db.models.fields.files import FileDescriptor
 from easy_thumbnails import fields as easy_thumbnails_fields, \
     files as easy_thumbnails_files
 
 from filer import settings as filer_settings
-from filer.utils.filer_easy_thumbnails import ThumbnailerNameMixin
+from filer.utils.filer_easy_thumbnails import (
+    ThumbnailerNameMixin, ManifestThumbnailFile, thumbnail_manifest)
 from filer.utils.cdn import get_cdn_url
 
 
@@ -19,6 +21,8 @@ THUMBNAIL_OPTIONS = {
     'public': filer_settings.FILER_PUBLICMEDIA_THUMBNAIL_OPTIONS,
     'private': filer_settings.FILER_PRIVATEMEDIA_THUMBNAIL_OPTIONS,
 }
+# instance attribute that keeps the names of the stored files per field
+STORED_NAMES_ATTR = '_stored_file_names'
 
 
 def generate_filename_multistorage(instance, filename):
@@ -108,12 +112,58 @@ class MultiStorageFieldFile(ThumbnailerNameMixin,
         content.seek(0) # Ensure we upload the whole file
         super(MultiStorageFieldFile, self).save(name, content, save)
 
+    @property
+    def stored_name(self):
+        """
+        Name of the file whose content is described by the instance's stored
+            metadata (size, sha1).
+        """
+        stored_names = self.instance.__dict__.get(STORED_NAMES_ATTR, {})
+        return stored_names.get(self.field.name)
+
+    @property
+    def content_changed(self):
+        """
+        True if the file content might differ from the stored one: a new
+            file was assigned and not yet saved to storage or the file now
+            points to a different storage name.
+        """
+        return (not self._committed or
+                (self.name or '') != (self.stored_name or ''))
+
+    def mark_content_stored(self):
+        self.instance.__dict__.setdefault(
+            STORED_NAMES_ATTR, {})[self.field.name] = self.name
+
     def get_thumbnail(self, opts, save=True, generate=None):
         if self.instance.is_in_trash():
             return None
+        options = self.get_options(opts)
+        use_manifest = (
+            thumbnail_manifest.enabled and
+            not options.get('HIGH_RESOLUTION',
+                            self.thumbnail_high_resolution))
+        if use_manifest:
+            known = thumbnail_manifest.get(
+                self.source_storage, self.name, options)
+            if known is not None:
+                thumbnail = ManifestThumbnailFile(
+                    known[0], known[1], storage=self.thumbnail_storage)
+                return CdnAwareThumbnailFile(thumbnail, self.instance)
         thumbnail = super(MultiStorageFieldFile, self).get_thumbnail(opts, save, generate)
+        if thumbnail is None:
+            # not generated yet
+            return None
+        if use_manifest:
+            thumbnail_manifest.set(self.source_storage, self.name, options,
+                                   thumbnail.name, thumbnail.url)
         return CdnAwareThumbnailFile(thumbnail, self.instance)
 
+    def delete_thumbnails(self, *args, **kwargs):
+        thumbnail_manifest.invalidate(self.source_storage, self.name)
+        return super(MultiStorageFieldFile, self).delete_thumbnails(
+            *args, **kwargs)
+
     def get_thumbnails(self, *args, **kwargs):
         if self.instance.is_in_trash():
             return []
@@ -121,8 +171,22 @@ class MultiStorageFieldFile(ThumbnailerNameMixin,
             *args, **kwargs)
 
 
+class MultiStorageFileDescriptor(FileDescriptor):
+    """
+    Remembers the first file name assigned to a model instance (the one loaded
+        from the database) so that content changes can be detected.
+    """
+
+    def __set__(self, instance, value):
+        stored_names = instance.__dict__.setdefault(STORED_NAMES_ATTR, {})
+        if self.field.name not in stored_names:
+            stored_names[self.field.name] = getattr(value, 'name', value)
+        super(MultiStorageFileDescriptor, self).__set__(instance, value)
+
+
 class MultiStorageFileField(easy_thumbnails_fields.ThumbnailerField):
     attr_class = MultiStorageFieldFile
+    descriptor_class = MultiStorageFileDescriptor
 
     def __init__(self, verbose_name=None, name=None,
                  storages=None, thumbnail_storages=None, thumbnail_options=None, **kwargs):
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from filer import settings as filer_settings
+from filer.models import Image
+from filer.utils.db import bulk_update_field
+
+
+class Command(BaseCommand):
+
+    help = "Reads and stores the EXIF data of the images saved before it " \
+           "was stored, in batches of FILER_BULK_BATCH_SIZE images."
+
+    def handle(self, *args, **options):
+        pending = Image.all_objects.filter(_exif_data__isnull=True)
+        total = pending.count()
+        if not total:
+            self.stdout.write("No images without EXIF data.\n")
+            return
+        self.stdout.write("Reading the EXIF data of %s images...\n" % total)
+        done, unreadable, last_pk = 0, 0, 0
+        while True:
+            images = list(pending.filter(pk__gt=last_pk).order_by('pk')[
+                :filer_settings.FILER_BULK_BATCH_SIZE])
+            if not images:
+                break
+            exif_data = {}
+            for image in images:
+                info = image.image_info
+                if info is None:
+                    # missing or unavailable file, read again on the next run
+                    unreadable += 1
+                    continue
+                exif_data[image.pk] = image._dump_exif(info)
+            bulk_update_field(Image.all_objects.all(), '_exif_data', exif_data)
+            done += len(images)
+            last_pk = images[-1].pk
+            self.stdout.write("%s/%s\n" % (done, total))
+        if unreadable:
+            self.stdout.write("%s images could not be read.\n" % unreadable)
+        self.stdout.write("Done.\n")
@@ -1,25 +1,63 @@
+import os
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 # makes sure cms is loaded first
 import cms
-from filer.utils.status import FileChecker
+from filer.utils.status import FileAudit
 
 
 class Command(BaseCommand):
 
     help = "Checks wheather filer files exist on storage."
+    option_list = BaseCommand.option_list + (
+        make_option('--output',
+            action='store',
+            dest='output',
+            default=None,
+            help='File in which the files with problems are written as '
+                 'JSON lines (defaults to the standard output).'),
+        make_option('--checkpoint',
+            action='store',
+            dest='checkpoint',
+            default=None,
+            help='File in which the progress is saved. An interrupted check '
+                 'started with the same checkpoint and output continues '
+                 'from where it stopped.'),
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=None,
+            help='Number of files checked concurrently.'),
+        make_option('--skip-urls',
+            action='store_false',
+            dest='check_urls',
+            default=True,
+            help='Does not check if the urls of the files are accessible.'),
+        )
 
     def handle(self, *args, **options):
-        self.stdout.write(
-            "Checking filer files. This might take a while...\n")
-
-        every = 50
-        times = 0
+        if options['output']:
+            # appends to the output of a resumed check
+            resumed = (options['checkpoint'] and
+                       os.path.exists(options['checkpoint']))
+            output = open(options['output'], 'a' if resumed else 'w')
+            messages = self.stdout
+        else:
+            # the messages don't go in the JSON lines output
+            output, messages = self.stdout, self.stderr
+        messages.write("Checking filer files. This might take a while...\n")
 
         def logger(stats):
-            logger.times += 1
-            if logger.times % every == 0:
-                self.stdout.write("\n" + stats.progress())
-        logger.times = 0
+            self.stderr.write(stats.progress())
 
-        result_stats = FileChecker.check_all(log_progress=logger)
-        self.stdout.write(result_stats.as_string(full=True))
+        try:
+            result_stats = FileAudit(
+                output, checkpoint=options['checkpoint'],
+                workers=options['workers'],
+                check_urls=options['check_urls']).run(log_progress=logger)
+        finally:
+            if output is not self.stdout:
+                output.close()
+        messages.write(result_stats.as_string())
@@ -26,17 +26,16 @@ class Command(BaseCommand):
                 if checker.full_rebuild:
                     self.stdout.write(
                         'There are multiple root folders with the same '
-                        'tree_id. This will require a full rebuild.\n')
-                else:
-                    for folder_pk, msg in list(checker.corrupted_folders.items()):
-                        self.stdout.write('Folder /%s:\n\t%s' % (
-                            checker._get_folder_path(folder_pk), msg))
-                        self.stdout.write('\n')
-                    self.stdout.write(
-                        "\nFollowing trees will require a rebuild\n")
-                    for folder in checker.get_corrupted_root_nodes():
-                        self.stdout.write('\n/%s' % folder.name)
+                        'tree_id. Their trees will get new tree ids.\n')
+                for folder_pk, msg in list(checker.corrupted_folders.items()):
+                    self.stdout.write('Folder /%s:\n\t%s' % (
+                        checker._get_folder_path(folder_pk), msg))
                     self.stdout.write('\n')
+                self.stdout.write(
+                    "\nFollowing trees will require a rebuild\n")
+                for folder in checker.get_corrupted_root_nodes():
+                    self.stdout.write('\n/%s' % folder.name)
+                self.stdout.write('\n')
             else:
                 self.stdout.write("There are no corruptions\n")
         else:
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from filer.models import Folder
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes the file, subfolder and size counters stored on " \
+           "the folders."
+
+    def handle(self, *args, **options):
+        count = Folder.all_objects.rebuild_counters()
+        self.stdout.write("Rebuilt counters of %s folders.\n" % count)
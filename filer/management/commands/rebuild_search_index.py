@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from filer.utils.search import get_search_backend
+
+
+class Command(BaseCommand):
+
+    help = "Indexes all the files and folders for the configured search " \
+           "backend."
+
+    def handle(self, *args, **options):
+        count = get_search_backend().rebuild_index()
+        if count is None:
+            self.stdout.write(
+                "The configured search backend does not use an index.\n")
+        else:
+            self.stdout.write("Indexed %s files and folders.\n" % count)
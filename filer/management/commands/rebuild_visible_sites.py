@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from filer.models import Folder
+
+
+class Command(BaseCommand):
+
+    help = "Recomputes the sites where each folder is visible (its site " \
+           "and the sites it is shared with)."
+
+    def handle(self, *args, **options):
+        count = Folder.all_objects.update_visible_sites()
+        self.stdout.write("Stored %s visible sites of folders.\n" % count)
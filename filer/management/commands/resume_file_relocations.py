@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from filer.models import FileRelocation
+
+
+class Command(BaseCommand):
+
+    help = "Finishes moving on storage the files of renamed or moved " \
+           "folders (FOLDER_AFFECTS_URL) when the folder save was " \
+           "interrupted and the files of deleted folders that were not " \
+           "moved to the trash."
+
+    def handle(self, *args, **options):
+        pending = FileRelocation.objects.count()
+        if not pending:
+            self.stdout.write("No file relocations to resume.\n")
+            return
+        self.stdout.write("Resuming %s file relocations...\n" % pending)
+        FileRelocation.objects.relocate()
+        self.stdout.write("Done.\n")
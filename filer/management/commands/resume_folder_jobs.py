@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from filer.models import FolderJob
+from filer.utils.jobs import resume_queued_jobs
+
+
+class Command(BaseCommand):
+
+    help = "Marks as failed the folder jobs lost by their executor and " \
+           "submits again the jobs that were queued but never started " \
+           "(ex: after the web server was restarted)."
+
+    def handle(self, *args, **options):
+        resumed = resume_queued_jobs()
+        FolderJob.objects.fail_stale()
+        if not resumed:
+            self.stdout.write("No queued folder jobs.\n")
+            return
+        self.stdout.write("Submitted %s queued folder jobs.\n" % resumed)
@@ -1,46 +1,45 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
-from filer.models import File, Folder
-from filer import settings as filer_settings
-from django.utils import timezone
-from datetime import timedelta
+from filer.utils.trash import TrashPurge
 
 
 class Command(BaseCommand):
 
     help = "Hard-deletes old files and folders from filer trash."
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only counts the files and folders that would be deleted.'),
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=None,
+            help='Number of files or folders deleted at once.'),
+        make_option('--max-rate',
+            action='store',
+            type='float',
+            dest='max_rate',
+            default=None,
+            help='Maximum number of files and folders deleted per second.'),
+        )
 
     def handle(self, *args, **options):
-        no_of_sec = filer_settings.FILER_TRASH_CLEAN_INTERVAL
-        time_threshold = timezone.now() - timedelta(seconds=no_of_sec)
-        files_ids = File.trash.filter(deleted_at__lt=time_threshold)\
-            .values_list('id', flat=True)
-        folder_ids = Folder.trash.filter(deleted_at__lt=time_threshold)\
-            .order_by('tree_id', '-level').values_list('id', flat=True)
-
-        if not folder_ids and not files_ids:
+        purge = TrashPurge(
+            dry_run=options['dry_run'], batch_size=options['batch_size'],
+            max_rate=options['max_rate'],
+            log=lambda msg: self.stdout.write("%s\n" % msg))
+        moved = purge.finish_trash_moves()
+        if moved:
+            self.stdout.write(
+                "Moved %s files of deleted folders to the trash.\n" % moved)
+        if not purge.has_expired_items():
             self.stdout.write("No old files or folders.\n")
             return
-
-        for file_id in files_ids:
-            a_file = File.trash.get(id=file_id)
-            self.stdout.write("Deleting file %s: %s\n" % (
-                file_id, repr(a_file.file.name)))
-            try:
-                a_file.delete(to_trash=False)
-            except Exception as e:
-                self.stderr.write("%s\n" % str(e))
-
-        for folder_id in folder_ids:
-            a_folder = Folder.trash.get(id=folder_id)
-            ancestors = a_folder.get_ancestors(include_self=True)
-            path = repr('/'.join(ancestors.values_list('name', flat=True)))
-            if File.all_objects.filter(folder=folder_id).exists():
-                self.stdout.write("Cannot delete folder %s: %s since is "
-                                  "not empty.\n" % (folder_id, path))
-                continue
-            self.stdout.write(
-                "Deleting folder %s: %s\n" % (folder_id, path))
-            try:
-                a_folder.delete(to_trash=False)
-            except Exception as e:
-                self.stderr.write("%s\n" % str(e))
+        stats = purge.run()
+        if options['dry_run']:
+            self.stdout.write("Dry run, nothing was deleted.\n")
+        self.stdout.write("%s\n" % stats.as_string())
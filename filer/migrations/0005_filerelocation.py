@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '0004_unique_clipboard_per_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileRelocation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('is_public', models.BooleanField(default=True)),
+                ('old_location', models.CharField(max_length=255)),
+                ('new_location', models.CharField(max_length=255)),
+                ('status', models.IntegerField(default=0, choices=[(0, 'Pending'), (1, 'Moved')])),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('file', models.ForeignKey(related_name='relocations', verbose_name='file', to='filer.File')),
+            ],
+            options={
+                'verbose_name': 'file relocation',
+                'verbose_name_plural': 'file relocations',
+            },
+        ),
+    ]
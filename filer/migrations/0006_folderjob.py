@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+from django.conf import settings
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('filer', '0005_filerelocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('action', models.CharField(max_length=20, choices=[('copy', 'Copy'), ('move', 'Move'), ('delete', 'Delete'), ('extract', 'Extract')])),
+                ('status', models.IntegerField(default=0, choices=[(0, 'Queued'), (1, 'Running'), (2, 'Done'), (3, 'Failed')])),
+                ('arguments', models.TextField(default='{}')),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('messages', models.TextField(default='[]')),
+                ('notified', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('started_at', models.DateTimeField(null=True, blank=True)),
+                ('finished_at', models.DateTimeField(null=True, blank=True)),
+                ('folder', models.ForeignKey(related_name='jobs', on_delete=django.db.models.deletion.SET_NULL, verbose_name='folder', blank=True, to='filer.Folder', null=True)),
+                ('owner', models.ForeignKey(related_name='filer_folder_jobs', on_delete=django.db.models.deletion.SET_NULL, verbose_name='owner', blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+            options={
+                'ordering': ('created_at',),
+                'verbose_name': 'folder job',
+                'verbose_name_plural': 'folder jobs',
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+from filer.utils.folder_counters import rebuild_folder_counters
+
+
+def populate_folder_counters(apps, schema_editor):
+    Folder = apps.get_model("filer", "Folder")
+    File = apps.get_model("filer", "File")
+    print("Computed counters of {} folders".format(
+        rebuild_folder_counters(Folder, File)))
+
+
+def show_rollback_info_message(apps, schema_editor):
+    print("Folder counters do not need to be changed.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '0006_folderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='direct_children_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='direct_file_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='subtree_file_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='subtree_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_folder_counters,
+                             show_rollback_info_message),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '0007_folder_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='_exif_data',
+            field=models.TextField(null=True, editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+from filer.utils.folder_paths import rebuild_folder_paths
+
+
+def populate_folder_paths(apps, schema_editor):
+    Folder = apps.get_model("filer", "Folder")
+    print("Computed paths of {} folders".format(rebuild_folder_paths(Folder)))
+
+
+def show_rollback_info_message(apps, schema_editor):
+    print("Folder paths do not need to be changed.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '0008_image_exif_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='path',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='path_hash',
+            field=models.CharField(default='', editable=False, max_length=40,
+                                   db_index=True),
+        ),
+        migrations.RunPython(populate_folder_paths,
+                             show_rollback_info_message),
+    ]
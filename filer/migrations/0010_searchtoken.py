@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '0009_folder_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('token', models.CharField(max_length=64, db_index=True)),
+                ('file', models.ForeignKey(related_name='search_tokens', blank=True, to='filer.File', null=True)),
+                ('folder', models.ForeignKey(related_name='search_tokens', blank=True, to='filer.Folder', null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+from filer.utils.folder_sites import update_visible_sites
+
+
+def populate_visible_sites(apps, schema_editor):
+    Folder = apps.get_model("filer", "Folder")
+    FolderVisibleSite = apps.get_model("filer", "FolderVisibleSite")
+    print("Stored {} visible sites of folders".format(
+        update_visible_sites(Folder, FolderVisibleSite)))
+
+
+def show_rollback_info_message(apps, schema_editor):
+    print("Visible sites of folders do not need to be changed.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        ('filer', '0010_searchtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderVisibleSite',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('folder', models.ForeignKey(related_name='visible_sites', to='filer.Folder')),
+                ('site', models.ForeignKey(related_name='+', to='sites.Site')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='foldervisiblesite',
+            unique_together=set([('site', 'folder')]),
+        ),
+        migrations.RunPython(populate_visible_sites,
+                             show_rollback_info_message),
+    ]
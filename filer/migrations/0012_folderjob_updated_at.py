@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filer', '0011_foldervisiblesite'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folderjob',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
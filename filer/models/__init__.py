@@ -6,3 +6,6 @@ from filer.models.imagemodels import *
 from filer.models.foldermodels import *
 from filer.models.virtualitems import *
 from filer.models.archivemodels import *
+from filer.models.relocationmodels import *
+from filer.models.jobmodels import *
+from filer.models.searchmodels import *
@@ -5,20 +5,23 @@ from filer.models.filemodels import File
 from filer.models.foldermodels import Folder
 from filer.models.imagemodels import Image as FilerImage
 from django.utils.translation import ugettext_lazy as _
-from django.core.files.base import ContentFile
+from django.db import transaction
 from django.db.models import Q
-from filer.settings import FILER_IS_PUBLIC_DEFAULT
+from filer import settings as filer_settings
+from filer.settings import FILER_IS_PUBLIC_DEFAULT, FILER_FILE_CHUNK_SIZE
+from filer.utils.db import chunked
 from filer.utils.files import matching_file_subtypes
+from filer.utils.folder_paths import get_path_hash
+from filer.utils.pil_exif import probe_image
+from filer.utils.storage_transfer import ChunkedFile, map_concurrently
+import hashlib
 import os.path
+import re
+import tempfile
 import zipfile
 
-try:
-    from PIL import Image as PILImage
-except ImportError:
-    try:
-        import Image as PILImage
-    except ImportError:
-        raise ImportError("The Python Imaging Library was not found.")
+# names of files shown with their sha1 prefix (see File.actual_name)
+RE_HASHED_NAME = re.compile(r'^[0-9a-f]{10}_(.+)$')
 
 
 class Archive(File):
@@ -86,44 +89,116 @@ class Archive(File):
         cwd = self.logical_folder
         if cwd.is_root:
             cwd_path = os.sep
-            orphan_files = [x.pretty_logical_path
-                            for x in File.objects.filter(folder=None)]
-            orphan_folders = [x.pretty_logical_path
-                              for x in Folder.objects.filter(parent=None)]
-            filer_paths = orphan_files + orphan_folders
+            cwd = None
         else:
             cwd_path = cwd.pretty_logical_path + os.sep
-            filer_paths = cwd.pretty_path_entries()
 
-        zip_paths = [cwd_path + to_unicode(x).rstrip(os.sep)
-                     for x in zippy.namelist()]
-        file_set = set(filer_paths)
-        intersection = [x for x in zip_paths if x in file_set]
-        return intersection
+        zip_paths = [to_unicode(x).rstrip(os.sep) for x in zippy.namelist()]
+        existing = self._existing_paths(
+            cwd, [tuple(x.split(os.sep)) for x in zip_paths])
+        return [cwd_path + x for x in zip_paths
+                if tuple(x.split(os.sep)) in existing]
+
+    def _existing_paths(self, cwd, paths):
+        """
+        Returns the paths (tuples of names, relative to the cwd folder) that
+        are already used by alive folders or files. Runs one query for the
+        folders (matched by their path) and one query for the files.
+        """
+        folder_ids = {(): cwd.id if cwd else None}
+        existing = set()
+        base_path = cwd.path + '/' if cwd else '/'
+        prefixes = set(path[:depth] for path in paths
+                       for depth in range(1, len(path) + 1))
+        found = {}
+        prefix_paths = set(
+            base_path + '/'.join(prefix) for prefix in prefixes)
+        subfolders = Folder.objects.filter(path_hash__in=set(
+            get_path_hash(path) for path in prefix_paths))
+        for folder_id, path in subfolders.values_list('id', 'path'):
+            if path in prefix_paths:
+                found.setdefault(path, folder_id)
+        # a prefix exists only if all its ancestors are alive too
+        for prefix in sorted(prefixes, key=len):
+            path = base_path + '/'.join(prefix)
+            if prefix[:-1] in folder_ids and path in found:
+                folder_ids[prefix] = found[path]
+                existing.add(prefix)
+
+        file_paths = set(path for path in paths if path[:-1] in folder_ids)
+        if not file_paths:
+            return existing
+        prefixes_by_folder_id = dict(
+            (folder_id, prefix) for prefix, folder_id in folder_ids.items())
+        # files are shown with the sha1 prefixed names (see File.actual_name)
+        names = set()
+        for path in file_paths:
+            names.add(path[-1])
+            match = RE_HASHED_NAME.match(path[-1])
+            if match:
+                names.add(match.group(1))
+        files = File.objects.filter(
+            _in_folders_query('folder', set(
+                folder_ids[path[:-1]] for path in file_paths)),
+            (Q(original_filename__in=names) & (
+                Q(name__isnull=True) | Q(name__exact=''))) |
+            Q(name__in=names))
+        cwd_root = None
+        if cwd is not None:
+            cwd_root = cwd.get_root().name if cwd.level else cwd.name
+        for folder_id, name, original_filename, sha1 in files.values_list(
+                'folder_id', 'name', 'original_filename', 'sha1'):
+            prefix = prefixes_by_folder_id[folder_id]
+            clean_name = original_filename if name in ('', None) else name
+            if cwd is not None:
+                ancestors = cwd.level + len(prefix)
+                root_folder = cwd_root if ancestors else None
+            else:
+                root_folder = prefix[0] if len(prefix) > 1 else None
+            if (not sha1 or
+                    root_folder in filer_settings.FILER_NOHASH_ROOTFOLDERS):
+                actual_name = clean_name
+            else:
+                actual_name = '%s_%s' % (sha1[:10], clean_name)
+            existing.add(prefix + (actual_name,))
+        return existing
 
     def _extract_zip(self, filer_file):
         """
         Creates the file and folder hierarchy from the contents of the zip
         file. It first creates the parent folder of the selected file if it
         does not already exist, similair to mkdir -p.
+
+        The files are created in batches of ``FILER_BULK_BATCH_SIZE``
+        members: their content is streamed out of the zip, the images are
+        probed and the new files are saved on storage concurrently and then
+        the rows are saved in one transaction.
         """
         zippy = zipfile.ZipFile(filer_file)
-        entries = zippy.infolist()
-        for entry in entries:
+        self._folders_by_path = {}
+        self._subfolders_by_parent = {}
+        members = []
+        for entry in zippy.infolist():
             full_path = to_unicode(entry.filename)
             filename = os.path.basename(full_path)
             parent_dir = self._create_parent_folders(full_path)
             if filename:
-                data = zippy.read(entry)
-                self._create_file(filename, parent_dir, data)
+                members.append((entry, filename, parent_dir))
+        for batch in chunked(members):
+            self._create_files(zippy, batch)
 
     def _create_parent_folders(self, full_path):
         """Creates the folder parents for a given entry."""
-        dir_parents_of_entry = full_path.split(os.sep)[:-1]
+        dir_parents_of_entry = tuple(full_path.split(os.sep)[:-1])
+        if dir_parents_of_entry in self._folders_by_path:
+            return self._folders_by_path[dir_parents_of_entry]
         parent_dir = self.folder
-        for directory_name in dir_parents_of_entry:
-            parent_dir = self._create_folder(
-                directory_name, parent_dir)
+        for depth, directory_name in enumerate(dir_parents_of_entry, 1):
+            path = dir_parents_of_entry[:depth]
+            if path not in self._folders_by_path:
+                self._folders_by_path[path] = self._create_folder(
+                    directory_name, parent_dir)
+            parent_dir = self._folders_by_path[path]
         return parent_dir
 
     def _create_folder(self, name, parent):
@@ -131,65 +206,154 @@ class Archive(File):
         Helper wrapper of creating a file in a filer folder.
         If there already is a folder with the given name, it returnes that.
         """
-        attrs = dict(name=name, parent=parent)
-        if getattr(self, 'bypass_owner', False) is False:
-            attrs['owner'] = self.owner
-
-        existing = Folder.objects.filter(**attrs)
-        if existing:
-            return existing[0]
-        # make sure owner is set
+        parent_id = parent.id if parent else None
+        subfolders = self._subfolders_by_parent.get(parent_id)
+        if subfolders is None:
+            # all the existing subfolders are looked up at once
+            existing = Folder.objects.filter(parent=parent)
+            if getattr(self, 'bypass_owner', False) is False:
+                existing = existing.filter(owner=self.owner)
+            subfolders = {}
+            for folder in existing:
+                subfolders.setdefault(folder.name, folder)
+            self._subfolders_by_parent[parent_id] = subfolders
+        if name in subfolders:
+            return subfolders[name]
+        attrs = dict(name=name, owner=self.owner)
         if parent:
+            # the parent's tree fields change when folders are created
             attrs['parent'] = Folder.objects.get(id=parent.id)
-        attrs['owner'] = self.owner
-        return Folder.objects.create(**attrs)
+        subfolders[name] = Folder.objects.create(**attrs)
+        return subfolders[name]
 
-    def _is_valid_image(self, content_file):
-        try:
-            PILImage.open(content_file)
-        except (IOError, ):
-            self.extract_errors.append(
-                "%s is not a valid image." % content_file.name)
-        else:
-            return True
-        return False
-
-    def _create_file(self, basename, folder, data):
-        """Helper wrapper of creating a filer file."""
-        file_data = ContentFile(data)
-        file_data.name = basename
-        matched_file_types = matching_file_subtypes(basename, None, None)
-        FileSubClass = matched_file_types[0]
-        if (FileSubClass is FilerImage and
-                not self._is_valid_image(file_data)):
-            return
-
-        actual_name_query = (Q(original_filename=basename) & (
-            Q(name__isnull=True) | Q(name__exact=''))) | Q(name=basename)
+    def _read_member(self, zippy, entry, basename):
+        """
+        Streams the zip member to a temporary file and returns its content,
+        with its sha1 computed along the way.
+        """
+        chunk_size = FILER_FILE_CHUNK_SIZE
+        spooled = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+        sha1 = hashlib.sha1()
+        with zippy.open(entry) as member:
+            for chunk in iter(lambda: member.read(chunk_size), b''):
+                sha1.update(chunk)
+                spooled.write(chunk)
+        spooled.seek(0)
+        content = ChunkedFile(spooled, name=basename)
+        content.size = entry.file_size
+        # used instead of reading the content again (see File.save)
+        content.sha1 = sha1.hexdigest()
+        return content
 
-        search_query = Q(folder=folder) & actual_name_query
+    def _probe_image(self, content):
+        info = probe_image(content)
+        content.seek(0)
+        return info
 
+    def _get_existing_files(self, folder, basenames):
+        """
+        Returns the lists of files of the folder that have the given names,
+            by name.
+        """
+        actual_name_query = (Q(original_filename__in=basenames) & (
+            Q(name__isnull=True) | Q(name__exact=''))) | Q(name__in=basenames)
+        search_query = Q(folder=folder) & actual_name_query
         if getattr(self, 'bypass_owner', False) is False:
             search_query &= Q(owner=self.owner)
+        existing = {}
+        for file_object in File.objects.filter(search_query):
+            existing.setdefault(
+                file_object.name or file_object.original_filename,
+                []).append(file_object)
+        return existing
 
-        file_manager = FileSubClass.objects
-        existing = file_manager.filter(search_query)
-        file_object = None
-        if existing:
-            file_object = existing[0]
-            file_object.name = None
-            file_object.original_filename = basename
-            file_object.file = file_data
-            file_object.save()
-        else:
-            file_object = file_manager.create(
+    def _create_files(self, zippy, members):
+        """Creates (or updates) the filer files of the given zip members."""
+        contents, file_types = [], []
+        for entry, basename, folder in members:
+            contents.append(self._read_member(zippy, entry, basename))
+            file_types.append(matching_file_subtypes(basename, None, None)[0])
+        images = [index for index, FileSubClass in enumerate(file_types)
+                  if FileSubClass is FilerImage]
+        image_infos = dict(zip(images, map_concurrently(
+            self._probe_image, [contents[index] for index in images])))
+
+        existing_by_folder = {}
+        for folder in set(folder for _, _, folder in members):
+            existing_by_folder[folder] = self._get_existing_files(
+                folder, [basename for _, basename, member_folder in members
+                         if member_folder == folder])
+
+        new_files, updated_files = [], []
+        for index, (entry, basename, folder) in enumerate(members):
+            content, FileSubClass = contents[index], file_types[index]
+            info = image_infos.get(index)
+            if FileSubClass is FilerImage and info is None:
+                self.extract_errors.append(
+                    "%s is not a valid image." % basename)
+                continue
+            existing = [file_object for file_object in
+                        existing_by_folder[folder].get(basename, [])
+                        if isinstance(file_object, FileSubClass)]
+            if existing:
+                updated_files.append((existing[0], content))
+                continue
+            file_object = FileSubClass(
                 original_filename=basename,
                 folder=folder,
                 owner=self.owner,
-                file=file_data,
                 is_public=FILER_IS_PUBLIC_DEFAULT,
             )
-        return file_object
+            new_files.append((file_object, content, info))
+
+        def store(new_file):
+            file_object, content, _info = new_file
+            name = file_object._meta.get_field('file').generate_filename(
+                file_object, content.name)
+            return file_object.file.storage.save(name, content)
+        stored_names = map_concurrently(store, new_files)
+
+        # the folder counters and the search index are updated once for the
+        #   whole batch; the thumbnails are queued once the rows are
+        #   committed, otherwise the workers might not find the images
+        saved, images = [], []
+
+        def save(file_object):
+            save_kwargs = dict(update_counters=False,
+                               update_search_index=False)
+            if isinstance(file_object, FilerImage):
+                save_kwargs['queue_thumbnails'] = False
+                images.append(file_object)
+            file_object.save(**save_kwargs)
+            saved.append(file_object)
+
+        with transaction.atomic():
+            for (file_object, content, info), stored_name in zip(
+                    new_files, stored_names):
+                # the content is already stored, its size and sha1 known
+                file_object = file_object.__class__(
+                    original_filename=file_object.original_filename,
+                    folder=file_object.folder,
+                    owner=file_object.owner,
+                    is_public=file_object.is_public,
+                    file=stored_name,
+                    _file_size=content.size,
+                    sha1=content.sha1,
+                )
+                if info is not None:
+                    file_object.set_image_info(info)
+                save(file_object)
+            for file_object, content in updated_files:
+                file_object.name = None
+                file_object.original_filename = content.name
+                file_object.file = content
+                save(file_object)
+            File.update_folder_counters_in_bulk(saved)
+            File.update_search_index_in_bulk(saved)
+        for image in images:
+            image.queue_default_thumbnails()
+        for content in contents:
+            content.close()
 
     class Meta:
         """Meta information for filer file model."""
@@ -198,6 +362,15 @@ class Archive(File):
         verbose_name_plural = _('archives')
 
 
+def _in_folders_query(field_name, folder_ids):
+    """Matches the given folder ids, where None stands for no folder."""
+    query = Q(**{'%s__in' % field_name: [
+        folder_id for folder_id in folder_ids if folder_id is not None]})
+    if None in folder_ids:
+        query |= Q(**{'%s__isnull' % field_name: True})
+    return query
+
+
 def to_unicode(x):  # expects str or unicode
     if isinstance(x, str):
         return x
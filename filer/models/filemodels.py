@@ -1,6 +1,5 @@
 #-*- coding: utf-8 -*-
 import polymorphic
-import hashlib
 import os
 import filer
 import logging
@@ -8,14 +7,15 @@ import operator
 
 from django.contrib.auth import models as auth_models
 from django.core import urlresolvers
-from django.core.files.base import ContentFile
 from django.core.exceptions import ValidationError
 from django.db import (models, IntegrityError, transaction)
 from django.utils.translation import ugettext_lazy as _
 from filer.fields.multistorage_file import MultiStorageFileField
 from filer.models import mixins
 from filer.utils.cms_roles import *
-from filer.utils.files import matching_file_subtypes
+from filer.utils import storage_transfer
+from filer.utils.files import matching_file_subtypes, sha1_for_file
+from filer.utils.search import get_search_backend, get_search_text
 from filer import settings as filer_settings
 from django.db.models import Count
 from django.utils import timezone
@@ -164,6 +164,11 @@ class File(polymorphic.PolymorphicModel,
         self._old_name = self.name
         self._current_file_location = self.file.name
         self._old_folder_id = self.folder_id
+        # folder and size accounted in the folder counters
+        self._counted_folder_id = self.folder_id if self.pk else None
+        self._counted_size = self._file_size or 0
+        # text last indexed for the search
+        self._indexed_search_text = get_search_text(self) if self.pk else None
 
     def clean(self):
         if self.name:
@@ -220,14 +225,8 @@ class File(polymorphic.PolymorphicModel,
         self.is_public = not self.is_public
         self.file.delete_thumbnails()
         self.is_public = not self.is_public
-        # This is needed because most of the remote File Storage backend do not
-        # open the file.
-        src_file = src_storage.open(src_file_name)
-        src_file.open()
-        self.file = dst_storage.save(dst_file_name,
-            ContentFile(src_file.read()))
-        src_file.close()
-        src_storage.delete(src_file_name)
+        self.file = storage_transfer.move_file(
+            src_storage, src_file_name, dst_storage, dst_file_name)
 
     def _copy_file(self, destination, overwrite=False):
         """
@@ -242,35 +241,35 @@ class File(polymorphic.PolymorphicModel,
 
         src_file_name = self._current_file_location
         storage = self.file.storages['public' if self.is_public else 'private']
-
-        if hasattr(storage, 'copy'):
-            storage.copy(src_file_name, destination)
-        else:
-            # This is needed because most of the remote File Storage backend do not
-            # open the file.
-            src_file = storage.open(src_file_name)
-            src_file.open()
-            destination = storage.save(destination,
-                                       ContentFile(src_file.read()))
-            src_file.close()
+        destination = storage_transfer.copy_file(
+            storage, src_file_name, storage, destination)
         self._current_file_location = destination
         self.old_name = self.name
         self._old_folder_id = getattr(self.folder, 'id', None)
         return destination
 
     def generate_sha1(self):
-        sha = hashlib.sha1()
-        self.file.seek(0)
-        sha.update(self.file.read())
-        self.sha1 = sha.hexdigest()
-        # to make sure later operations can read the whole file
-        self.file.seek(0)
+        self.sha1 = sha1_for_file(self.file)
+
+    def _get_uploaded_sha1(self):
+        """
+        Returns the sha1 computed while the new file content was uploaded
+            (see filer.utils.files.handle_upload), if there is one.
+        """
+        if not self.file or self.file._committed:
+            return None
+        # do not use self.file.file since it would open the file on storage
+        return getattr(getattr(self.file, '_file', None), 'sha1', None)
 
     def set_restricted_from_folder(self):
         if self.folder and self.folder.restricted:
             self.restricted = self.folder.restricted
 
     def save(self, *args, **kwargs):
+        # the caller updates the folder counters and the search index itself
+        #   (see update_folder_counters_in_bulk), e.g. for a batch of files
+        update_counters = kwargs.pop('update_counters', True)
+        update_search_index = kwargs.pop('update_search_index', True)
         self.set_restricted_from_folder()
         # check if this is a subclass of "File" or not and set
         # _file_type_plugin_name
@@ -281,30 +280,114 @@ class File(polymorphic.PolymorphicModel,
             pass
         elif issubclass(self.__class__, File):
             self._file_type_plugin_name = self.__class__.__name__
-        # cache the file size
-        # TODO: only do this if needed (depending on the storage backend the whole file will be downloaded)
-        try:
-            self._file_size = self.file.size
-        except:
-            pass
+        # size and sha1 need to be computed only for new content since,
+        #   depending on the storage backend, the whole file will be
+        #   downloaded
+        content_changed = self._is_content_changed()
+        if content_changed:
+            # cache the file size
+            try:
+                self._file_size = self.file.size
+            except:
+                pass
         if self._old_is_public != self.is_public and self.pk:
             self._move_file()
             self._old_is_public = self.is_public
 
-        # generate SHA1 hash
-        # TODO: only do this if needed (depending on the storage backend the whole file will be downloaded)
-        try:
-            self.generate_sha1()
-        except (IOError, TypeError, ValueError) as e:
-            pass
+        if content_changed:
+            # generate SHA1 hash
+            uploaded_sha1 = self._get_uploaded_sha1()
+            if uploaded_sha1:
+                self.sha1 = uploaded_sha1
+            else:
+                try:
+                    self.generate_sha1()
+                except (IOError, TypeError, ValueError) as e:
+                    pass
         if filer_settings.FOLDER_AFFECTS_URL and self._is_path_changed():
             self._force_commit = True
             self.update_location_on_storage(*args, **kwargs)
         else:
             super(File, self).save(*args, **kwargs)
+        self.file.mark_content_stored()
+        if update_counters and self.deleted_at is None:
+            self._update_folder_counters()
+        if update_search_index:
+            self._update_search_index()
 
     save.alters_data = True
 
+    def _update_search_index(self):
+        File.update_search_index_in_bulk([self])
+
+    @staticmethod
+    def update_search_index_in_bulk(files):
+        """
+        Indexes, for the search, the given files whose searched text changed.
+        """
+        changed = [(filer_file, get_search_text(filer_file))
+                   for filer_file in files]
+        changed = [(filer_file, search_text)
+                   for filer_file, search_text in changed
+                   if search_text != filer_file._indexed_search_text]
+        if not changed:
+            return
+        get_search_backend().index_many(
+            [filer_file for filer_file, _ in changed])
+        for filer_file, search_text in changed:
+            filer_file._indexed_search_text = search_text
+
+    def _update_folder_counters(self):
+        File.update_folder_counters_in_bulk([self])
+
+    @staticmethod
+    def update_folder_counters_in_bulk(files):
+        """
+        Moves the given (alive) files from the counters of the folders they
+            were accounted in to the counters of their current folders, with
+            one counters update per folder.
+        """
+        # folder id: [files, subtree files, subtree size]
+        deltas = {}
+        for filer_file in files:
+            size = filer_file._file_size or 0
+            if filer_file._counted_folder_id == filer_file.folder_id:
+                deltas.setdefault(filer_file.folder_id, [0, 0, 0])[2] += (
+                    size - filer_file._counted_size)
+            else:
+                old = deltas.setdefault(
+                    filer_file._counted_folder_id, [0, 0, 0])
+                old[0] -= 1
+                old[1] -= 1
+                old[2] -= filer_file._counted_size
+                new = deltas.setdefault(filer_file.folder_id, [0, 0, 0])
+                new[0] += 1
+                new[1] += 1
+                new[2] += size
+            filer_file._counted_folder_id = filer_file.folder_id
+            filer_file._counted_size = size
+        folders = filer.models.foldermodels.Folder.all_objects
+        for folder_id, (files_delta, subtree_files, subtree_size) in (
+                deltas.items()):
+            folders.update_counters(folder_id, files=files_delta,
+                                    subtree_files=subtree_files,
+                                    subtree_size=subtree_size)
+
+    def _discount_from_folder(self):
+        filer.models.foldermodels.Folder.all_objects.update_counters(
+            self.folder_id, files=-1, subtree_files=-1,
+            subtree_size=-(self._file_size or 0))
+        self._counted_folder_id = None
+
+    def _is_content_changed(self):
+        """
+        Used to detect if the cached file size and sha1 need to be
+            recomputed.
+        """
+        if self._file_size is None or not self.sha1:
+            return True
+        return self.file.content_changed
+
     def _is_path_changed(self):
         """
         Used to detect if file location on storage should be updated or not.
@@ -339,14 +422,11 @@ class File(polymorphic.PolymorphicModel,
             #   filer file instance save
             self.file.storage.save(self._current_file_location, self.file)
             self._old_sha1 = self.sha1
-        new_location = self.file.field.upload_to(self, self.actual_name)
         storage = self.file.storage
-
-        def copy_and_save():
-            saved_as = self._copy_file(new_location)
-            assert saved_as == new_location, '%s %s' % (saved_as, new_location)
-            self.file = saved_as
-            super(File, self).save(*args, **kwargs)
+        # the copy gets another name when the new location is already taken
+        new_location = self._copy_file(
+            self.file.field.upload_to(self, self.actual_name))
+        self.file = new_location
 
         if self._force_commit:
             try:
@@ -359,7 +439,7 @@ class File(polymorphic.PolymorphicModel,
                     # that didn't actually finish succesfull.
                     # This 'hack' can be removed once django adds support for on_commit and
                     # on_rollback hooks (see: https://code.djangoproject.com/ticket/14051)
-                    copy_and_save()
+                    super(File, self).save(*args, **kwargs)
             except:
                 # delete the file from new_location if the db update failed
                 if old_location != new_location:
@@ -370,7 +450,7 @@ class File(polymorphic.PolymorphicModel,
                 if old_location != new_location:
                     storage.delete(old_location)
         else:
-            copy_and_save()
+            super(File, self).save(*args, **kwargs)
         return new_location
 
     def soft_delete(self, *args, **kwargs):
@@ -418,6 +498,7 @@ class File(polymorphic.PolymorphicModel,
 
             self.deleted_at = deletion_time
             self.file = new_location
+            self._discount_from_folder()
 
     def hard_delete(self, *args, **kwargs):
         """
@@ -425,6 +506,8 @@ class File(polymorphic.PolymorphicModel,
         """
         # delete the model before deleting the file from storage
         super(File, self).delete(*args, **kwargs)
+        if self.deleted_at is None:
+            self._discount_from_folder()
         # delete the actual file from storage and all its thumbnails
         #   if there are no other filer files referencing it.
         if not File.objects.filter(file=self.file.name,
@@ -435,20 +518,24 @@ class File(polymorphic.PolymorphicModel,
         super(File, self).delete_restorable(*args, **kwargs)
     delete.alters_data = True
 
-    def _set_valid_name_for_restore(self):
+    def _set_valid_name_for_restore(self, existing_file_names=None):
         """
         Generates the first available name so this file
             can be restored in the folder.
+        The names of the files from the folder are loaded unless they are
+            given (as a set).
         """
         basename, extension = os.path.splitext(self.clean_actual_name)
-        if self.folder:
-            files = self.folder.files
-        elif self.owner:
-            files = filer.models.tools.get_user_clipboard(self.owner).files.all()
-        else:
-            from filer.models.virtualitems import UnfiledImages
-            files = UnfiledImages().files
-        existing_file_names = [f.clean_actual_name for f in files]
+        if existing_file_names is None:
+            if self.folder:
+                files = self.folder.files
+            elif self.owner:
+                files = filer.models.tools.get_user_clipboard(
+                    self.owner).files.all()
+            else:
+                from filer.models.virtualitems import UnfiledImages
+                files = UnfiledImages().files
+            existing_file_names = set(f.clean_actual_name for f in files)
         i = 1
         while self.clean_actual_name in existing_file_names:
             filename = "%s_%s%s" % (basename, i, extension)
@@ -465,6 +552,12 @@ class File(polymorphic.PolymorphicModel,
             If there's already an existing file with the same name, it will
                 generate a new filename.
         """
+        relocations = filer.models.FileRelocation.objects.filter(file=self)
+        if relocations.exists():
+            # the file was not yet moved to its trash location
+            relocations.model.objects.relocate(relocations)
+            self.file.name = File.trash.filter(pk=self.pk).values_list(
+                'file', flat=True)[0]
         if self.folder_id:
             Folder = filer.models.foldermodels.Folder
             try:
@@ -495,6 +588,10 @@ class File(polymorphic.PolymorphicModel,
                 name=self.name, original_filename=self.original_filename)
             self.deleted_at = None
             self.file.name = new_location
+            self._counted_folder_id = None
+            self._counted_size = 0
+            self._update_folder_counters()
+            self._update_search_index()
             # restore to user clipboard
             if self.owner_id and not self.folder_id:
                 clipboard = filer.models.tools.get_user_clipboard(self.owner)
@@ -520,8 +617,13 @@ class File(polymorphic.PolymorphicModel,
             except (IOError, TypeError, ValueError):
                 return self.clean_actual_name
         try:
-            folder = self.folder.get_ancestors().first()
-            root_folder = getattr(folder, 'name', None)
+            if self.folder.path:
+                # "/root/.../folder"
+                names = self.folder.path.split('/')[1:]
+                root_folder = names[0] if len(names) > 1 else None
+            else:
+                ancestors = self.folder.get_cached_ancestors()
+                root_folder = ancestors[0].name if ancestors else None
         except:
             root_folder = None
         if root_folder in filer_settings.FILER_NOHASH_ROOTFOLDERS:
@@ -629,7 +731,7 @@ class File(polymorphic.PolymorphicModel,
         """
         folder_path = []
         if self.folder:
-            folder_path.extend(self.folder.get_ancestors())
+            folder_path.extend(self.folder.get_cached_ancestors())
         folder_path.append(self.logical_folder)
         return folder_path
 
@@ -4,13 +4,18 @@ from django.contrib.auth import models as auth_models
 from django.core import urlresolvers
 from django.core.exceptions import ValidationError
 from django.db import (models, IntegrityError, transaction)
-from django.db.models import (query, Q, signals)
+from django.db.models import (query, Q, F, Count, Sum, Value, signals)
+from django.db.models.functions import Concat, Substr
 from django.dispatch import receiver
 from django.utils.http import urlquote
 from django.utils.translation import ugettext_lazy as _
 from filer.utils.cms_roles import *
+from filer.utils.db import bulk_update_field
+from filer.utils.folder_paths import get_path_hash, update_path_hashes
 from filer.models import mixins
 from filer import settings as filer_settings
+from filer.utils.search import get_search_backend, get_search_text
+from filer.utils.trash import queue_trash_move
 from django.utils import timezone
 import mptt
 import itertools
@@ -86,6 +91,84 @@ class FolderManager(models.Manager):
     def get_queryset(self):
         return FolderQueryset(self.model, using=self._db)
 
+    def update_counters(self, folder_id, files=0, subtree_files=0,
+                        subtree_size=0):
+        """
+        Adds the given deltas to the direct file count of the folder and to
+            the subtree counters of the folder and of all its ancestors.
+        """
+        if not folder_id or not (files or subtree_files or subtree_size):
+            return
+        folders = FolderQueryset(self.model, using=self._db)
+        if files:
+            folders.filter(pk=folder_id).update(
+                direct_file_count=F('direct_file_count') + files)
+        if subtree_files or subtree_size:
+            node = folders.filter(pk=folder_id).values(
+                'tree_id', 'lft', 'rght').first()
+            if node is None:
+                return
+            folders.filter(
+                tree_id=node['tree_id'], lft__lte=node['lft'],
+                rght__gte=node['rght']).update(
+                subtree_file_count=F('subtree_file_count') + subtree_files,
+                subtree_size=F('subtree_size') + subtree_size)
+
+    def recount_children(self, folder_ids):
+        """
+        Recomputes the direct children count of the given folders.
+        """
+        folder_ids = set(folder_id for folder_id in folder_ids if folder_id)
+        if not folder_ids:
+            return
+        folders = FolderQueryset(self.model, using=self._db)
+        counts = dict(folders.alive().filter(
+            parent__in=folder_ids).values_list('parent').annotate(
+            count=Count('id')).order_by())
+        for folder_id in folder_ids:
+            folders.filter(pk=folder_id).update(
+                direct_children_count=counts.get(folder_id, 0))
+
+    def rebuild_counters(self, tree_ids=None, root=None):
+        """
+        Recomputes from scratch the counters of all the folders (or only of
+            the folders from the given trees or from the subtree of the given
+            root folder).
+        """
+        from filer.utils.folder_counters import rebuild_folder_counters
+        return rebuild_folder_counters(
+            self.model, filer.models.filemodels.File, tree_ids, root)
+
+    def update_visible_sites(self, folder_ids=None):
+        """
+        Recomputes the sites where the given folders (or all the folders)
+            are visible (see FolderVisibleSite).
+        """
+        from filer.utils.folder_sites import update_visible_sites
+        return update_visible_sites(
+            self.model, FolderVisibleSite, folder_ids)
+
+    def share_with_sites(self, folder_ids, site_ids):
+        """
+        Replaces the shared sites of the given folders with the given sites
+            using bulk queries (the m2m_changed signal is not sent).
+        """
+        through = self.model.shared.through
+        through.objects.filter(folder__in=folder_ids).delete()
+        through.objects.bulk_create([
+            through(folder_id=folder_id, site_id=site_id)
+            for folder_id in folder_ids for site_id in site_ids],
+            batch_size=filer_settings.FILER_BULK_BATCH_SIZE)
+        self.update_visible_sites(folder_ids)
+
+    def rebuild_paths(self, tree_ids=None):
+        """
+        Recomputes from scratch the paths of all the folders (or only of the
+            folders from the given trees).
+        """
+        from filer.utils.folder_paths import rebuild_folder_paths
+        return rebuild_folder_paths(self.model, tree_ids)
+
     def __getattr__(self, name):
         if name.startswith('__'):
             return super(FolderManager, self).__getattr__(self, name)
@@ -172,6 +255,28 @@ class Folder(models.Model, mixins.IconsMixin):
                     "its assets. However, they will not be able to change, "
                     "delete or move it, not even add new assets."))
 
+    # denormalized counters of the alive files and subfolders; they are
+    #   kept up to date by the file and folder operations and can be
+    #   recomputed with the rebuild_folder_counters command
+    direct_file_count = models.PositiveIntegerField(default=0, editable=False)
+    direct_children_count = models.PositiveIntegerField(
+        default=0, editable=False)
+    subtree_file_count = models.PositiveIntegerField(
+        default=0, editable=False)
+    subtree_size = models.BigIntegerField(default=0, editable=False)
+
+    # denormalized path ("/" + the names of the ancestors and of the folder
+    #   joined by "/"); it is updated for the whole subtree when the folder
+    #   is renamed or moved
+    path = models.TextField(default='', editable=False)
+    # sha1 of the path; the folders are looked up by path through it since
+    #   long paths can't be indexed on all the databases
+    path_hash = models.CharField(max_length=40, default='', editable=False,
+                                 db_index=True)
+
+    COUNTER_FIELDS = ('direct_file_count', 'direct_children_count',
+                      'subtree_file_count', 'subtree_size')
+
     objects = AliveFolderManager()
     trash = TrashFolderManager()
     all_objects = FolderManager()
@@ -183,6 +288,9 @@ class Folder(models.Model, mixins.IconsMixin):
         super(Folder, self).__init__(*args, **kwargs)
         self._old_name = self.name
         self._old_parent_id = self.parent_id
+        self._counted_parent_id = self.parent_id
+        # text last indexed for the search
+        self._indexed_search_text = get_search_text(self) if self.pk else None
 
     def clean(self):
 
@@ -257,82 +365,192 @@ class Folder(models.Model, mixins.IconsMixin):
         Folder type and restriction should be preserved
             to all descendants
         """
-        descendants = None
+        desc_ids = None
         if self._update_descendants:
             descendants = self.get_descendants()
             descendants.update(
                 folder_type=self.folder_type, site=self.site,
                 restricted=self.restricted)
-            desc_ids = [desc.pk for desc in descendants]
-            if self.pk:
-                desc_ids.append(self.pk)
+            desc_ids = list(descendants.values_list('id', flat=True))
             file_mgr = filer.models.filemodels.File.all_objects
             file_mgr.filter(
-                folder__in=desc_ids).update(restricted=self.restricted)
+                folder__in=desc_ids + [self.pk]).update(
+                restricted=self.restricted)
 
         if self.parent:
-            parent_shared_sites = self.parent.shared.values_list(
-                'id', flat=True)
+            parent_shared_sites = set(self.parent.shared.values_list(
+                'id', flat=True))
             instance_shared_sites = self.shared.values_list('id', flat=True)
-            if set(instance_shared_sites) != set(parent_shared_sites):
-                shared_sites = self.parent.shared.all()
-                self.shared = shared_sites
-                descendants = descendants or self.get_descendants()
-                for desc_folder in descendants:
-                    desc_folder.shared = shared_sites
+            if set(instance_shared_sites) != parent_shared_sites:
+                if desc_ids is None:
+                    desc_ids = list(self.get_descendants().values_list(
+                        'id', flat=True))
+                Folder.all_objects.share_with_sites(
+                    desc_ids + [self.pk], parent_shared_sites)
+                return
+
+        if self._update_descendants:
+            # the site of the subtree changed
+            Folder.all_objects.update_visible_sites(desc_ids + [self.pk])
+
+    def get_cached_ancestors(self):
+        """
+        Same as get_ancestors but the ancestors are loaded only once per
+            instance.
+        """
+        if not hasattr(self, '_ancestors_cache'):
+            self._ancestors_cache = list(self.get_ancestors())
+        return self._ancestors_cache
+
+    def _get_user_field_names(self):
+        # the counters are updated with queries; saving the (possibly stale)
+        #   values of this instance would overwrite them
+        return [name for name in super(Folder, self)._get_user_field_names()
+                if name not in Folder.COUNTER_FIELDS]
+
+    def _save_and_count(self, *args, **kwargs):
+        """
+        Saves the folder and moves its subtree counters from its old
+            ancestors to its new ancestors.
+        """
+        created = self.pk is None
+        moved = not created and self._counted_parent_id != self.parent_id
+        counted = self.deleted_at is None
+        if moved:
+            # the node is moved with all its fields saved so make sure the
+            #   counters are current
+            counters = Folder.all_objects.filter(pk=self.pk).values(
+                *Folder.COUNTER_FIELDS).first() or {}
+            for field, value in counters.items():
+                setattr(self, field, value)
+            if counted:
+                Folder.all_objects.update_counters(
+                    self._counted_parent_id,
+                    subtree_files=-self.subtree_file_count,
+                    subtree_size=-self.subtree_size)
+        old_path = self._set_path()
+        super(Folder, self).save(*args, **kwargs)
+        if old_path is not None and old_path != self.path:
+            self._update_descendants_path(old_path)
+        if moved and counted:
+            Folder.all_objects.update_counters(
+                self.parent_id, subtree_files=self.subtree_file_count,
+                subtree_size=self.subtree_size)
+        if created or moved:
+            Folder.all_objects.recount_children(
+                [self._counted_parent_id, self.parent_id])
+        self._counted_parent_id = self.parent_id
+        self._update_search_index()
+
+    def _update_search_index(self):
+        search_text = get_search_text(self)
+        if search_text != self._indexed_search_text:
+            get_search_backend().index(self)
+            self._indexed_search_text = search_text
+
+    def _set_path(self):
+        """
+        Computes the path of the folder from the (saved) path of its parent.
+            Returns the path currently saved for the folder or None if it is
+            not saved yet.
+        """
+        paths = dict(Folder.all_objects.filter(
+            pk__in=[pk for pk in (self.pk, self.parent_id) if pk]
+        ).values_list('pk', 'path'))
+        self.path = '%s/%s' % (paths.get(self.parent_id, ''), self.name)
+        self.path_hash = get_path_hash(self.path)
+        return paths.get(self.pk) if self.pk else None
+
+    def _update_descendants_path(self, old_path):
+        # replaces the old path prefix of all the descendants at once
+        descendants = Folder.all_objects.filter(
+            tree_id=self.tree_id, lft__gt=self.lft, rght__lt=self.rght)
+        descendants.update(path=Concat(
+            Value(self.path), Substr('path', len(old_path) + 1),
+            output_field=models.TextField()))
+        update_path_hashes(descendants)
+
+    def _rename(self, new_name):
+        """
+        Renames the folder with queries (no save, no signals) and updates the
+            paths of its subtree.
+        """
+        old_path = Folder.all_objects.filter(pk=self.pk).values_list(
+            'path', flat=True).first()
+        self.name = new_name
+        self.path = '%s/%s' % (old_path.rpartition('/')[0], new_name)
+        self.path_hash = get_path_hash(self.path)
+        Folder.all_objects.filter(pk=self.pk).update(
+            name=self.name, path=self.path, path_hash=self.path_hash)
+        self._update_descendants_path(old_path)
+        self._update_search_index()
 
     def save(self, *args, **kwargs):
+        # ancestors might change
+        self.__dict__.pop('_ancestors_cache', None)
         if not filer_settings.FOLDER_AFFECTS_URL:
             self.set_metadata_from_parent()
-            super(Folder, self).save(*args, **kwargs)
+            self._save_and_count(*args, **kwargs)
             self.update_descendants_metadata()
             return
 
-        storages = []
-        old_locations = []
-        new_locations = []
-
-        def delete_from_locations(locations, storages):
-            for location, storage in zip(locations, storages):
-                storage.delete(location)
+        relocations = filer.models.FileRelocation.objects
+        if self.pk:
+            # finish moving the files left by a previous save that was
+            #   interrupted
+            relocations.relocate(relocations.for_folder(self))
 
-        try:
-            with transaction.atomic(savepoint=False):
-                self.set_metadata_from_parent()
-                super(Folder, self).save(*args, **kwargs)
-                self.update_descendants_metadata()
-                if self.is_affecting_file_paths():
-                    desc_ids = list(self.get_descendants(
-                        include_self=True).values_list('id', flat=True))
-                    # update location only for alive files
-                    file_mgr = filer.models.filemodels.File.objects
-                    all_files = file_mgr.filter(folder__in=desc_ids)
-                    for f in all_files:
-                        old_location = f.file.name
-                        new_location = f.update_location_on_storage()
-                        if old_location != new_location:
-                            storages.append(f.file.storage)
-                            old_locations.append(old_location)
-                            new_locations.append(new_location)
-        except:
-            delete_from_locations(new_locations, storages)
-            raise
-        else:
-            delete_from_locations(old_locations, storages)
+        with transaction.atomic(savepoint=False):
+            self.set_metadata_from_parent()
+            self._save_and_count(*args, **kwargs)
+            self.update_descendants_metadata()
+            affects_file_paths = self.is_affecting_file_paths()
+            if affects_file_paths:
+                # new locations are computed and recorded together with the
+                #   folder change
+                relocations.plan_for_folder(self)
+        if affects_file_paths:
+            # files are moved in batches; if this gets interrupted the files
+            #   still point to their old locations and the relocations will
+            #   be finished by the next save or by the resume_file_relocations
+            #   command
+            relocations.relocate(relocations.for_folder(self))
 
     def soft_delete(self):
+        """
+        Moves the folder, its subfolders and their files to the trash with a
+            few queries. The files are moved to their trash location on
+            storage afterwards, outside the request (see
+            filer.utils.trash.queue_trash_move).
+        """
+        relocations = filer.models.FileRelocation.objects
+        # finish moving the files left by a rename or move that was
+        #   interrupted; the trash locations are planned from their locations
+        relocations.relocate(relocations.for_folder(self))
         deletion_time = timezone.now()
         desc_ids = list(self.get_descendants(
             include_self=True).values_list('id', flat=True))
-        # soft delete all alive files
-        file_mgr = filer.models.filemodels.File.objects
-        files_qs = file_mgr.filter(folder__in=desc_ids)
-        for filer_file in files_qs:
-            filer_file.soft_delete(deletion_time=deletion_time)
-        # soft delete all alive folders
-        Folder.objects.filter(
-            id__in=desc_ids).update(deleted_at=deletion_time)
+        files_qs = filer.models.filemodels.File.objects.filter(
+            folder__in=desc_ids)
+        with transaction.atomic():
+            # trash locations are computed while the folders are alive
+            moves = relocations.plan_for_trash(self)
+            totals = files_qs.aggregate(
+                count=Count('id'), size=Sum('_file_size'))
+            # soft delete all alive files and folders
+            files_qs.update(deleted_at=deletion_time)
+            Folder.objects.filter(
+                id__in=desc_ids).update(deleted_at=deletion_time)
+            # trashed files are not counted
+            Folder.all_objects.filter(id__in=desc_ids).update(
+                direct_file_count=0, subtree_file_count=0, subtree_size=0)
+            Folder.all_objects.update_counters(
+                self.parent_id, subtree_files=-totals['count'],
+                subtree_size=-(totals['size'] or 0))
+            Folder.all_objects.recount_children([self.parent_id])
         self.deleted_at = deletion_time
+        if moves:
+            queue_trash_move(self)
 
     def hard_delete(self):
         # This would happen automatically by ways of the delete
@@ -345,6 +563,7 @@ class Folder(models.Model, mixins.IconsMixin):
         for file_obj in file_mgr.filter(folder__in=desc_ids):
             file_obj.hard_delete()
         super(Folder, self).delete()
+        Folder.all_objects.recount_children([self.parent_id])
 
     def delete(self, *args, **kwargs):
         super(Folder, self).delete_restorable(*args, **kwargs)
@@ -373,31 +592,114 @@ class Folder(models.Model, mixins.IconsMixin):
             first_node_trashed = first_node_trashed[0]
             new_name = first_node_trashed._generate_valid_name_for_restore()
             if new_name != first_node_trashed.name:
-                Folder.trash.filter(
-                    id=first_node_trashed.id).update(name=new_name)
+                first_node_trashed._rename(new_name)
+            parent_ids = list(trashed_ancestors.values_list(
+                'parent_id', flat=True))
             trashed_ancestors.update(deleted_at=None)
+            Folder.all_objects.recount_children(parent_ids)
 
     def restore(self):
         """
             Restores all files and subfolders contained in this folder.
+        The names already used in the folders are changed in memory and the
+            rows are updated in bulk. The files are moved back from their
+            trash location as file relocations, in batches and concurrently
+            (see FileRelocation).
         """
+        relocations = filer.models.FileRelocation.objects
+        # finish moving the files to the trash before moving them back
+        relocations.relocate(relocations.for_folder(self))
         self.restore_path()
-        # add self since it was restored with restore_path method
-        desc_ids = [self.id]
-        descendants = self.get_descendants(include_self=True).filter(
-            deleted_at__isnull=False)
-        for descendant in descendants:
-            new_name = descendant._generate_valid_name_for_restore()
-            Folder.trash.filter(id=descendant.id).update(
-                deleted_at=None, name=new_name)
-            desc_ids.append(descendant.id)
-        # restore self and descendants files
-        file_mgr = filer.models.filemodels.File.trash
-        files_qs = file_mgr.filter(folder__in=desc_ids)
-        for filer_file in files_qs:
-            filer_file.restore()
+        with transaction.atomic():
+            file_ids = self._restore_descendants()
+            relocations.plan_for_restore(self, file_ids)
+        relocations.relocate(relocations.for_folder(self))
         self.deleted_at = None
 
+    def _restore_descendants(self):
+        """
+        Restores the trashed subfolders of this (alive) folder and the
+            trashed files of this folder and of the restored subfolders.
+            Returns the ids of the restored files.
+        """
+        File = filer.models.filemodels.File
+        # parents come before their children
+        subtree = list(self.get_descendants(include_self=True).order_by(
+            'lft'))
+        restored = [folder for folder in subtree
+                    if folder.deleted_at is not None]
+        used_names = {}
+        for folder in subtree:
+            if folder.deleted_at is None:
+                used_names.setdefault(folder.parent_id, set()).add(
+                    folder.name)
+        renamed, paths = [], {}
+        for folder in restored:
+            names = used_names.setdefault(folder.parent_id, set())
+            name, i = folder.name, 1
+            while name in names:
+                name = "%s_%s" % (folder.name, i)
+                i += 1
+            names.add(name)
+            if name != folder.name:
+                folder.name = name
+                renamed.append(folder)
+        by_id = {folder.pk: folder for folder in subtree}
+        for folder in subtree:
+            if folder.pk == self.pk:
+                continue
+            path = '%s/%s' % (by_id[folder.parent_id].path, folder.name)
+            if path != folder.path:
+                folder.path = paths[folder.pk] = path
+        folders = Folder.all_objects.all()
+        bulk_update_field(folders, 'name', {
+            folder.pk: folder.name for folder in renamed})
+        bulk_update_field(folders, 'path', paths)
+        bulk_update_field(folders, 'path_hash', dict(
+            (pk, get_path_hash(path)) for pk, path in paths.items()))
+        Folder.trash.filter(
+            tree_id=self.tree_id, lft__gt=self.lft, rght__lt=self.rght
+        ).update(deleted_at=None)
+        for folder in renamed:
+            folder._update_search_index()
+
+        folder_ids = [self.pk] + [folder.pk for folder in restored]
+        used_names = {}
+        for folder_id, name, original_filename in File.objects.filter(
+                folder__in=folder_ids).values_list(
+                'folder', 'name', 'original_filename'):
+            used_names.setdefault(folder_id, set()).add(
+                name if name not in ('', None) else original_filename)
+        files = list(File.trash.filter(folder__in=folder_ids).order_by('pk'))
+        renamed = []
+        for filer_file in files:
+            names = used_names.setdefault(filer_file.folder_id, set())
+            old_names = (filer_file.name, filer_file.original_filename)
+            filer_file._set_valid_name_for_restore(names)
+            names.add(filer_file.clean_actual_name)
+            if (filer_file.name, filer_file.original_filename) != old_names:
+                renamed.append(filer_file)
+        file_rows = File._base_manager.all()
+        bulk_update_field(file_rows, 'name', {
+            filer_file.pk: filer_file.name for filer_file in renamed})
+        bulk_update_field(file_rows, 'original_filename', {
+            filer_file.pk: filer_file.original_filename
+            for filer_file in renamed})
+        File.trash.filter(folder__in=folder_ids).update(deleted_at=None)
+        for filer_file in renamed:
+            filer_file._update_search_index()
+
+        # the restored files and subfolders are counted again
+        old_totals = (by_id[self.pk].subtree_file_count,
+                      by_id[self.pk].subtree_size)
+        Folder.all_objects.rebuild_counters(root=self)
+        new_totals = Folder.all_objects.filter(pk=self.pk).values_list(
+            'subtree_file_count', 'subtree_size')[0]
+        Folder.all_objects.update_counters(
+            self.parent_id, subtree_files=new_totals[0] - old_totals[0],
+            subtree_size=new_totals[1] - old_totals[1])
+        return [filer_file.pk for filer_file in files]
+
     @property
     def trashed_file_count(self):
         file_mgr = filer.models.filemodels.File.trash
@@ -409,15 +711,11 @@ class Folder(models.Model, mixins.IconsMixin):
 
     @property
     def file_count(self):
-        if not hasattr(self, '_file_count_cache'):
-            self._file_count_cache = self.files.count()
-        return self._file_count_cache
+        return self.direct_file_count
 
     @property
     def children_count(self):
-        if not hasattr(self, '_children_count_cache'):
-            self._children_count_cache = self.children.count()
-        return self._children_count_cache
+        return self.direct_children_count
 
     @property
     def item_count(self):
@@ -474,6 +772,8 @@ class Folder(models.Model, mixins.IconsMixin):
 
     @property
     def pretty_logical_path(self):
+        if self.path and self.deleted_at is None:
+            return self.path
         return "/%s" % "/".join([f.name
                                    for f in self.logical_path + [self]])
 
@@ -507,9 +807,17 @@ class Folder(models.Model, mixins.IconsMixin):
         except Folder.DoesNotExist:
             return False
 
+    @property
+    def shared_site_ids(self):
+        # the directory listing fetches the shared sites of all its folders
+        #   at once (see filer.admin.tools.prefetch_listing_items)
+        if getattr(self, '_shared_site_ids_cache', None) is not None:
+            return self._shared_site_ids_cache
+        return set(self.shared.values_list('id', flat=True))
+
     @property
     def get_folder_type_display(self):
-        if self.shared.exists():
+        if self.shared_site_ids:
             return 'Shared by site'
         return Folder.FOLDER_TYPES[self.folder_type]
 
@@ -517,9 +825,9 @@ class Folder(models.Model, mixins.IconsMixin):
         return self.folder_type == Folder.CORE_FOLDER
 
     def is_readonly_for_user(self, user):
-        return self.is_core() or (
+        return self.is_core() or bool(
             self.site and not has_role_on_site(user, self.site) and
-            self.shared.filter(id__in=get_sites_for_user(user)).exists())
+            self.shared_site_ids.intersection(get_sites_for_user(user)))
 
     def is_restricted_for_user(self, user):
         perm = 'filer.can_restrict_operations'
@@ -574,7 +882,7 @@ class Folder(models.Model, mixins.IconsMixin):
 
         if not self.site:
             return False
-        if not self.parent:
+        if not self.parent_id:
             # only site admins can change root site folders
             return has_admin_role_on_site(user, self.site)
         perm = 'filer.change_folder'
@@ -616,17 +924,48 @@ except mptt.AlreadyRegistered:
     pass
 
 
+class FolderVisibleSite(models.Model):
+    """
+    A site where a folder is visible: the site of the folder or a site the
+        folder is shared with. Kept up to date when the sites of the folders
+        change; it allows filtering the folders visible on some sites
+        without joining the shared sites (and without DISTINCT).
+    """
+    folder = models.ForeignKey(Folder, related_name='visible_sites',
+                               on_delete=models.CASCADE)
+    site = models.ForeignKey(Site, related_name='+', on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'filer'
+        unique_together = (('site', 'folder'),)
+
+
 @receiver(signals.m2m_changed, sender=Folder.shared.through)
 def update_shared_sites_for_descendants(instance, **kwargs):
     """
-    Makes sure that folders keep all shared sites from their root folder.
+    Makes sure that folders keep all shared sites from their root folder
+        and keeps the visible sites of the changed folders up to date.
     """
     action = kwargs['action']
-    if not action.startswith('post_') or instance.parent_id:
+    if kwargs['reverse']:
+        # the folders shared with a site changed
+        if action == 'pre_clear':
+            instance._shared_folder_ids = list(
+                instance.shared.values_list('id', flat=True))
+        elif action == 'post_clear':
+            Folder.all_objects.update_visible_sites(
+                instance.__dict__.pop('_shared_folder_ids', []))
+        elif action.startswith('post_'):
+            Folder.all_objects.update_visible_sites(kwargs['pk_set'])
+        return
+    if not action.startswith('post_'):
+        return
+    if instance.parent_id:
+        Folder.all_objects.update_visible_sites([instance.pk])
         return
 
     instance = Folder.all_objects.get(id=instance.id)
-    sites = instance.shared.all()
-    descendants = instance.get_descendants()
-    for desc_folder in descendants:
-        desc_folder.shared = sites
+    site_ids = list(instance.shared.values_list('id', flat=True))
+    desc_ids = list(instance.get_descendants().values_list('id', flat=True))
+    Folder.all_objects.share_with_sites(desc_ids, site_ids)
+    Folder.all_objects.update_visible_sites([instance.pk])
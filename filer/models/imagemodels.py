@@ -1,14 +1,7 @@
 #-*- coding: utf-8 -*-
+import json
 import logging
 
-try:
-    from PIL import Image as PILImage
-except ImportError:
-    try:
-        import Image as PILImage
-    except ImportError:
-        raise ImportError("The Python Imaging Library was not found.")
-from datetime import datetime
 from django.core import urlresolvers
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
@@ -18,7 +11,9 @@ from django.core.exceptions import ValidationError
 from filer import settings as filer_settings
 from filer.models.filemodels import File
 from filer.utils.filer_easy_thumbnails import FilerThumbnailer
-from filer.utils.pil_exif import get_exif_for_file
+from filer.utils.pil_exif import (
+    probe_image, get_serializable_exif, get_subject_location)
+from filer.utils.thumbnails import queue_thumbnails
 import os
 
 logger = logging.getLogger("filer")
@@ -72,6 +67,10 @@ class Image(File):
 
     subject_location = models.CharField(_('subject location'), max_length=64, null=True, blank=True,
                                         default=None)
+    # json encoded EXIF data read when the image content was saved (None if
+    #   it was not read yet or the file could not be read, see the
+    #   backfill_image_exif command)
+    _exif_data = models.TextField(null=True, blank=True, editable=False)
 
     @classmethod
     def matches_file_type(cls, iname, ifile, request):
@@ -102,35 +101,34 @@ class Image(File):
         super(Image, self).clean()
 
     def save(self, *args, **kwargs):
-        if self.date_taken is None:
-            try:
-                exif_date = self.exif.get('DateTimeOriginal', None)
-                if exif_date is not None:
-                    d, t = str.split(exif_date.values)
-                    year, month, day = d.split(':')
-                    hour, minute, second = t.split(':')
-                    if getattr(settings, "USE_TZ", False):
-                        tz = timezone.get_current_timezone()
-                        self.date_taken = timezone.make_aware(datetime(
-                            int(year), int(month), int(day),
-                            int(hour), int(minute), int(second)), tz)
-                    else:
-                        self.date_taken = datetime(
-                            int(year), int(month), int(day),
-                            int(hour), int(minute), int(second))
-            except:
-                pass
+        # the caller queues the thumbnails itself, e.g. once its transaction
+        #   is committed and the workers can see the image
+        queue_thumbnails = kwargs.pop('queue_thumbnails', True)
+        content_changed = self._is_content_changed()
+        if content_changed:
+            # new content, new dimensions and EXIF data
+            self.__dict__.pop('_image_info_cache', None)
+            self.__dict__.pop('_exif_cache', None)
+        info = None
+        if (self.date_taken is None or self._width is None or
+                self._exif_data is None or content_changed):
+            info = self.image_info
+        if info is not None:
+            self.set_image_info(info)
+        elif content_changed:
+            # not stored until the image can be read (see the
+            #   backfill_image_exif command)
+            self._exif_data = None
         if self.date_taken is None:
             self.date_taken = timezone.now()
         self.has_all_mandatory_data = self._check_validity()
-        try:
-            # do this more efficient somehow?
-            self.file.seek(0)
-            self._width, self._height = PILImage.open(self.file).size
-        except Exception:
-            # probably the image is missing. nevermind.
-            pass
         super(Image, self).save(*args, **kwargs)
+        if info is not None:
+            # the file might have a new name once stored
+            self._image_info_cache = (self.file.name, info)
+        if (queue_thumbnails and content_changed and
+                not self.is_in_trash()):
+            self.queue_default_thumbnails()
 
     def _check_validity(self):
         if not self.name:
@@ -143,17 +141,69 @@ class Image(File):
         else:
             return 1.0
 
+    @property
+    def image_info(self):
+        """
+        Dimensions, EXIF data, orientation and date taken of the image (see
+            filer.utils.pil_exif.probe_image) or None if the file is not a
+            readable image. The file is opened (from any storage) once.
+        """
+        cached = self.__dict__.get('_image_info_cache')
+        if cached is not None and cached[0] == self.file.name:
+            return cached[1]
+        info = None
+        if self.file:
+            try:
+                self.file.seek(0)
+                info = probe_image(self.file)
+                self.file.seek(0)
+            except Exception:
+                # probably the image is missing. nevermind.
+                pass
+        self._image_info_cache = (self.file.name, info)
+        return info
+
+    def set_image_info(self, info):
+        """
+        Sets the dimensions, EXIF data and (when missing) the date taken
+            from the given image info of the current file.
+        """
+        self._image_info_cache = (self.file.name, info)
+        self._width, self._height = info.width, info.height
+        self._exif_data = self._dump_exif(info)
+        self.__dict__.pop('_exif_cache', None)
+        if self.date_taken is None and info.date_taken:
+            if getattr(settings, "USE_TZ", False):
+                tz = timezone.get_current_timezone()
+                self.date_taken = timezone.make_aware(info.date_taken, tz)
+            else:
+                self.date_taken = info.date_taken
+
+    @staticmethod
+    def _dump_exif(info):
+        return json.dumps(get_serializable_exif(info.exif))
+
     def _get_exif(self):
-        if hasattr(self, '_exif_cache'):
+        """
+        EXIF data stored when the image was saved. It is read from the file
+            of the images whose EXIF data is not stored yet.
+        """
+        if '_exif_cache' in self.__dict__:
             return self._exif_cache
-        else:
-            if self.file:
-                self._exif_cache = get_exif_for_file(self.file.path)
-            else:
-                self._exif_cache = {}
+        exif_data = self._exif_data
+        if exif_data is None:
+            info = self.image_info
+            exif_data = self._dump_exif(info) if info is not None else '{}'
+        self._exif_cache = json.loads(exif_data)
         return self._exif_cache
     exif = property(_get_exif)
 
+    def get_subject_location(self):
+        """
+        Subject location (x, y) recorded by the camera, if any.
+        """
+        return get_subject_location(self.exif)
+
     @property
     def label(self):
         if self.name in ['', None]:
@@ -169,15 +219,25 @@ class Image(File):
     def height(self):
         return self._height or 0
 
-    def _generate_thumbnails(self, required_thumbnails):
+    def _get_required_thumbnails(self, required_thumbnails):
+        return dict(
+            (name, dict(opts, subject_location=self.subject_location))
+            for name, opts in list(required_thumbnails.items()))
+
+    def _get_icon_thumbnails(self):
+        return dict(
+            (size, {'size': (int(size), int(size)),
+                    'crop': True,
+                    'upscale': True})
+            for size in filer_settings.FILER_ADMIN_ICON_SIZES)
+
+    def _get_existing_thumbnails(self, required_thumbnails):
         _thumbnails = {}
-        if self.is_in_trash():
-            return _thumbnails
         for name, opts in list(required_thumbnails.items()):
             try:
-                opts.update({'subject_location': self.subject_location})
-                thumb = self.file.get_thumbnail(opts)
-                _thumbnails[name] = thumb.url
+                thumb = self.file.get_thumbnail(opts, generate=False)
+                if thumb is not None:
+                    _thumbnails[name] = thumb.url
             except Exception as e:
                 # catch exception and manage it. We can re-raise it for debugging
                 # purposes and/or just logging it, provided user configured
@@ -188,15 +248,38 @@ class Image(File):
                     raise e
         return _thumbnails
 
+    def _generate_thumbnails(self, required_thumbnails):
+        """
+        Returns the urls of the thumbnails that are already rendered and
+            queues the missing ones (see filer.utils.thumbnails).
+        """
+        if self.is_in_trash():
+            return {}
+        required_thumbnails = self._get_required_thumbnails(
+            required_thumbnails)
+        _thumbnails = self._get_existing_thumbnails(required_thumbnails)
+        missing = dict((name, opts)
+                       for name, opts in required_thumbnails.items()
+                       if name not in _thumbnails)
+        if missing and queue_thumbnails(self, missing):
+            _thumbnails.update(self._get_existing_thumbnails(missing))
+        return _thumbnails
+
+    def queue_default_thumbnails(self):
+        """
+        Queues the rendering of the icons and of the default thumbnails.
+        """
+        required_thumbnails = self._get_icon_thumbnails()
+        required_thumbnails.update(Image.DEFAULT_THUMBNAILS)
+        queue_thumbnails(
+            self, self._get_required_thumbnails(required_thumbnails))
+
     @property
     def icons(self):
-        required_thumbnails = dict(
-            (size, {'size': (int(size), int(size)),
-                    'crop': True,
-                    'upscale': True,
-                    'subject_location': self.subject_location})
-            for size in filer_settings.FILER_ADMIN_ICON_SIZES)
-        return self._generate_thumbnails(required_thumbnails)
+        # the generic image icons are shown until the thumbnails are rendered
+        _icons = super(Image, self).icons
+        _icons.update(self._generate_thumbnails(self._get_icon_thumbnails()))
+        return _icons
 
     @property
     def thumbnails(self):
@@ -0,0 +1,210 @@
+#-*- coding: utf-8 -*-
+import json
+import time
+from datetime import timedelta
+
+from django.contrib import messages as django_messages
+from django.contrib.auth import models as auth_models
+from django.db import models
+from django.db.models import F
+from django.utils import timezone
+from django.utils.translation import ugettext, ugettext_lazy as _
+
+from filer import settings as filer_settings
+
+
+class FolderJobManager(models.Manager):
+
+    def unfinished(self):
+        return self.filter(status__in=(FolderJob.QUEUED, FolderJob.RUNNING))
+
+    def stale(self):
+        """
+        Unfinished jobs that made no progress for FILER_JOB_TIMEOUT seconds:
+            they were lost by their executor (ex: the process was restarted).
+        """
+        return self.unfinished().filter(
+            updated_at__lt=timezone.now() - timedelta(
+                seconds=filer_settings.FILER_JOB_TIMEOUT))
+
+    def fail_stale(self, jobs=None):
+        """
+        Marks the stale jobs (from the given ones) as failed.
+        """
+        stale = self.stale()
+        if jobs is not None:
+            stale = stale.filter(pk__in=jobs)
+        for job in stale:
+            job.add_message(ugettext(
+                "%(action)s was interrupted before it finished.") % {
+                    'action': job.get_action_display()},
+                level=django_messages.ERROR)
+            job.finish(failed=True)
+
+    def to_notify(self, user):
+        """
+        Finished jobs of the user whose messages were not shown yet.
+        """
+        return self.filter(
+            owner=user, notified=False,
+            status__in=(FolderJob.DONE, FolderJob.FAILED))
+
+
+class FolderJob(models.Model):
+    """
+    A long running folder action (copy, move, delete, extract) that runs
+        outside the admin request (see filer.utils.jobs).
+    """
+    COPY = 'copy'
+    MOVE = 'move'
+    DELETE = 'delete'
+    EXTRACT = 'extract'
+
+    ACTIONS = (
+        (COPY, _('Copy')),
+        (MOVE, _('Move')),
+        (DELETE, _('Delete')),
+        (EXTRACT, _('Extract')),
+    )
+
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+    STATUSES = (
+        (QUEUED, _('Queued')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+
+    # minimum number of seconds between two progress writes
+    PROGRESS_INTERVAL = 1
+
+    action = models.CharField(max_length=20, choices=ACTIONS)
+    status = models.IntegerField(choices=STATUSES, default=QUEUED)
+    owner = models.ForeignKey(auth_models.User, verbose_name=_('owner'),
+                              related_name='filer_folder_jobs',
+                              on_delete=models.SET_NULL,
+                              null=True, blank=True)
+    # folder from which the action was started
+    folder = models.ForeignKey('Folder', verbose_name=_('folder'),
+                               related_name='jobs',
+                               on_delete=models.SET_NULL,
+                               null=True, blank=True)
+    # json encoded arguments of the action (selected files/folders, ...)
+    arguments = models.TextField(default='{}')
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    # json encoded list of (message level, message) shown to the owner
+    #   after the job finishes
+    messages = models.TextField(default='[]')
+    notified = models.BooleanField(default=False)
+    created_at = models.DateTimeField(_('created at'), auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # last time the job was started or made progress
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    objects = FolderJobManager()
+
+    def __init__(self, *args, **kwargs):
+        super(FolderJob, self).__init__(*args, **kwargs)
+        self._unsaved_progress = 0
+        self._last_progress_write = 0
+
+    def get_arguments(self):
+        return json.loads(self.arguments)
+
+    def set_arguments(self, **arguments):
+        self.arguments = json.dumps(arguments)
+
+    def get_messages(self):
+        return json.loads(self.messages)
+
+    def add_message(self, message, level=django_messages.INFO):
+        self.messages = json.dumps(
+            self.get_messages() + [[level, "%s" % message]])
+
+    @property
+    def is_finished(self):
+        return self.status in (FolderJob.DONE, FolderJob.FAILED)
+
+    @property
+    def percent(self):
+        if not self.total:
+            return 100 if self.is_finished else 0
+        return min(100, int(100 * self.processed / self.total))
+
+    def start(self):
+        """
+        Marks the queued job as running. Returns False if the job was already
+            started (ex: it was submitted again).
+        """
+        now = timezone.now()
+        started = FolderJob.objects.filter(
+            pk=self.pk, status=FolderJob.QUEUED).update(
+            status=FolderJob.RUNNING, started_at=now, updated_at=now)
+        if started:
+            self.status = FolderJob.RUNNING
+            self.started_at = self.updated_at = now
+        return bool(started)
+
+    def advance(self, count=1):
+        """
+        Adds to the processed items. Progress is written to the database at
+            most once every PROGRESS_INTERVAL seconds.
+        """
+        self._unsaved_progress += count
+        if time.time() - self._last_progress_write >= self.PROGRESS_INTERVAL:
+            self._write_progress()
+
+    def _write_progress(self):
+        if self._unsaved_progress:
+            self.updated_at = timezone.now()
+            FolderJob.objects.filter(pk=self.pk).update(
+                processed=F('processed') + self._unsaved_progress,
+                updated_at=self.updated_at)
+            self.processed += self._unsaved_progress
+            self._unsaved_progress = 0
+        self._last_progress_write = time.time()
+
+    def finish(self, failed=False):
+        self._write_progress()
+        self.status = FolderJob.FAILED if failed else FolderJob.DONE
+        self.finished_at = self.updated_at = timezone.now()
+        self.save(update_fields=[
+            'status', 'finished_at', 'updated_at', 'messages'])
+
+    def notify(self, request):
+        """
+        Shows the job messages to the user and marks the job as notified.
+        """
+        for level, message in self.get_messages():
+            django_messages.add_message(request, level, message)
+        FolderJob.objects.filter(pk=self.pk).update(notified=True)
+        self.notified = True
+
+    def as_dict(self):
+        return {
+            'id': self.pk,
+            'action': self.action,
+            'action_display': "%s" % self.get_action_display(),
+            'status': self.status,
+            'status_display': "%s" % self.get_status_display(),
+            'total': self.total,
+            'processed': self.processed,
+            'percent': self.percent,
+            'finished': self.is_finished,
+        }
+
+    def __str__(self):
+        return "%s job %s (%s)" % (
+            self.get_action_display(), self.pk, self.get_status_display())
+
+    class Meta:
+        app_label = 'filer'
+        ordering = ('created_at',)
+        verbose_name = _('folder job')
+        verbose_name_plural = _('folder jobs')
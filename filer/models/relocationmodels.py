@@ -0,0 +1,235 @@
+#-*- coding: utf-8 -*-
+import itertools
+import logging
+
+from django.db import models, transaction
+from django.utils.translation import ugettext_lazy as _
+from filer import settings as filer_settings
+from filer.models import filemodels
+from filer.utils import storage_transfer
+from filer.utils.db import bulk_update_field, chunked
+from filer.utils.filer_easy_thumbnails import delete_thumbnails_in_bulk
+from filer.utils.generate_filename import get_trash_path
+
+
+logger = logging.getLogger(__name__)
+
+
+def _subtree_files_q(folder, prefix=''):
+    return models.Q(**{
+        prefix + 'folder__tree_id': folder.tree_id,
+        prefix + 'folder__lft__gte': folder.lft,
+        prefix + 'folder__rght__lte': folder.rght,
+    })
+
+
+def _cache_subtree_ancestors(folder):
+    """
+    Loads the folder's subtree and computes the ancestors of each subfolder
+        in memory (see Folder.get_cached_ancestors).
+    Returns the subtree folders by id.
+    """
+    subtree = sorted(folder.get_descendants(include_self=True),
+                     key=lambda subfolder: subfolder.lft)
+    folders_by_id = {subfolder.pk: subfolder for subfolder in subtree}
+    ancestors = {folder.pk: folder.get_cached_ancestors()}
+    # parents are always before their children when ordered by lft
+    for subfolder in subtree:
+        if subfolder.pk not in ancestors:
+            parent = folders_by_id.get(subfolder.parent_id)
+            if parent is None or parent.pk not in ancestors:
+                continue
+            ancestors[subfolder.pk] = ancestors[parent.pk] + [parent]
+        subfolder._ancestors_cache = ancestors[subfolder.pk]
+    return folders_by_id
+
+
+class FileRelocationManager(models.Manager):
+
+    def for_folder(self, folder):
+        """
+        Relocations of the files from the folder's subtree.
+        """
+        return self.filter(_subtree_files_q(folder, prefix='file__'))
+
+    def _plan(self, folder, get_new_location, file_ids=None):
+        """
+        Records the relocations of the subtree files to the locations given by
+            ``get_new_location``. The pending relocations of these files (not
+            finished by a concurrent save) are replaced since they start from
+            the same location.
+        """
+        folders_by_id = _cache_subtree_ancestors(folder)
+        pending = set(self.filter(
+            _subtree_files_q(folder, prefix='file__'),
+            status=FileRelocation.PENDING).values_list('file_id', flat=True))
+        subtree_files = filemodels.File.objects.filter(
+            _subtree_files_q(folder))
+        if file_ids is None:
+            files = subtree_files.iterator()
+        else:
+            files = itertools.chain.from_iterable(
+                subtree_files.filter(pk__in=batch_ids)
+                for batch_ids in chunked(sorted(file_ids)))
+        relocations, replaced = [], []
+        for file_obj in files:
+            if file_obj.pk in pending:
+                replaced.append(file_obj.pk)
+            file_obj.folder = folders_by_id[file_obj.folder_id]
+            old_location = file_obj.file.name
+            new_location = get_new_location(file_obj)
+            if old_location != new_location:
+                relocations.append(self.model(
+                    file_id=file_obj.pk, is_public=file_obj.is_public,
+                    old_location=old_location, new_location=new_location))
+        for batch_ids in chunked(replaced):
+            self.filter(file__in=batch_ids,
+                        status=FileRelocation.PENDING).delete()
+        self.bulk_create(
+            relocations, batch_size=filer_settings.FILER_BULK_BATCH_SIZE)
+        return len(relocations)
+
+    def plan_for_folder(self, folder):
+        """
+        Computes the new storage location of all the alive files from the
+            folder's subtree (after the folder was renamed or moved) and
+            records the files that need to be moved.
+        No query is done per file: the folders' paths are computed in memory
+            from the subtree.
+        """
+        return self._plan(folder, lambda file_obj: file_obj.file.field.upload_to(
+            file_obj, file_obj.actual_name))
+
+    def plan_for_trash(self, folder):
+        """
+        Records the trash location of all the alive files from the folder's
+            subtree. Must be called before the subtree is moved to the trash
+            since the trash locations are built from the alive paths.
+        """
+        return self._plan(folder, get_trash_path)
+
+    def plan_for_restore(self, folder, file_ids):
+        """
+        Records the location, in the restored folder's subtree, of the given
+            (restored) files that are still in their trash location.
+        """
+        return self._plan(folder, lambda file_obj: file_obj.file.field.upload_to(
+            file_obj, file_obj.upload_to_name), file_ids)
+
+    def relocate(self, relocations=None):
+        """
+        Moves the files on storage and updates their location in the
+            database, in batches. Each batch is done in its own transaction so
+            the progress is kept if the process is interrupted; calling this
+            again resumes from where it stopped.
+        """
+        if relocations is None:
+            relocations = self.all()
+        relocation_ids = list(
+            relocations.order_by('pk').values_list('pk', flat=True))
+        for batch_ids in chunked(relocation_ids):
+            self._relocate_batch(list(self.filter(pk__in=batch_ids)))
+        return len(relocation_ids)
+
+    def _relocate_batch(self, batch):
+        pending = [relocation for relocation in batch
+                   if relocation.status == FileRelocation.PENDING]
+        for is_public in (True, False):
+            old_locations = [relocation.old_location for relocation in pending
+                             if relocation.is_public == is_public]
+            if old_locations:
+                # thumbnails will get generated again for the new location
+                delete_thumbnails_in_bulk(
+                    FileRelocation.get_storage(is_public),
+                    FileRelocation.get_thumbnail_storage(is_public),
+                    old_locations)
+        saved_as = storage_transfer.map_concurrently(
+            FileRelocation.copy, pending)
+        with transaction.atomic():
+            bulk_update_field(
+                filemodels.File._base_manager.all(), 'file',
+                {relocation.file_id: new_location
+                 for relocation, new_location in zip(pending, saved_as)})
+            self.filter(pk__in=[relocation.pk for relocation in pending]
+                        ).update(status=FileRelocation.MOVED)
+        # the files now point to the new locations; old locations that are
+        #   still used by alive files are kept
+        referenced = set(filemodels.File.objects.non_polymorphic().filter(
+            file__in=[relocation.old_location for relocation in batch]
+        ).values_list('file', 'is_public'))
+        storage_transfer.map_concurrently(FileRelocation.delete_old, [
+            relocation for relocation in batch
+            if (relocation.old_location, relocation.is_public)
+            not in referenced])
+        self.filter(pk__in=[relocation.pk for relocation in batch]).delete()
+
+
+class FileRelocation(models.Model):
+    """
+    Keeps track of a file that needs to be moved on storage after its folder
+        (or an ancestor) was renamed or moved, while FOLDER_AFFECTS_URL is
+        enabled, or after its folder was moved to or restored from the
+        trash.
+    Relocations left by interrupted folder saves are finished by the
+        resume_file_relocations command.
+    """
+    PENDING = 0
+    # file location was updated in the database but the file was not yet
+    #   removed from the old location
+    MOVED = 1
+
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (MOVED, 'Moved'),
+    )
+
+    file = models.ForeignKey('File', verbose_name=_('file'),
+                             related_name='relocations')
+    is_public = models.BooleanField(default=True)
+    old_location = models.CharField(max_length=255)
+    new_location = models.CharField(max_length=255)
+    status = models.IntegerField(choices=STATUSES, default=PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = FileRelocationManager()
+
+    @staticmethod
+    def get_storage(is_public):
+        field = filemodels.File._meta.get_field('file')
+        return field.storages['public' if is_public else 'private']
+
+    @staticmethod
+    def get_thumbnail_storage(is_public):
+        field = filemodels.File._meta.get_field('file')
+        return field.thumbnail_storages['public' if is_public else 'private']
+
+    @property
+    def storage(self):
+        return self.get_storage(self.is_public)
+
+    def copy(self):
+        """
+        Copies the file to the new location and returns the name under which
+            it was saved.
+        """
+        try:
+            return storage_transfer.copy_file(
+                self.storage, self.old_location,
+                self.storage, self.new_location)
+        except Exception as e:
+            filemodels.silence_error_if_missing_file(e)
+            if filer_settings.FILER_ENABLE_LOGGING:
+                logger.error('Error while trying to copy file: %s to %s.' % (
+                    self.old_location, self.new_location), e)
+            return self.new_location
+
+    def delete_old(self):
+        self.storage.delete(self.old_location)
+
+    def __str__(self):
+        return "%s -> %s" % (self.old_location, self.new_location)
+
+    class Meta:
+        app_label = 'filer'
+        verbose_name = _('file relocation')
+        verbose_name_plural = _('file relocations')
@@ -0,0 +1,25 @@
+#-*- coding: utf-8 -*-
+from django.db import models
+
+
+class SearchToken(models.Model):
+    """
+    A word of the name, description or original file name of a file or of
+        the name of a folder. Used by the indexed search backend (see
+        filer.utils.search).
+    """
+    MAX_LENGTH = 64
+
+    token = models.CharField(max_length=MAX_LENGTH, db_index=True)
+    file = models.ForeignKey('filer.File', null=True, blank=True,
+                             related_name='search_tokens',
+                             on_delete=models.CASCADE)
+    folder = models.ForeignKey('filer.Folder', null=True, blank=True,
+                               related_name='search_tokens',
+                               on_delete=models.CASCADE)
+
+    def __str__(self):
+        return self.token
+
+    class Meta:
+        app_label = 'filer'
@@ -30,6 +30,9 @@ if not FILER_STATICMEDIA_PREFIX:
 
 FILER_ADMIN_ICON_SIZES = getattr(settings, "FILER_ADMIN_ICON_SIZES", ('32',))
 
+# Size of the chunks used when filer streams file content (hashing, copying).
+FILER_FILE_CHUNK_SIZE = getattr(settings, 'FILER_FILE_CHUNK_SIZE', 64 * 2 ** 10)
+
 # This is an ordered iterable that describes a list of
 # classes that I should check for when adding files
 FILER_FILE_MODELS = getattr(settings, 'FILER_FILE_MODELS',
@@ -219,6 +222,55 @@ FILER_PRIVATEMEDIA_SERVER = load_object(FILER_SERVERS['private']['main']['ENGINE
 FILER_PRIVATEMEDIA_THUMBNAIL_SERVER = load_object(FILER_SERVERS['private']['thumbnails']['ENGINE'])(**FILER_SERVERS['private']['thumbnails']['OPTIONS'])
 
 FOLDER_AFFECTS_URL = getattr(settings, 'FILER_FOLDER_AFFECTS_URL', False)
+
+# Ordered list of callables that copy files between storages. The first one
+#   that can handle the source and destination storages does the copy (see
+#   filer.utils.storage_transfer).
+FILER_FILE_TRANSFER_BACKENDS = getattr(settings, 'FILER_FILE_TRANSFER_BACKENDS', (
+    'filer.utils.storage_transfer.server_side_copy',
+    'filer.utils.storage_transfer.hard_link',
+    'filer.utils.storage_transfer.local_copy',
+    'filer.utils.storage_transfer.streamed_copy',
+))
+# Number of threads used for storage operations that filer runs concurrently
+#   (ex: moving the files of a renamed folder).
+FILER_STORAGE_WORKERS = getattr(settings, 'FILER_STORAGE_WORKERS', 8)
+# Number of rows written/processed at once by bulk operations.
+FILER_BULK_BATCH_SIZE = getattr(settings, 'FILER_BULK_BATCH_SIZE', 500)
+# Runs the long folder actions from the admin (copy, move, delete, extract)
+#   outside the request (see filer.utils.jobs).
+FILER_JOB_EXECUTOR = getattr(
+    settings, 'FILER_JOB_EXECUTOR', 'filer.utils.jobs.thread_executor')
+# Number of threads used by the thread job executor.
+FILER_JOB_WORKERS = getattr(settings, 'FILER_JOB_WORKERS', 2)
+# Number of seconds after which an unfinished folder job that made no
+#   progress is considered lost and marked as failed.
+FILER_JOB_TIMEOUT = getattr(settings, 'FILER_JOB_TIMEOUT', 1800)
+# Renders the missing image thumbnails outside the request that needs them.
+#   See filer.utils.thumbnails.
+FILER_THUMBNAIL_EXECUTOR = getattr(
+    settings, 'FILER_THUMBNAIL_EXECUTOR',
+    'filer.utils.thumbnails.thread_executor')
+# Number of threads used by the thread thumbnail executor.
+FILER_THUMBNAIL_WORKERS = getattr(settings, 'FILER_THUMBNAIL_WORKERS', 2)
+# Moves the files of deleted folders to their trash location on storage
+#   outside the request. See filer.utils.trash.
+FILER_TRASH_MOVE_EXECUTOR = getattr(
+    settings, 'FILER_TRASH_MOVE_EXECUTOR',
+    'filer.utils.trash.thread_executor')
+# Number of source files whose thumbnail names and urls are also kept in
+#   memory (0 disables the manifest). See filer.utils.filer_easy_thumbnails.
+FILER_THUMBNAIL_MANIFEST_SIZE = getattr(
+    settings, 'FILER_THUMBNAIL_MANIFEST_SIZE', 10000)
+# Alias of the django cache that keeps the thumbnail manifest for all the
+#   processes (None disables the manifest).
+FILER_THUMBNAIL_MANIFEST_CACHE = getattr(
+    settings, 'FILER_THUMBNAIL_MANIFEST_CACHE', 'default')
+# Searches the files and folders of the directory listing. See
+#   filer.utils.search.
+FILER_SEARCH_BACKEND = getattr(
+    settings, 'FILER_SEARCH_BACKEND',
+    'filer.utils.search.QuerySearchBackend')
 CDN_DOMAIN = getattr(settings, 'FILER_CDN_DOMAIN', None)
 CDN_INVALIDATION_TIME = getattr(settings, 'FILER_CDN_INVALIDATION_TIME', 0)
 FILER_TRASH_PREFIX = getattr(settings, 'FILER_TRASH_PREFIX', '_trash')
@@ -259,6 +311,23 @@ FILER_TRASH_CLEAN_INTERVAL = getattr(settings, 'FILER_TRASH_CLEAN_INTERVAL', 60
 #     """
 #     pass
 
+# The manager can also define (optional, avoids a has_perm_on_site call per site):
+#
+# def get_sites_with_perm(user, perm):
+#     """
+#     :param perm: full name (<app_label>.<permission>) of the permission
+#     :return: list of django.contrib.sites.models.Site IDs on which the user has the permission.
+#     """
+#     pass
+
 FILER_ROLES_MANAGER = getattr(settings,
                               'FILER_ROLES_MANAGER',
                               'cmsroles.siteadmin.FilerRolesManager')
+# Seconds the permissions fetched from the roles manager are cached between
+#   requests (0 keeps them only for the current request).
+#   See filer.utils.cms_roles.
+FILER_PERMISSIONS_CACHE_TIMEOUT = getattr(
+    settings, 'FILER_PERMISSIONS_CACHE_TIMEOUT', 0)
+# Alias of the cache (from settings.CACHES) that keeps the permissions
+FILER_PERMISSIONS_CACHE = getattr(
+    settings, 'FILER_PERMISSIONS_CACHE', 'default')
@@ -1,4 +1,5 @@
 #-*- coding: utf-8 -*-
+import logging
 import urllib.request, urllib.parse, urllib.error
 
 from django.core.files.storage import FileSystemStorage
@@ -9,6 +10,8 @@ try:
 except ImportError:
     from storages.backends.s3boto3 import S3Boto3Storage as S3BotoStorage
 
+logger = logging.getLogger(__name__)
+
 
 class PublicFileSystemStorage(FileSystemStorage):
     """
@@ -60,17 +63,57 @@ class PatchedS3BotoStorage(S3BotoStorage):
         return False
 
     def copy(self, src_name, dst_name):
-        src_path = self._normalize_name(self._clean_name(src_name))
+        self._copy_object(self, src_name, dst_name)
+
+    def delete_many(self, names):
+        """
+        Deletes the objects with one multi-object delete request per 1000
+            names. Returns the names of the objects that were not deleted.
+        """
+        names_by_key = dict(
+            (self._normalize_name(self._clean_name(name)), name)
+            for name in names)
+        keys = list(names_by_key)
+        failed = []
+        for start in range(0, len(keys), 1000):
+            response = self.bucket.delete_objects(Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+                'Quiet': True})
+            for error in response.get('Errors', []):
+                logger.error('Could not delete %s: %s %s', error['Key'],
+                             error.get('Code'), error.get('Message'))
+                failed.append(names_by_key.get(error['Key'], error['Key']))
+        return failed
+
+    def copy_from(self, src_storage, src_name, dst_name):
+        """
+        Server side copy of an object from another bucket. Returns the name
+            of the copy (existing objects are not overwritten) or None if
+            the source storage is not a S3 storage.
+        """
+        if not isinstance(src_storage, S3BotoStorage):
+            return None
+        dst_name = self.get_available_name(dst_name)
+        self._copy_object(src_storage, src_name, dst_name)
+        return dst_name
+
+    def _copy_object(self, src_storage, src_name, dst_name):
+        src_path = src_storage._normalize_name(
+            src_storage._clean_name(src_name))
         dst_path = self._normalize_name(self._clean_name(dst_name))
         copy_source = {
-            'Bucket': self.bucket.name,
+            'Bucket': src_storage.bucket.name,
             'Key': src_path
         }
-        source_obj = self.bucket.Object(src_path)
+        source_obj = src_storage.bucket.Object(src_path)
         extra_args = {
             'ContentType': source_obj.content_type
         }
-        # we cannot preserve acl in boto3, but we can give public read
-        if self.has_public_read(source_obj):
-            extra_args['ACL'] = 'public-read'
-        self.bucket.copy(copy_source, dst_path, extra_args)
\ No newline at end of file
+        if src_storage is self:
+            # we cannot preserve acl in boto3, but we can give public read
+            if self.has_public_read(source_obj):
+                extra_args['ACL'] = 'public-read'
+        elif getattr(self, 'default_acl', None):
+            # objects copied from other buckets get this bucket's acl
+            extra_args['ACL'] = self.default_acl
+        self.bucket.copy(copy_source, dst_path, extra_args)
@@ -6,3 +6,21 @@ from django.core.management import call_command
 @task
 def take_out_filer_trash_task():
     call_command("take_out_filer_trash")
+
+
+@task
+def run_folder_job_task(job_id):
+    from filer.utils.jobs import run_job
+    run_job(job_id)
+
+
+@task
+def render_thumbnails_task(image_id, thumbnails):
+    from filer.utils.thumbnails import render_thumbnails
+    render_thumbnails(image_id, thumbnails)
+
+
+@task
+def move_files_to_trash_task(folder_id):
+    from filer.utils.trash import move_files_to_trash
+    move_files_to_trash(folder_id)
@@ -85,15 +85,24 @@ def get_popup_params(context, sep='?'):
     return params
 
 
+def _for_user(filer_obj, user, check):
+    # the directory listing precomputes these checks for all its items
+    #   (see filer.admin.tools.prefetch_listing_items)
+    cached = getattr(filer_obj, '_%s_cache' % check, None)
+    if cached is not None and cached[0] == user.pk:
+        return cached[1]
+    return getattr(filer_obj, 'is_%s' % check)(user)
+
+
 @register.filter
 def is_restricted_for_user(filer_obj, user):
-    return (filer_obj.is_readonly_for_user(user) or
-            filer_obj.is_restricted_for_user(user))
+    return (_for_user(filer_obj, user, 'readonly_for_user') or
+            _for_user(filer_obj, user, 'restricted_for_user'))
 
 
 @register.filter
 def is_readonly_for_user(filer_obj, user):
-    return filer_obj.is_readonly_for_user(user)
+    return _for_user(filer_obj, user, 'readonly_for_user')
 
 
 @register.filter
@@ -59,6 +59,11 @@ CACHE_BACKEND = 'locmem:///'
 SECRET_KEY = 'secret'
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
+# run the folder jobs in the request so tests can check their results
+FILER_JOB_EXECUTOR = 'filer.utils.jobs.immediate_executor'
+FILER_THUMBNAIL_EXECUTOR = 'filer.utils.thumbnails.immediate_executor'
+FILER_TRASH_MOVE_EXECUTOR = 'filer.utils.trash.immediate_executor'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
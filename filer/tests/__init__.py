@@ -1,5 +1,6 @@
 #-*- coding: utf-8 -*-
 from filer.tests.admin import *
+from filer.tests.commands import *
 from filer.tests.models import *
 from filer.tests.server_backends import *
 from filer.tests.tools import *
@@ -1,9 +1,12 @@
 #-*- coding: utf-8 -*-
+import hashlib
 import os
 import tempfile
 import zipfile
 import io
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 from django.core import files as dj_files
@@ -17,6 +20,7 @@ from filer.models.archivemodels import Archive
 from filer.models.foldermodels import Folder
 from filer.models.imagemodels import Image
 from filer.models.clipboardmodels import Clipboard
+from filer.models.jobmodels import FolderJob
 from filer.models.virtualitems import FolderRoot
 from filer.models import tools
 from filer.tests.helpers import (
@@ -74,6 +78,51 @@ class FilerFolderAdminUrlsTests(TestCase):
         self.assertEqual(Folder.objects.all()[0].name, FOLDER_NAME)
         self.assertEqual(response.status_code, 302)
 
+    def test_directory_listing_queries_do_not_depend_on_items(self):
+        site = Site.objects.get(id=1)
+        folder = Folder.objects.create(name='parent', site=site)
+
+        def add_items(count):
+            for i in range(count):
+                child = Folder.objects.create(
+                    name='child %d' % Folder.objects.count(),
+                    parent=folder, owner=self.superuser, site=site)
+                child.shared.add(site)
+                File.objects.create(
+                    original_filename='file %d' % File.objects.count(),
+                    folder=folder, owner=self.superuser,
+                    file=dj_files.base.ContentFile('data'))
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(get_dir_listing_url(folder))
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        add_items(1)
+        # creates the clipboard
+        count_queries()
+        queries = count_queries()
+        add_items(4)
+        self.assertEqual(count_queries(), queries)
+
+    def test_directory_listing_search_is_ranked(self):
+        folder = Folder.objects.create(name='photos')
+        beach = File.objects.create(
+            original_filename='beach.jpg', description='summer holiday',
+            folder=folder, file=dj_files.base.ContentFile(b'data'))
+        summer = File.objects.create(
+            original_filename='summer.jpg', folder=folder,
+            file=dj_files.base.ContentFile(b'data'))
+        File.objects.create(
+            original_filename='winter.jpg', folder=folder,
+            file=dj_files.base.ContentFile(b'data'))
+        response = self.client.get(get_dir_listing_url(None), {'q': 'summer'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [item.pk for item in response.context['paginated_items']],
+            [summer.pk, beach.pk])
+
     def test_filer_directory_listing_root_empty_get(self):
         response = self.client.get(get_dir_listing_url(None))
         self.assertEqual(response.status_code, 200)
@@ -304,6 +353,32 @@ class FilerClipboardAdminUrlsTests(TestCase):
         self.assertEqual(Image.objects.all()[0].original_filename,
                          self.image_name)
 
+    def test_filer_upload_stores_sha1_computed_on_upload(self):
+        with open(self.filename, 'rb') as f:
+            expected_sha1 = hashlib.sha1(f.read()).hexdigest()
+        original_generate_sha1 = Image.generate_sha1
+
+        def fail_generate_sha1(instance):
+            raise AssertionError('Content was read again to compute sha1')
+        Image.generate_sha1 = fail_generate_sha1
+        try:
+            file_obj = dj_files.File(open(self.filename))
+            self.client.post(
+                reverse('admin:filer-ajax_upload'), {
+                'Filename': self.image_name,
+                'Filedata': file_obj,
+                'jsessionid': self.client.session.session_key, })
+            self.client.post(reverse('admin:filer-ajax_upload') +
+                '?filename=raw_%s' % self.image_name,
+                data=open(self.filename, 'rb').read(),
+                content_type='application/octet-stream',
+                **{'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'})
+        finally:
+            Image.generate_sha1 = original_generate_sha1
+        self.assertEqual(Image.objects.count(), 2)
+        for image in Image.objects.all():
+            self.assertEqual(image.sha1, expected_sha1)
+
     def test_filer_ajax_upload_long_filename(self):
         # additional setup
         # create an image with a long filename
@@ -563,6 +638,39 @@ class FilerBulkOperationsTests(BulkOperationsMixin, TestCase):
                 filer_obj_as_checkox(self.src_folder),
         }, follow=True)
 
+    def test_move_action_runs_as_folder_job(self):
+        response, _ = move_action(
+            self.client, self.src_folder, self.dst_folder, [self.image_obj],
+            follow=True)
+        job = FolderJob.objects.get()
+        self.assertEqual(job.action, FolderJob.MOVE)
+        self.assertEqual(job.status, FolderJob.DONE)
+        self.assertEqual(job.owner, self.superuser)
+        self.assertEqual(job.folder, self.src_folder)
+        self.assertEqual((job.processed, job.total), (1, 1))
+        self.assertTrue(job.notified)
+        self.assertIn("Successfully moved 1 files and/or folders",
+                      get_user_message(response).message)
+        self.assertEqual(self.dst_folder.files.count(), 1)
+
+    def test_folder_job_status(self):
+        job = FolderJob.objects.create(
+            action=FolderJob.COPY, owner=self.superuser, total=4,
+            processed=1)
+        url = reverse('admin:filer-folder_job_status', args=(job.id, ))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        status = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(status['status'], FolderJob.QUEUED)
+        self.assertEqual(status['percent'], 25)
+        self.assertFalse(status['finished'])
+
+        create_staffuser('joe')
+        self.client.logout()
+        self.client.login(username='joe', password='secret')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
 
 class FilerDeleteOperationTests(BulkOperationsMixin, TestCase):
 
@@ -2510,6 +2618,39 @@ class TestAdminTools(TestCase):
         self.assertEqual(File.objects.filter(restricted=False).count(), 0)
         self.assertEqual(Folder.objects.filter(restricted=False).count(), 0)
 
+    def test_multi_action_permission_denials(self):
+        from filer.admin.tools import MultiActionPermission
+        root = Folder.objects.create(name='root', site=self.site)
+        child = Folder.objects.create(name='child', parent=root)
+        Folder.objects.create(name='restricted', parent=child, restricted=True)
+        other = Folder.objects.create(name='other', site=self.other_site)
+        other_child = Folder.objects.create(name='other child', parent=other)
+        core = Folder.objects.create(
+            name='core', folder_type=Folder.CORE_FOLDER)
+        core_file = File.objects.create(original_filename='core', folder=core)
+        other_file = File.objects.create(
+            original_filename='other', folder=other_child)
+        permission = MultiActionPermission(
+            self.user,
+            File.objects.filter(id__in=[core_file.id, other_file.id]),
+            Folder.objects.filter(id__in=[child.id, other_child.id]))
+        # roles are fetched once per user
+        permission.denials()
+        # selected folders, restricted folders of their trees and files
+        with self.assertNumQueries(3):
+            denials = permission.denials()
+        self.assertEqual(denials, {
+            MultiActionPermission.READONLY: {
+                'files': [core_file.id], 'folders': []},
+            MultiActionPermission.NO_SITE: {
+                'files': [core_file.id], 'folders': []},
+            MultiActionPermission.RESTRICTED: {
+                'files': [], 'folders': [child.id]},
+            MultiActionPermission.OTHER_SITE: {
+                'files': [other_file.id], 'folders': [other_child.id]},
+        })
+        self.assertFalse(permission.is_allowed())
+
     def test_truncate_filename_no_extension(self):
         jpeg_file = io.StringIO('      JFIF') # jpeg signature
         jpeg_file.name = '123456789'
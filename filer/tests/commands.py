@@ -3,11 +3,13 @@ from io import StringIO
 from datetime import datetime, timedelta
 
 from django.test import TestCase
+from django.core.files.base import ContentFile
 from django.core.management import call_command
+from django.utils import timezone
 
 from filer.models.foldermodels import Folder
 from filer.models.filemodels import File
-from filer.settings import FILER_TRASH_CLEAN_INTERVAL
+from filer.settings import FILER_JOB_TIMEOUT, FILER_TRASH_CLEAN_INTERVAL
 
 
 class TestTakeOutTrashCommand(TestCase):
@@ -56,12 +58,7 @@ class TestTakeOutTrashCommand(TestCase):
         stdout, stderr = self.run_trash_command()
         self.assertEqual(stderr.getvalue(), "", "Errors found while running command!")
         stdout_val = stdout.getvalue()
-        deleted_files = stdout_val.count("Deleting file")
-        self.assertEqual(deleted_files, 2,
-                         "Deleted unexpected number of files: " + str(deleted_files))
-        deleted_folders = stdout_val.count("Deleting folder")
-        self.assertEqual(deleted_folders, 3,
-                         "Deleted unexpected number of folders: " + str(deleted_folders))
+        self.assertIn("2 files (0 on storage) and 3 folders deleted", stdout_val)
         self.assert_required_files_remain()
         self.assert_folder_does_not_exist("old_del_dir")
         self.assert_folder_does_not_exist("old_del_sub_dir")
@@ -77,10 +74,119 @@ class TestTakeOutTrashCommand(TestCase):
         self.assertEqual(stderr.getvalue(), "", "Errors found while running command!")
         self.assert_required_files_remain()
 
-    def run_trash_command(self):
+    def test_dry_run(self):
+        stdout, stderr = self.run_trash_command(dry_run=True)
+        self.assertIn("2 files (0 on storage) and 3 folders deleted",
+                      stdout.getvalue())
+        Folder.all_objects.get(name="old_del_sub_dir")
+        File.all_objects.get(original_filename="old_del_top_file")
+
+    def test_not_empty_folders_are_kept(self):
+        File.objects.create(original_filename="kept_file",
+                            folder=self.old_del_sub_dir)
+        stdout, stderr = self.run_trash_command()
+        self.assertIn("2 folders kept", stdout.getvalue())
+        Folder.all_objects.get(name="old_del_dir")
+        self.assert_folder_does_not_exist("old_del_empty_dir")
+
+    def test_referenced_storage_files_are_kept(self):
+        alive = File.objects.create(
+            original_filename="alive",
+            file=ContentFile(b'data', name='alive.txt'))
+        shared = File.objects.create(
+            original_filename="old_del_shared_file", deleted_at=self.long_ago)
+        unique = File.objects.create(
+            original_filename="old_del_unique_file", deleted_at=self.long_ago,
+            file=ContentFile(b'data', name='unique.txt'))
+        File.all_objects.filter(pk=shared.pk).update(file=alive.file.name)
+        storage = alive.file.storage
+        stdout, stderr = self.run_trash_command()
+        self.assertIn("4 files (1 on storage)", stdout.getvalue())
+        self.assertTrue(storage.exists(alive.file.name))
+        self.assertFalse(storage.exists(unique.file.name))
+        alive.delete(to_trash=False)
+
+    def test_thumbnails_of_purged_images_are_deleted(self):
+        import io
+        from easy_thumbnails.models import Source
+        from filer.models import Image
+        from filer.tests.helpers import create_image
+        content = io.BytesIO()
+        create_image(size=(40, 30)).save(content, 'JPEG')
+        image = Image.objects.create(
+            original_filename="old_del_image",
+            file=ContentFile(content.getvalue(), name='old_del_image.jpg'))
+        thumbnail = image.file.get_thumbnail({'size': (32, 32)})
+        thumbnail_storage = image.file.thumbnail_storage
+        self.assertTrue(thumbnail_storage.exists(thumbnail.name))
+        File.objects.filter(pk=image.pk).update(deleted_at=self.long_ago)
+        stdout, stderr = self.run_trash_command()
+        self.assertIn("3 files (1 on storage)", stdout.getvalue())
+        self.assertFalse(thumbnail_storage.exists(thumbnail.name))
+        self.assertFalse(
+            Source.objects.filter(name=image.file.name).exists())
+
+    def test_storage_delete_errors_are_counted(self):
+        failed = File.objects.create(
+            original_filename="old_del_failed", deleted_at=self.long_ago,
+            file=ContentFile(b'data', name='failed.txt'))
+        storage = failed.file.storage
+        # the batch delete reports every object as not deleted
+        storage.delete_many = lambda names: list(names)
+        try:
+            stdout, stderr = self.run_trash_command()
+        finally:
+            del storage.delete_many
+        self.assertIn("1 errors.", stdout.getvalue())
+        self.assertIn("Could not delete from storage: %s" % failed.file.name,
+                      stdout.getvalue())
+        self.assertTrue(storage.exists(failed.file.name))
+        storage.delete(failed.file.name)
+
+    def test_purged_subtrees_leave_no_gaps(self):
+        from filer.utils.checktrees import TreeChecker
+        old_child = Folder.objects.create(name="old_del_child",
+                                          parent=self.root_dir)
+        Folder.objects.create(name="old_del_grandchild", parent=old_child)
+        Folder.objects.create(name="after", parent=self.root_dir)
+        Folder.all_objects.filter(name__in=[
+            "old_del_child", "old_del_grandchild"]).update(
+            deleted_at=self.long_ago)
+        self.run_trash_command()
+        self.assert_folder_does_not_exist("old_del_grandchild")
+        TreeChecker(Folder.all_objects).find_corruptions()
+        self.assertEqual(Folder.objects.get(pk=self.root_dir.pk).get_descendant_count(), 2)
+
+    def test_lost_trash_moves_are_finished(self):
+        from filer.models import FileRelocation
+        from filer.utils import trash
+        # the executor loses the moves
+        trash.get_trash_move_executor._cache = lambda folder_id: None
+        try:
+            moved_dir = Folder.objects.create(name="moved_dir")
+            moved_file = File.objects.create(
+                original_filename="moved_file", folder=moved_dir,
+                file=ContentFile(b'data', name='moved.txt'))
+            Folder.objects.get(pk=moved_dir.pk).delete()
+        finally:
+            del trash.get_trash_move_executor._cache
+        stdout, stderr = self.run_trash_command()
+        self.assertNotIn("Moved", stdout.getvalue())
+        FileRelocation.objects.update(
+            created_at=timezone.now() - timedelta(hours=1))
+        stdout, stderr = self.run_trash_command()
+        self.assertIn("Moved 1 files of deleted folders to the trash.",
+                      stdout.getvalue())
+        self.assertFalse(FileRelocation.objects.exists())
+        moved_file = File.trash.get(pk=moved_file.pk)
+        self.assertTrue(moved_file.file.name.startswith('_trash/'))
+        self.assertTrue(moved_file.file.storage.exists(moved_file.file.name))
+
+    def run_trash_command(self, **options):
         stdout = StringIO()
         stderr = StringIO()
-        call_command("take_out_filer_trash", stdout=stdout, stderr=stderr)
+        call_command("take_out_filer_trash", stdout=stdout, stderr=stderr,
+                     **options)
         return stdout, stderr
 
     def assert_required_files_remain(self):
@@ -105,3 +211,55 @@ class TestTakeOutTrashCommand(TestCase):
         with self.assertRaises(File.DoesNotExist):
             File.all_objects.get(original_filename=file_name)
 
+
+
+class TestResumeFolderJobsCommand(TestCase):
+    """ Tests for the management command that recovers the folder jobs. """
+
+    def test_queued_jobs_are_resumed_and_lost_jobs_fail(self):
+        from filer.models import FolderJob
+        from filer.utils import jobs
+        long_ago = timezone.now() - timedelta(
+            seconds=FILER_JOB_TIMEOUT + 60)
+        lost = FolderJob.objects.create(
+            action=FolderJob.COPY, status=FolderJob.RUNNING,
+            updated_at=long_ago)
+        queued = FolderJob.objects.create(
+            action=FolderJob.MOVE, updated_at=long_ago)
+        submitted = []
+        jobs.get_job_executor._cache = submitted.append
+        try:
+            stdout = StringIO()
+            call_command("resume_folder_jobs", stdout=stdout)
+        finally:
+            del jobs.get_job_executor._cache
+        self.assertEqual(stdout.getvalue(),
+                         "Submitted 1 queued folder jobs.\n")
+        self.assertEqual(submitted, [queued])
+        self.assertEqual(FolderJob.objects.get(pk=queued.pk).status,
+                         FolderJob.QUEUED)
+        lost = FolderJob.objects.get(pk=lost.pk)
+        self.assertEqual(lost.status, FolderJob.FAILED)
+        self.assertEqual(len(lost.get_messages()), 1)
+        # a job is run only once
+        jobs.run_job(lost.pk)
+        self.assertEqual(FolderJob.objects.get(pk=lost.pk).status,
+                         FolderJob.FAILED)
+
+
+class TestFilesStatusCommand(TestCase):
+    """ Tests for the management command that checks the filer files. """
+
+    def test_default_output_is_json_lines(self):
+        import json
+        missing = File.objects.create(
+            original_filename="missing",
+            file=ContentFile(b'data', name='missing.txt'))
+        missing.file.storage.delete(missing.file.name)
+        stdout, stderr = StringIO(), StringIO()
+        call_command("files_status", stdout=stdout, stderr=stderr,
+                     check_urls=False)
+        rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [missing.pk])
+        self.assertIn("Checking filer files.", stderr.getvalue())
+        missing.delete(to_trash=False)
@@ -151,15 +151,17 @@ class SettingsOverride(object):
             return inner
 
 
+    _missing = object()
+
     def enable(self):
         self.old = {}
         for key, value in list(self.overrides.items()):
-            self.old[key] = getattr(self.settings_module, key, None)
+            self.old[key] = getattr(self.settings_module, key, self._missing)
             setattr(self.settings_module, key, value)
 
     def disable(self):
        for key, value in list(self.old.items()):
-            if value is not None:
+            if value is not self._missing:
                 setattr(self.settings_module, key, value)
             else:
                 delattr(self.settings_module,key)
@@ -1,4 +1,6 @@
 #-*- coding: utf-8 -*-
+import datetime
+import hashlib
 import os
 import tempfile
 import urllib.parse
@@ -12,19 +14,26 @@ from django.test.utils import override_settings
 from django.core.files import File as DjangoFile
 from django.core.exceptions import ValidationError
 from django.contrib.admin import helpers
+from django.contrib.sites.models import Site
 from django.core import files as dj_files
 
 from filer import settings as filer_settings
-from filer.models.foldermodels import Folder
+from filer.models.foldermodels import Folder, FolderVisibleSite
 from filer.models.imagemodels import Image
 from filer.models.filemodels import File
 from filer.models.archivemodels import Archive
 from filer.models.clipboardmodels import Clipboard
+from filer.models.relocationmodels import FileRelocation
+from filer.models.searchmodels import SearchToken
 from filer.tests.helpers import (
     get_dir_listing_url, create_superuser, create_folder_structure,
     create_image, create_clipboard_item, SettingsOverride,
     filer_obj_as_checkox)
+from filer.utils import cms_roles, search
 from filer.utils.generate_filename import by_path
+from filer.utils.multi_model_qs import MultiModelQuerysetChain
+from filer.utils.files import sha1_for_file
+from filer.utils.folder_paths import get_path_hash
 
 
 def create_filer_image_obj(image_name, size=(800, 600), **kwargs):
@@ -108,6 +117,119 @@ class FilerApiTests(TestCase):
             self.assertEqual(os.path.basename(icons[size]),
                              file_basename + '__%sx%s_q85_crop_subsampling-2_upscale.jpg' %(size,size))
 
+    def test_icons_are_queued_until_rendered(self):
+        from filer.utils import thumbnails
+        queued = []
+
+        def queue_only(image_id, thumbs):
+            queued.append((image_id, thumbs))
+            return False
+        thumbnails.get_thumbnail_executor._cache = queue_only
+        try:
+            image = self.create_filer_image()
+            # the upload queued the icons and the default thumbnails
+            self.assertEqual(len(queued), 1)
+            self.assertEqual(queued[0][0], image.pk)
+            # pending thumbnails are not queued again
+            self.assertEqual(image.icons, super(Image, image).icons)
+            self.assertEqual(image.thumbnails, {})
+            self.assertEqual(len(queued), 1)
+        finally:
+            del thumbnails.get_thumbnail_executor._cache
+        thumbnails.render_thumbnails(*queued[0])
+        file_basename = os.path.basename(image.file.path)
+        for size in filer_settings.FILER_ADMIN_ICON_SIZES:
+            self.assertEqual(
+                os.path.basename(image.icons[size]),
+                file_basename + '__%sx%s_q85_crop_subsampling-2_upscale.jpg' %
+                (size, size))
+        self.assertEqual(len(image.thumbnails), len(Image.DEFAULT_THUMBNAILS))
+
+    def test_existing_thumbnails_do_not_use_storage(self):
+        image = Image.objects.create(
+            owner=self.superuser, original_filename=self.image_name,
+            file=DjangoFile(open(self.filename, 'rb'),
+                            name=self.image_name))
+        icons = image.icons
+        image = Image.objects.get(pk=image.pk)
+        storage = image.file.thumbnail_storage
+
+        def fail(*args, **kwargs):
+            raise AssertionError('storage used')
+        storage.exists = storage.url = fail
+        try:
+            self.assertEqual(image.icons, icons)
+        finally:
+            del storage.exists, storage.url
+        # moving the file deletes the thumbnails and forgets them
+        image.is_public = not image.is_public
+        image.save()
+        thumb_name = image.file.get_thumbnail(
+            {'size': (32, 32), 'crop': True, 'upscale': True}).name
+        self.assertTrue(image.file.thumbnail_storage.exists(thumb_name))
+
+    def test_thumbnail_manifest_is_invalidated_for_all_processes(self):
+        from filer.utils.filer_easy_thumbnails import ThumbnailManifest
+        storage = Image._meta.get_field('file').storages['public']
+        options = {'size': (32, 32)}
+        # two processes sharing the cache
+        manifest, other = ThumbnailManifest(), ThumbnailManifest()
+        # the entries kept in memory are checked in the shared cache again
+        #   after memory_ttl seconds
+        other.memory_ttl = 0
+        manifest.set(storage, 'a.jpg', options, 'a.jpg__32x32.jpg', 'u')
+        self.assertEqual(other.get(storage, 'a.jpg', options),
+                         ('a.jpg__32x32.jpg', 'u'))
+        manifest.invalidate(storage, 'a.jpg')
+        self.assertIsNone(other.get(storage, 'a.jpg', options))
+        with SettingsOverride(filer_settings,
+                              FILER_THUMBNAIL_MANIFEST_CACHE=None):
+            self.assertFalse(manifest.enabled)
+
+    def test_image_info_is_read_from_the_file_content(self):
+        import io
+        from PIL import Image as PILImage
+        exif = PILImage.Exif()
+        exif[274] = 6  # Orientation
+        exif[36867] = '2014:03:15 10:20:30'  # DateTimeOriginal
+        content = io.BytesIO()
+        create_image(size=(80, 60)).save(content, 'JPEG', exif=exif.tobytes())
+        # in memory content, there is no local path to read from
+        image = Image.objects.create(
+            owner=self.superuser, original_filename='exif.jpg',
+            file=dj_files.base.ContentFile(content.getvalue(),
+                                           name='exif.jpg'))
+        self.assertEqual((image.width, image.height), (80, 60))
+        self.assertEqual(image.image_info.orientation, 6)
+        self.assertEqual(image.exif['Orientation'], 6)
+        self.assertEqual(image.date_taken.replace(tzinfo=None),
+                         datetime.datetime(2014, 3, 15, 10, 20, 30))
+        # the EXIF data is stored, reading it doesn't open the file
+        image = Image.objects.get(pk=image.pk)
+        image.file.storage.delete(image.file.name)
+        self.assertEqual(image.exif['DateTimeOriginal'],
+                         '2014:03:15 10:20:30')
+
+    def test_backfill_image_exif(self):
+        from io import StringIO
+        from django.core.management import call_command
+        image = Image.objects.create(
+            owner=self.superuser, original_filename=self.image_name,
+            file=DjangoFile(open(self.filename, 'rb'), name=self.image_name))
+        broken = Image.objects.create(
+            owner=self.superuser, original_filename='broken.jpg',
+            file=dj_files.base.ContentFile(b'not an image', name='broken.jpg'))
+        # images that can't be read don't get (empty) EXIF data stored
+        self.assertEqual(Image.objects.get(pk=broken.pk)._exif_data, None)
+        self.assertEqual(Image.objects.get(pk=broken.pk).exif, {})
+        self.assertEqual(Image.objects.get(pk=broken.pk)._exif_data, None)
+        Image.objects.update(_exif_data=None)
+        stdout = StringIO()
+        call_command('backfill_image_exif', stdout=stdout)
+        self.assertIn("1 images could not be read.", stdout.getvalue())
+        self.assertEqual(Image.objects.get(pk=image.pk)._exif_data, '{}')
+        self.assertEqual(Image.objects.get(pk=broken.pk)._exif_data, None)
+
     def test_file_upload_public_destination(self):
         """
         Test where an image `is_public` == True is uploaded.
@@ -139,6 +261,53 @@ class FilerApiTests(TestCase):
         image.save()
         self.assertTrue(image.file.path.startswith(filer_settings.FILER_PUBLICMEDIA_STORAGE.location))
 
+    def test_sha1_is_generated_in_chunks(self):
+        image = self.create_filer_image()
+        with open(self.filename, 'rb') as f:
+            expected_sha1 = hashlib.sha1(f.read()).hexdigest()
+        self.assertEqual(image.sha1, expected_sha1)
+        self.assertEqual(sha1_for_file(image.file, chunk_size=7),
+                         expected_sha1)
+
+    def test_metadata_change_does_not_recompute_size_and_sha1(self):
+        image = self.create_filer_image()
+        image = Image.objects.get(pk=image.pk)
+        sha1, size = image.sha1, image.size
+        original_generate_sha1 = Image.generate_sha1
+
+        def fail_generate_sha1(instance):
+            raise AssertionError('sha1 recomputed for unchanged content')
+        Image.generate_sha1 = fail_generate_sha1
+        try:
+            image.title = 'new title'
+            image.restricted = True
+            image.save()
+        finally:
+            Image.generate_sha1 = original_generate_sha1
+        image = Image.objects.get(pk=image.pk)
+        self.assertEqual(image.title, 'new title')
+        self.assertEqual((image.sha1, image.size), (sha1, size))
+
+    def test_new_content_recomputes_size_and_sha1(self):
+        image = self.create_filer_image()
+        image = Image.objects.get(pk=image.pk)
+        self.assertFalse(image.file.content_changed)
+        other_image = create_image(size=(100, 100))
+        other_path = os.path.join(os.path.dirname(__file__), 'other.jpg')
+        other_image.save(other_path, 'JPEG')
+        try:
+            image.file = DjangoFile(open(other_path, 'rb'), name='other.jpg')
+            self.assertTrue(image.file.content_changed)
+            image.save()
+            with open(other_path, 'rb') as f:
+                expected_sha1 = hashlib.sha1(f.read()).hexdigest()
+        finally:
+            os.remove(other_path)
+        self.assertEqual(image.sha1, expected_sha1)
+        self.assertEqual(image.size, os.path.getsize(image.file.path))
+        self.assertEqual((image.width, image.height), (100, 100))
+        self.assertFalse(image.file.content_changed)
+
     def test_folder_rename_updates_file_urls(self):
         with SettingsOverride(filer_settings,
                               FILER_PUBLICMEDIA_UPLOAD_TO=by_path,
@@ -155,6 +324,139 @@ class FilerApiTests(TestCase):
             afile = File.objects.get(pk=afile.pk)
             self.assertIn('bar/{}'.format(afile.actual_name), afile.url)
 
+    def test_file_rename_keeps_existing_storage_files(self):
+        with SettingsOverride(filer_settings,
+                              FILER_PUBLICMEDIA_UPLOAD_TO=by_path,
+                              FOLDER_AFFECTS_URL=True):
+            folder = Folder.objects.create(name='foo')
+            afile = File.objects.create(
+                name='testfile.txt', folder=folder,
+                file=dj_files.base.ContentFile(b'data', name='testfile.txt'))
+            afile.name = 'renamed.txt'
+            taken = afile.file.field.upload_to(afile, afile.actual_name)
+            storage = afile.file.storage
+            storage.save(taken, dj_files.base.ContentFile(b'other'))
+            afile.save()
+            afile = File.objects.get(pk=afile.pk)
+            self.assertNotEqual(afile.file.name, taken)
+            self.assertTrue(storage.exists(afile.file.name))
+            self.assertEqual(storage.open(taken).read(), b'other')
+            storage.delete(taken)
+
+    def test_folder_move_relocates_all_subtree_files(self):
+        with SettingsOverride(filer_settings,
+                              FILER_PUBLICMEDIA_UPLOAD_TO=by_path,
+                              FOLDER_AFFECTS_URL=True):
+            foo = Folder.objects.create(name='foo')
+            bar = Folder.objects.create(name='bar', parent=foo)
+            baz = Folder.objects.create(name='baz')
+            files = []
+            for folder in (foo, bar):
+                afile = File(name='testfile.jpg', folder=folder,
+                             file=DjangoFile(open(self.filename, 'rb')))
+                afile.save()
+                files.append(afile)
+            old_locations = [afile.file.name for afile in files]
+            foo = Folder.objects.get(pk=foo.pk)
+            foo.parent = baz
+            foo.save()
+            self.assertEqual(FileRelocation.objects.count(), 0)
+            storage = filer_settings.FILER_PUBLICMEDIA_STORAGE
+            for afile, old_location in zip(files, old_locations):
+                afile = File.objects.get(pk=afile.pk)
+                self.assertEqual(afile.file.name, os.path.join(
+                    *([f.name for f in afile.logical_path] +
+                      [afile.actual_name])))
+                self.assertTrue(afile.file.name.startswith('baz/foo/'))
+                self.assertTrue(storage.exists(afile.file.name))
+                self.assertFalse(storage.exists(old_location))
+
+    def test_server_side_copy_does_not_overwrite(self):
+        import shutil
+        from django.core.files.storage import FileSystemStorage
+        from filer.utils.storage_transfer import server_side_copy
+
+        class CopyingStorage(FileSystemStorage):
+            def copy(self, src_name, dst_name):
+                shutil.copyfile(self.path(src_name), self.path(dst_name))
+        storage = CopyingStorage(location=tempfile.mkdtemp())
+        try:
+            storage.save('src.txt', dj_files.base.ContentFile(b'src'))
+            storage.save('dst.txt', dj_files.base.ContentFile(b'dst'))
+            copy_name = server_side_copy(storage, 'src.txt',
+                                         storage, 'dst.txt')
+            self.assertNotEqual(copy_name, 'dst.txt')
+            self.assertEqual(storage.open(copy_name).read(), b'src')
+            self.assertEqual(storage.open('dst.txt').read(), b'dst')
+        finally:
+            shutil.rmtree(storage.location)
+
+    def test_interrupted_folder_rename_is_resumed(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from filer.utils import storage_transfer
+        with SettingsOverride(filer_settings,
+                              FILER_PUBLICMEDIA_UPLOAD_TO=by_path,
+                              FOLDER_AFFECTS_URL=True):
+            folder = Folder.objects.create(name='foo')
+            afile = File(name='testfile.jpg', folder=folder,
+                         file=DjangoFile(open(self.filename, 'rb')))
+            afile.save()
+            old_location = afile.file.name
+
+            def fail_copy(*args):
+                raise RuntimeError('storage is down')
+            original_copy_file = storage_transfer.copy_file
+            storage_transfer.copy_file = fail_copy
+            try:
+                folder.name = 'bar'
+                self.assertRaises(RuntimeError, folder.save)
+            finally:
+                storage_transfer.copy_file = original_copy_file
+            # folder change is kept and the file is still usable
+            self.assertEqual(Folder.objects.get(pk=folder.pk).name, 'bar')
+            afile = File.objects.get(pk=afile.pk)
+            self.assertEqual(afile.file.name, old_location)
+            self.assertTrue(afile.file.storage.exists(old_location))
+            self.assertEqual(FileRelocation.objects.filter(
+                file=afile, status=FileRelocation.PENDING).count(), 1)
+
+            call_command('resume_file_relocations', stdout=StringIO())
+            self.assertEqual(FileRelocation.objects.count(), 0)
+            afile = File.objects.get(pk=afile.pk)
+            self.assertTrue(afile.file.name.startswith('bar/'))
+            self.assertTrue(afile.file.storage.exists(afile.file.name))
+            self.assertFalse(afile.file.storage.exists(old_location))
+
+    def test_interrupted_folder_rename_is_finished_before_delete(self):
+        from filer.utils import storage_transfer
+        with SettingsOverride(filer_settings,
+                              FILER_PUBLICMEDIA_UPLOAD_TO=by_path,
+                              FOLDER_AFFECTS_URL=True):
+            folder = Folder.objects.create(name='foo')
+            afile = File(name='testfile.jpg', folder=folder,
+                         file=DjangoFile(open(self.filename, 'rb')))
+            afile.save()
+
+            def fail_copy(*args):
+                raise RuntimeError('storage is down')
+            original_copy_file = storage_transfer.copy_file
+            storage_transfer.copy_file = fail_copy
+            try:
+                folder.name = 'bar'
+                self.assertRaises(RuntimeError, folder.save)
+            finally:
+                storage_transfer.copy_file = original_copy_file
+            Folder.objects.get(pk=folder.pk).delete()
+            self.assertEqual(FileRelocation.objects.count(), 0)
+            trashed = File.trash.get(pk=afile.pk)
+            self.assertTrue(trashed.file.name.startswith('_trash/'))
+            self.assertTrue(trashed.file.storage.exists(trashed.file.name))
+            # no copy is left at the renamed location
+            storage = trashed.file.storage
+            self.assertFalse(storage.exists('bar') and
+                             storage.listdir('bar')[1])
+
     def test_file_change_upload_to_destination(self):
         """
         Test that the file is actualy move from the private to the public
@@ -350,6 +652,35 @@ class ArchiveTest(TestCase):
             subfolder.delete()
         self.assertEqual(Archive.objects.get().collisions(), [])
 
+    def test_collisions_of_nested_entries(self):
+        import io
+        foo = Folder.objects.create(name='foo')
+        bar = Folder.objects.create(name='bar', parent=foo)
+        baz = Folder.objects.create(name='baz', parent=bar)
+        File.objects.create(
+            original_filename='x.txt', folder=baz,
+            file=dj_files.base.ContentFile(b'x', name='x.txt'))
+        zip_content = io.BytesIO()
+        zippy = zipfile.ZipFile(zip_content, 'w')
+        zippy.writestr('bar/', b'')
+        zippy.writestr('bar/baz/x.txt', b'new x')
+        zippy.writestr('bar/baz/y.txt', b'y')
+        zippy.writestr('new.txt', b'new')
+        zippy.close()
+        archive = Archive.objects.create(
+            original_filename='nested.zip', folder=foo,
+            file=dj_files.base.ContentFile(zip_content.getvalue(),
+                                           name='nested.zip'))
+        archive = Archive.objects.get(pk=archive.pk)
+        # load the destination folder
+        archive.folder
+        with SettingsOverride(filer_settings,
+                              FILER_NOHASH_ROOTFOLDERS=['foo']):
+            # one query for the folders and one for the files
+            with self.assertNumQueries(2):
+                collisions = archive.collisions()
+        self.assertEqual(collisions, ['/foo/bar', '/foo/bar/baz/x.txt'])
+
     def test_entries_count(self):
         files = File.objects.filter(~Q(original_filename=self.zipname))
         tmp_basedir, _ = os.path.split(self.root)
@@ -376,6 +707,98 @@ class ArchiveTest(TestCase):
             filer_path = os.sep + os.sep.join(fields)
             self.assertEqual(filer_path, entry)
 
+    def test_extract_images_and_nested_folders(self):
+        import io
+        image_content = io.BytesIO()
+        create_image(size=(40, 30)).save(image_content, 'JPEG')
+        zip_content = io.BytesIO()
+        zippy = zipfile.ZipFile(zip_content, 'w')
+        zippy.writestr('a/b/image.jpg', image_content.getvalue())
+        zippy.writestr('a/b/broken.jpg', b'not an image')
+        zippy.writestr('a/c/notes.txt', b'some notes')
+        zippy.close()
+        archive = Archive.objects.create(
+            original_filename='images.zip',
+            file=dj_files.base.ContentFile(zip_content.getvalue(),
+                                           name='images.zip'))
+        archive.extract()
+        self.assertEqual(archive.extract_errors,
+                         ['broken.jpg is not a valid image.'])
+        a = Folder.objects.get(name='a', parent=None)
+        b = Folder.objects.get(name='b', parent=a)
+        self.assertTrue(Folder.objects.filter(name='c', parent=a).exists())
+        image = Image.objects.get(folder=b)
+        self.assertEqual((image.width, image.height), (40, 30))
+        self.assertEqual(image.size, len(image_content.getvalue()))
+        self.assertEqual(image.sha1, hashlib.sha1(
+            image_content.getvalue()).hexdigest())
+        notes = File.objects.get(original_filename='notes.txt')
+        self.assertEqual(notes.file.read(), b'some notes')
+        # extracting again updates the existing files
+        Archive.objects.get(pk=archive.pk).extract()
+        self.assertEqual(Image.objects.filter(folder=b).count(), 1)
+        self.assertEqual(Folder.objects.filter(name='a').count(), 1)
+
+    def test_extraction_updates_the_counters_once_per_folder(self):
+        import io
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        zip_content = io.BytesIO()
+        zippy = zipfile.ZipFile(zip_content, 'w')
+        for index in range(5):
+            zippy.writestr('x/%s.txt' % index, b'data')
+        zippy.close()
+        root = Folder.objects.create(name='root')
+        archive = Archive.objects.create(
+            original_filename='texts.zip', folder=root,
+            file=dj_files.base.ContentFile(zip_content.getvalue(),
+                                           name='texts.zip'))
+        with CaptureQueriesContext(connection) as queries:
+            archive.extract()
+        subtree_updates = [
+            query for query in queries.captured_queries
+            if 'SET "subtree_file_count"' in query['sql']]
+        self.assertEqual(len(subtree_updates), 1)
+        x = Folder.objects.get(name='x', parent=root)
+        self.assertEqual(x.direct_file_count, 5)
+        root = Folder.objects.get(pk=root.pk)
+        self.assertEqual((root.subtree_file_count, root.subtree_size),
+                         (6, archive.size + 5 * len(b'data')))
+        self.assertEqual(File.objects.filter(
+            original_filename='3.txt', folder=x).count(), 1)
+
+    def test_extracted_image_thumbnails_are_queued_after_commit(self):
+        import io
+        from django.db import connection
+        from filer.utils import thumbnails
+        image_content = io.BytesIO()
+        create_image(size=(40, 30)).save(image_content, 'JPEG')
+        zip_content = io.BytesIO()
+        zippy = zipfile.ZipFile(zip_content, 'w')
+        zippy.writestr('image.jpg', image_content.getvalue())
+        zippy.close()
+        archive = Archive.objects.create(
+            original_filename='image.zip',
+            file=dj_files.base.ContentFile(zip_content.getvalue(),
+                                           name='image.zip'))
+        # the test transaction's savepoints
+        savepoints = len(connection.savepoint_ids)
+        queued = []
+
+        def queue_only(image_id, thumbs):
+            queued.append((image_id, len(connection.savepoint_ids)))
+            return False
+        thumbnails.get_thumbnail_executor._cache = queue_only
+        try:
+            archive.extract()
+            image = Image.objects.get(original_filename='image.jpg')
+            self.assertEqual(queued, [(image.pk, savepoints)])
+            # the updated images are queued after the commit as well
+            Archive.objects.get(pk=archive.pk).extract()
+            self.assertEqual(queued[1:], [(image.pk, savepoints)])
+        finally:
+            del thumbnails.get_thumbnail_executor._cache
+
     def tearDown(self):
         os.remove('test.zip')
         for f in File.all_objects.all():
@@ -532,6 +955,35 @@ class TrashableModelTestCase(TestCase):
         self.assertEqual(File.trash.get(pk=file_foo_pk).file.name,
                          '_trash/%s/foo/%s' % (file_foo_pk, file_foo.actual_name))
 
+    def test_folder_files_are_moved_to_trash_afterwards(self):
+        from filer.utils import trash
+        queued = []
+        trash.get_trash_move_executor._cache = queued.append
+        try:
+            foo = Folder.objects.create(name='foo')
+            bar = Folder.objects.create(name='bar', parent=foo)
+            images = [self.create_filer_image('image%s.jpg' % i, folder=bar)
+                      for i in range(3)]
+            alive_names = [image.file.name for image in images]
+            Folder.objects.get(pk=foo.pk).delete()
+        finally:
+            del trash.get_trash_move_executor._cache
+        self.assertEqual(queued, [foo.pk])
+        self.assertEqual(File.trash.filter(folder=bar).count(), 3)
+        self.assertEqual(Folder.all_objects.get(pk=foo.pk).subtree_file_count,
+                         0)
+        # the files still point to their alive locations
+        self.assertEqual(sorted(File.trash.values_list('file', flat=True)),
+                         sorted(alive_names))
+        self.assertEqual(trash.move_files_to_trash(foo.pk), 3)
+        storage = images[0].file.storage
+        for image, alive_name in zip(images, alive_names):
+            trashed = File.trash.get(pk=image.pk)
+            self.assertEqual(trashed.file.name, '_trash/%s/foo/bar/%s' % (
+                image.pk, trashed.actual_name))
+            self.assertTrue(storage.exists(trashed.file.name))
+            self.assertFalse(storage.exists(alive_name))
+
     def test_restore_clipboard_file_missing_user(self):
         from filer.models.tools import get_user_clipboard, delete_clipboard
         user = create_superuser()
@@ -757,6 +1209,150 @@ class TrashableModelTestCase(TestCase):
         self.assertEqual(File.objects.get(id=new_bar_img.id).file.name,
                          'foo/bar_1/{}'.format(new_bar_img.actual_name))
 
+    def test_folder_restore_renames_and_counts_in_bulk(self):
+        root = Folder.objects.create(name='root')
+        foo = Folder.objects.create(name='foo', parent=root)
+        bar = Folder.objects.create(name='bar', parent=foo)
+        first = File.objects.create(
+            original_filename='file.txt', folder=bar,
+            file=dj_files.base.ContentFile(b'some data', name='file.txt'))
+        first.delete()
+        File.objects.create(
+            original_filename='file.txt', folder=bar,
+            file=dj_files.base.ContentFile(b'data', name='file.txt'))
+        foo.delete()
+        self.assertEqual(self._counters(root), (0, 0, 0, 0))
+        Folder.trash.get(pk=foo.pk).restore()
+        self.assertEqual(self._counters(root), (0, 1, 2, 13))
+        self.assertEqual(self._counters(foo), (0, 1, 2, 13))
+        self.assertEqual(self._counters(bar), (2, 0, 2, 13))
+        restored = File.objects.filter(folder=bar).order_by('pk')
+        self.assertEqual([filer_file.original_filename
+                          for filer_file in restored],
+                         ['file.txt', 'file_1.txt'])
+        for filer_file in restored:
+            self.assertEqual(filer_file.file.name,
+                             'root/foo/bar/%s' % filer_file.actual_name)
+            self.assertTrue(
+                filer_file.file.storage.exists(filer_file.file.name))
+        self.assertFalse(FileRelocation.objects.exists())
+
+    def _counters(self, folder):
+        return Folder.all_objects.filter(pk=folder.pk).values_list(
+            *Folder.COUNTER_FIELDS)[0]
+
+    def test_folder_counters_follow_changes(self):
+        foo = Folder.objects.create(name='foo')
+        bar = Folder.objects.create(name='bar', parent=foo)
+        baz = Folder.objects.create(name='baz')
+        afile = File.objects.create(
+            original_filename='file.txt', folder=bar,
+            file=dj_files.base.ContentFile(b'some data', name='file.txt'))
+        self.assertEqual(self._counters(foo), (0, 1, 1, 9))
+        self.assertEqual(self._counters(bar), (1, 0, 1, 9))
+        afile.folder = foo
+        afile.save()
+        self.assertEqual(self._counters(foo), (1, 1, 1, 9))
+        self.assertEqual(self._counters(bar), (0, 0, 0, 0))
+        afile.delete()
+        self.assertEqual(self._counters(foo), (0, 1, 0, 0))
+        File.trash.get(pk=afile.pk).restore()
+        self.assertEqual(self._counters(foo), (1, 1, 1, 9))
+        File.objects.create(
+            original_filename='other.txt', folder=bar,
+            file=dj_files.base.ContentFile(b'data', name='other.txt'))
+        bar = Folder.objects.get(pk=bar.pk)
+        bar.parent = baz
+        bar.save()
+        self.assertEqual(self._counters(foo), (1, 0, 1, 9))
+        self.assertEqual(self._counters(baz), (0, 1, 1, 4))
+        bar.delete()
+        self.assertEqual(self._counters(baz), (0, 0, 0, 0))
+
+    def test_rebuild_folder_counters(self):
+        foo = Folder.objects.create(name='foo')
+        bar = Folder.objects.create(name='bar', parent=foo)
+        for folder in (foo, bar, bar):
+            File.objects.create(
+                original_filename='file.txt', folder=folder,
+                file=dj_files.base.ContentFile(b'some data', name='file.txt'))
+        expected = [self._counters(folder) for folder in (foo, bar)]
+        Folder.objects.update(direct_file_count=0, direct_children_count=0,
+                              subtree_file_count=0, subtree_size=0)
+        self.assertEqual(Folder.all_objects.rebuild_counters(), 2)
+        self.assertEqual(expected, [(1, 1, 3, 27), (2, 0, 2, 18)])
+        self.assertEqual(
+            [self._counters(folder) for folder in (foo, bar)], expected)
+
+    def _paths(self, *folders):
+        saved = [Folder.all_objects.get(pk=folder.pk) for folder in folders]
+        for folder in saved:
+            self.assertEqual(folder.path_hash, get_path_hash(folder.path))
+        return [folder.path for folder in saved]
+
+    def test_folder_paths_follow_renames_and_moves(self):
+        foo = Folder.objects.create(name='foo')
+        bar = Folder.objects.create(name='bar', parent=foo)
+        baz = Folder.objects.create(name='baz', parent=bar)
+        other = Folder.objects.create(name='other')
+        self.assertEqual(self._paths(foo, bar, baz),
+                         ['/foo', '/foo/bar', '/foo/bar/baz'])
+        foo.name = 'renamed'
+        foo.save()
+        self.assertEqual(self._paths(foo, bar, baz),
+                         ['/renamed', '/renamed/bar', '/renamed/bar/baz'])
+        bar = Folder.objects.get(pk=bar.pk)
+        bar.parent = other
+        bar.save()
+        self.assertEqual(self._paths(foo, bar, baz, other),
+                         ['/renamed', '/other/bar', '/other/bar/baz', '/other'])
+        file_obj = File.objects.create(
+            original_filename='file.txt',
+            folder=Folder.objects.get(pk=baz.pk),
+            file=dj_files.base.ContentFile(b'some data', name='file.txt'))
+        file_obj = File.objects.select_related('folder').get(pk=file_obj.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(file_obj.pretty_logical_path,
+                             '/other/bar/baz/%s' % file_obj.actual_name)
+
+    def test_rebuild_folder_paths(self):
+        foo = Folder.objects.create(name='foo')
+        bar = Folder.objects.create(name='bar', parent=foo)
+        Folder.objects.update(path='', path_hash='')
+        self.assertEqual(Folder.all_objects.rebuild_paths(), 2)
+        self.assertEqual(self._paths(foo, bar), ['/foo', '/foo/bar'])
+
+    def _visible_sites(self, *folders):
+        return [set(folder.visible_sites.values_list('site', flat=True))
+                for folder in folders]
+
+    def test_visible_sites_follow_site_changes(self):
+        site = Site.objects.get(pk=1)
+        other = Site.objects.create(domain='other.example.com', name='other')
+        shared = Site.objects.create(domain='shared.example.com',
+                                     name='shared')
+        foo = Folder.objects.create(name='foo', site=site)
+        bar = Folder.objects.create(name='bar', parent=foo)
+        self.assertEqual(self._visible_sites(foo, bar),
+                         [{site.pk}, {site.pk}])
+        foo.shared.add(shared)
+        self.assertEqual(self._visible_sites(foo, bar),
+                         [{site.pk, shared.pk}, {site.pk, shared.pk}])
+        foo = Folder.objects.get(pk=foo.pk)
+        foo.site = other
+        foo.save()
+        baz = Folder.objects.create(
+            name='baz', parent=Folder.objects.get(pk=bar.pk))
+        self.assertEqual(self._visible_sites(foo, bar, baz),
+                         [{other.pk, shared.pk}] * 3)
+        foo.shared.clear()
+        self.assertEqual(self._visible_sites(foo, bar, baz),
+                         [{other.pk}] * 3)
+        FolderVisibleSite.objects.all().delete()
+        self.assertEqual(Folder.all_objects.update_visible_sites(), 3)
+        self.assertEqual(self._visible_sites(foo, bar, baz),
+                         [{other.pk}] * 3)
+
     def test_folder_save_with_trashed_subfolder(self):
         foo = Folder.objects.create(name='foo')
         foo_child = Folder.objects.create(name='foo_child', parent=foo)
@@ -908,3 +1504,248 @@ class TestFileModel(TestCase):
         self.assertEqual(file1.clean_actual_name, 'name')
         self.assertEqual(file1.actual_name, 'randomdata_name')
         self.assertEqual(file1.upload_to_name, file1.actual_name)
+
+
+class TokenSearchBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.backend = search.get_search_backend._cache = \
+            search.TokenSearchBackend()
+        self.folder = Folder.objects.create(name='Summer photos')
+        self.beach = File.objects.create(
+            original_filename='beach.jpg', description='Summer holiday',
+            folder=self.folder, file=dj_files.base.ContentFile(b'data', name='beach.jpg'))
+        self.summer = File.objects.create(
+            original_filename='summer-2015.jpg', folder=self.folder,
+            file=dj_files.base.ContentFile(b'data', name='summer-2015.jpg'))
+
+    def tearDown(self):
+        del search.get_search_backend._cache
+        for f in File.all_objects.all():
+            f.delete(to_trash=False)
+
+    def _search(self, queryset, *terms):
+        return [item.pk for item in self.backend.search(queryset, terms)]
+
+    def test_search_is_ranked(self):
+        self.assertEqual(self._search(File.objects.all(), 'SUM'),
+                         [self.summer.pk, self.beach.pk])
+        self.assertEqual(self._search(File.objects.all(), 'sum', '2015'),
+                         [self.summer.pk])
+        self.assertEqual(self._search(Folder.objects.all(), 'photo'),
+                         [self.folder.pk])
+        # words are matched by their start
+        self.assertEqual(self._search(File.objects.all(), 'ummer'), [])
+
+    def test_ranked_results_are_paginated(self):
+        chain = MultiModelQuerysetChain([
+            self.backend.search(Folder.objects.all(), ['summer']),
+            self.backend.search(File.objects.all(), ['summer'])])
+        self.assertEqual(chain.counts, [1, 2])
+        cursor = chain.get_cursor(chain[1])
+        self.assertEqual([item.pk for item in chain.after(cursor, 5)],
+                         [self.beach.pk])
+
+    def test_index_follows_changes(self):
+        self.beach.name = 'sea.jpg'
+        self.beach.save()
+        self.assertEqual(self._search(File.objects.all(), 'sea'),
+                         [self.beach.pk])
+        self.folder.name = 'Winter'
+        self.folder.save()
+        self.assertEqual(self._search(Folder.objects.all(), 'summer'), [])
+        self.assertEqual(self._search(Folder.objects.all(), 'winter'),
+                         [self.folder.pk])
+        self.summer.delete(to_trash=False)
+        self.assertEqual(self._search(File.all_objects.all(), '2015'), [])
+
+    def test_rebuild_index(self):
+        SearchToken.objects.all().delete()
+        self.assertEqual(self._search(File.objects.all(), 'beach'), [])
+        self.assertEqual(self.backend.rebuild_index(), 3)
+        self.assertEqual(self._search(File.objects.all(), 'beach'),
+                         [self.beach.pk])
+
+
+class PermissionsCacheTestCase(TestCase):
+
+    class RolesManager(object):
+
+        def __init__(self):
+            self.calls = []
+
+        def get_accessible_sites(self, user):
+            self.calls.append('get_accessible_sites')
+            return [1, 2, 3]
+
+        def get_sites_with_perm(self, user, perm):
+            self.calls.append('get_sites_with_perm')
+            return [2, 3, 4]
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.manager = cms_roles.get_roles_manager._cache = \
+            self.RolesManager()
+        self.user = User.objects.create_user('staff', 'staff@x.com', 'x')
+
+    def tearDown(self):
+        del cms_roles.get_roles_manager._cache
+
+    def _fresh_user(self):
+        # a new request gets a new user object
+        return self.user.__class__.objects.get(pk=self.user.pk)
+
+    def test_restriction_sites_are_fetched_in_one_call(self):
+        user = self._fresh_user()
+        self.assertEqual(cms_roles.get_sites_without_restriction_perm(user),
+                         [1])
+        self.assertTrue(cms_roles.can_restrict_on_site(user, 2))
+        self.assertFalse(cms_roles.can_restrict_on_site(user, 1))
+        self.assertEqual(self.manager.calls,
+                         ['get_accessible_sites', 'get_sites_with_perm'])
+        # not cached between requests by default
+        cms_roles.get_sites_for_user(self._fresh_user())
+        self.assertEqual(len(self.manager.calls), 3)
+
+    def test_permissions_are_cached_until_invalidated(self):
+        with SettingsOverride(filer_settings,
+                              FILER_PERMISSIONS_CACHE_TIMEOUT=60):
+            cms_roles.get_restriction_sites_for_user(self._fresh_user())
+            self.assertEqual(
+                cms_roles.get_restriction_sites_for_user(self._fresh_user()),
+                set([2, 3]))
+            self.assertEqual(len(self.manager.calls), 2)
+
+            from django.contrib.auth.models import Group
+            self.user.groups.add(Group.objects.create(name='editors'))
+            cms_roles.get_sites_for_user(self._fresh_user())
+            self.assertEqual(len(self.manager.calls), 3)
+
+            cms_roles.invalidate_permissions()
+            cms_roles.get_sites_for_user(self._fresh_user())
+            self.assertEqual(len(self.manager.calls), 4)
+
+    def test_superuser_changes_invalidate_cached_sites(self):
+        with SettingsOverride(filer_settings,
+                              FILER_PERMISSIONS_CACHE_TIMEOUT=60):
+            self.user.is_superuser = True
+            self.user.save()
+            all_sites = set(Site.objects.values_list('id', flat=True))
+            self.assertEqual(
+                cms_roles.get_sites_for_user(self._fresh_user()), all_sites)
+            new_site = Site.objects.create(domain='new.com', name='new')
+            self.assertEqual(
+                cms_roles.get_sites_for_user(self._fresh_user()),
+                all_sites | set([new_site.pk]))
+            # demoted users get their roles' sites only
+            self.user.is_superuser = False
+            self.user.save()
+            self.assertEqual(
+                cms_roles.get_sites_for_user(self._fresh_user()), [1, 2, 3])
+
+
+class FileAuditTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = Folder.objects.create(name='audit')
+        self.files = [
+            File.objects.create(
+                original_filename='%s.txt' % i, folder=self.folder,
+                file=dj_files.base.ContentFile(b'data', name='%s.txt' % i))
+            for i in range(3)]
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'audit.json')
+
+    def tearDown(self):
+        for f in File.all_objects.all():
+            f.delete(to_trash=False)
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        os.rmdir(os.path.dirname(self.checkpoint))
+
+    def _audit(self, output, **kwargs):
+        from filer.utils.status import FileAudit
+        return FileAudit(output, checkpoint=self.checkpoint, batch_size=2,
+                         check_urls=False, **kwargs).run()
+
+    def test_missing_files_are_streamed(self):
+        import io
+        import json
+        missing = self.files[1]
+        missing.file.storage.delete(missing.file.name)
+        output = io.StringIO()
+        stats = self._audit(output)
+        self.assertEqual(stats.index, 3)
+        self.assertEqual(stats.public['missing'], 1)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(
+            [row['id'] for row in rows if 'missing' in row['problems']],
+            [missing.pk])
+
+    def test_audit_resumes_from_checkpoint(self):
+        import io
+        import json
+        output = io.StringIO()
+        self._audit(output)
+        with open(self.checkpoint) as checkpoint:
+            self.assertEqual(json.load(checkpoint)['last_pk'],
+                             self.files[-1].pk)
+        # only the files added since the checkpoint are checked
+        File.objects.create(
+            original_filename='new.txt', folder=self.folder,
+            file=dj_files.base.ContentFile(b'data', name='new.txt'))
+        stats = self._audit(output)
+        self.assertEqual(stats.index, 4)
+        self.assertEqual(stats.public['total'] + stats.private['total'], 4)
+
+
+class TreeCheckerTestCase(TestCase):
+
+    def setUp(self):
+        self.root = Folder.objects.create(name='root')
+        create_folder_structure(depth=3, sibling=2, parent=self.root)
+        Folder.objects.create(name='other root')
+
+    def _tree_values(self):
+        return list(Folder.objects.order_by('pk').values_list(
+            'pk', 'lft', 'rght', 'level', 'tree_id'))
+
+    def test_check_uses_one_query(self):
+        from filer.utils.checktrees import TreeChecker
+        checker = TreeChecker()
+        with self.assertNumQueries(1):
+            checker.check_corruptions()
+        self.assertEqual(checker.corrupted_folders, {})
+
+    def test_rebuild_writes_only_corrupted_values(self):
+        from filer.utils.checktrees import TreeChecker, TreeCorruption
+        expected = self._tree_values()
+        child = Folder.objects.filter(parent=self.root).order_by('lft')[0]
+        Folder.objects.filter(pk=child.pk).update(rght=1000, level=5)
+        checker = TreeChecker()
+        self.assertRaises(TreeCorruption, checker.find_corruptions)
+        self.assertEqual(set(checker.corrupted_folders), set([child.pk]))
+        self.assertEqual(
+            [folder.pk for folder in checker.get_corrupted_root_nodes()],
+            [self.root.pk])
+        self.assertEqual(checker._get_folder_path(child.pk),
+                         'root/%s' % child.name)
+        # one update query per corrupted field (and the savepoint queries
+        #   of the tree transaction)
+        with self.assertNumQueries(4):
+            checker.rebuild()
+        self.assertEqual(self._tree_values(), expected)
+        TreeChecker().find_corruptions()
+
+    def test_duplicated_tree_ids_are_reassigned(self):
+        from filer.utils.checktrees import TreeChecker, TreeCorruption
+        other = Folder.objects.get(name='other root')
+        Folder.objects.filter(pk=other.pk).update(tree_id=self.root.tree_id)
+        checker = TreeChecker()
+        self.assertRaises(TreeCorruption, checker.find_corruptions)
+        self.assertTrue(checker.full_rebuild)
+        # only one of the trees gets a new tree id
+        self.assertEqual(len(checker.changes), 1)
+        checker.rebuild()
+        TreeChecker().find_corruptions()
+        self.assertNotEqual(Folder.objects.get(pk=other.pk).tree_id,
+                            Folder.objects.get(pk=self.root.pk).tree_id)
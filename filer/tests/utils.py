@@ -1,12 +1,20 @@
 #-*- coding: utf-8 -*-
 from zipfile import ZipFile
 import os
+import shutil
+import tempfile
 
 from django.core.files import File as DjangoFile
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
 from django.test.testcases import TestCase
+from filer.models import File, Folder
 from filer.tests.helpers import create_image
 
+from filer.utils import storage_transfer
 from filer.utils.loader import load
+from filer.utils.multi_model_qs import (
+    MultiModelQuerysetChain, MultiModelPaginator, InvalidCursor)
 from filer.utils.zip import unzip
 
 #===============================================================================
@@ -66,3 +74,115 @@ class ZippingTestCase(TestCase):
     def test_unzipping_works(self):
         result = unzip(self.zipfilename)
         self.assertEqual(result[0][0].name, self.file.name)
+
+
+#===============================================================================
+# Testing the storage transfer layer
+#===============================================================================
+
+class StorageTransferTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_storage = FileSystemStorage(
+            location=os.path.join(self.tmp_dir, 'src'))
+        self.dst_storage = FileSystemStorage(
+            location=os.path.join(self.tmp_dir, 'dst'))
+        self.content = b'filer' * 1000
+        self.src_name = self.src_storage.save(
+            'a/file.txt', ContentFile(self.content))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _read(self, storage, name):
+        with storage.open(name, 'rb') as f:
+            return f.read()
+
+    def test_copy_between_local_storages(self):
+        saved_as = storage_transfer.copy_file(
+            self.src_storage, self.src_name, self.dst_storage, 'b/file.txt')
+        self.assertEqual(saved_as, 'b/file.txt')
+        self.assertEqual(self._read(self.dst_storage, saved_as), self.content)
+        self.assertTrue(self.src_storage.exists(self.src_name))
+
+    def test_copy_does_not_overwrite_existing_files(self):
+        saved_as = storage_transfer.copy_file(
+            self.src_storage, self.src_name, self.src_storage, self.src_name)
+        self.assertNotEqual(saved_as, self.src_name)
+        self.assertEqual(self._read(self.src_storage, saved_as), self.content)
+
+    def test_move_between_local_storages(self):
+        saved_as = storage_transfer.move_file(
+            self.src_storage, self.src_name, self.dst_storage, 'b/file.txt')
+        self.assertEqual(self._read(self.dst_storage, saved_as), self.content)
+        self.assertFalse(self.src_storage.exists(self.src_name))
+
+    def test_local_copy_and_streamed_copy(self):
+        for transfer in (storage_transfer.local_copy,
+                         storage_transfer.streamed_copy):
+            saved_as = transfer(self.src_storage, self.src_name,
+                                self.dst_storage, 'b/file.txt')
+            self.assertEqual(
+                self._read(self.dst_storage, saved_as), self.content)
+            self.dst_storage.delete(saved_as)
+
+
+class MultiModelQuerysetChainTestCase(TestCase):
+
+    def setUp(self):
+        self.folders = [Folder.objects.create(name='folder %d' % i)
+                        for i in range(3)]
+        self.files = [
+            File.objects.create(original_filename='file %d' % i,
+                                name='file %d' % (i // 2),
+                                file=ContentFile('data', name='f%d' % i))
+            for i in range(5)]
+        self.chain = MultiModelQuerysetChain([
+            Folder.objects.order_by('name'), File.objects.order_by('name')])
+
+    def tearDown(self):
+        for f in File.objects.all():
+            f.delete(to_trash=False)
+
+    def test_counts_are_computed_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.chain.counts, [3, 5])
+            self.assertEqual(len(self.chain), 8)
+            self.assertEqual(self.chain.count(), 8)
+
+    def test_slices_only_query_overlapping_querysets(self):
+        self.chain.counts
+        with self.assertNumQueries(1):
+            self.assertEqual(self.chain[0:2], self.folders[:2])
+        with self.assertNumQueries(2):
+            self.assertEqual([f.pk for f in self.chain[2:4]],
+                             [self.folders[2].pk, self.files[0].pk])
+        self.assertEqual(self.chain[7].pk, self.files[4].pk)
+
+    def test_keyset_pagination(self):
+        # files have duplicated names, pk is used as a tiebreaker
+        items = list(self.chain[0:8])
+        for index, item in enumerate(items[:-1]):
+            cursor = self.chain.get_cursor(item)
+            self.assertEqual([i.pk for i in self.chain.after(cursor, 3)],
+                             [i.pk for i in items[index + 1:index + 4]])
+
+        paginator = MultiModelPaginator(self.chain, 3)
+        first_page = paginator.page(1)
+        self.chain.counts
+        # the items before the cursor are not counted
+        with self.assertNumQueries(3):
+            page = paginator.page_after(first_page.next_cursor,
+                                        first_page.next_page_number())
+        self.assertEqual(page.number, 2)
+        self.assertEqual(page.start_index(), 4)
+        self.assertEqual([i.pk for i in page], [i.pk for i in items[3:6]])
+        self.assertTrue(page.has_next())
+        page = paginator.page_after(page.next_cursor, page.next_page_number())
+        self.assertEqual([i.pk for i in page], [i.pk for i in items[6:8]])
+        self.assertFalse(page.has_next())
+        # nothing follows the last item
+        page = paginator.page_after(self.chain.get_cursor(items[-1]), 4)
+        self.assertEqual(page.number, 3)
+        self.assertRaises(InvalidCursor, paginator.page_after, '5-1', 2)
@@ -1,4 +1,8 @@
-from django.db.models import Count
+from array import array
+
+from django.db import transaction
+
+from filer.utils.db import bulk_update_field
 
 
 class TreeCorruption(Exception):
@@ -6,96 +10,152 @@ class TreeCorruption(Exception):
 
 
 class TreeChecker(object):
+    """
+    Checks (and fixes) the mptt values of the folder trees.
+
+    The (pk, parent, lft, rght, level, tree_id) values of all the folders are
+        loaded with one query and the expected values are computed in memory,
+        the same way django-mptt's rebuild computes them. Only the wrong
+        values are written when the trees are rebuilt.
+    """
 
-    ordering = ['tree_id', 'lft', 'rght']
+    ordering = ['tree_id', 'lft', 'rght', 'pk']
+    fields = ('lft', 'rght', 'level', 'tree_id')
 
     def __init__(self, folder_manager=None):
         self.full_rebuild = False
         self.corrupted_folders = {}
         self.corruption_check_done = False
+        # {root pk: {field: {pk: expected value}}} for the wrong values
+        self.changes = {}
+        self.corrupted_roots = set()
+        self._parents = {}
         if not folder_manager:
             from filer.models.foldermodels import Folder
             self.manager = Folder._tree_manager
         else:
             self.manager = folder_manager
 
-
     def find_corruptions(self):
         self.check_corruptions()
         if (self.full_rebuild or self.corrupted_folders):
             raise TreeCorruption()
 
     def _build_diff_msg(self, expected, actual):
-        attr_idx = {'lft':0, 'rght':1, 'level':2, 'tree_id':3}
-        expected, actual = list(expected), list(actual)
         diff = []
-        for attr, idx in list(attr_idx.items()):
-            if expected[idx] != actual[idx]:
+        for attr, expected_value, actual_value in zip(
+                self.fields, expected, actual):
+            if expected_value != actual_value:
                 diff.append('wrong %s value: expected %s, actual %s' % (
-                    attr, expected[idx], actual[idx]))
+                    attr, expected_value, actual_value))
         return '; '.join(diff)
 
-    def _get_parents_names(self, folder, names):
-        names.insert(0, folder.name)
-        if folder.parent:
-            self._get_parents_names(folder.parent, names)
-
     def _get_folder_path(self, pk):
-        folder = self.manager.get(pk=pk)
-        names = []
-        self._get_parents_names(folder, names)
-        return '/'.join(names)
+        if not self._parents:
+            self._load()
+        chain = [pk]
+        while self._parents.get(chain[-1]):
+            chain.append(self._parents[chain[-1]])
+        names = dict(self.manager.filter(pk__in=chain).values_list(
+            'pk', 'name'))
+        return '/'.join(names[ancestor] for ancestor in reversed(chain))
 
     def get_corrupted_root_nodes(self):
         if not self.corruption_check_done:
             self.check_corruptions()
-        corrupted_trees = self.manager.filter(
-            pk__in=list(self.corrupted_folders.keys())).\
-            values_list('tree_id', flat=True).distinct()
-        return self.manager.filter(
-            parent__isnull=True, tree_id__in=corrupted_trees)
+        return self.manager.filter(pk__in=self.corrupted_roots).order_by(
+            *self.ordering)
 
-    def check_tree(self, pk, lft, tree_id, level=0):
+    def _load(self):
         """
-            * checks if a certain folder tree is corrupted or not.
-            * uses the same logic as django-mptt's rebuild tree
+        Returns the folder ids (in the order the trees are rebuilt), their
+            current values and their children as linked lists
+            (first child / next sibling indexes, -1 for none).
         """
-        rght = lft + 1
-        child_ids = self.manager.filter(parent__pk=pk).\
-            order_by(*self.ordering).values_list('pk', flat=True)
-
-        for child_id in child_ids:
-            rght = self.check_tree(child_id, rght, tree_id, level + 1)
-
-        folder = self.manager.get(pk=pk)
-        expected = (lft, rght, level, tree_id)
-        actual = (folder.lft, folder.rght, folder.level, folder.tree_id)
-        if expected != actual:
-            self.corrupted_folders.setdefault(
-                pk, self._build_diff_msg(expected, actual))
-        return rght + 1
+        pks, values = array('l'), array('l')
+        first_child, last_child, next_sibling = (
+            array('l'), array('l'), array('l'))
+        roots, index, parents = [], {}, {}
+        rows = self.manager.order_by(*self.ordering).values_list(
+            'pk', 'parent_id', *self.fields).iterator()
+        for row in rows:
+            index[row[0]] = len(pks)
+            pks.append(row[0])
+            values.extend(row[2:])
+            first_child.append(-1)
+            last_child.append(-1)
+            next_sibling.append(-1)
+            parents[row[0]] = row[1]
+        for idx, pk in enumerate(pks):
+            parent = parents[pk]
+            if parent is None:
+                roots.append(idx)
+                continue
+            parent_idx = index.get(parent)
+            if parent_idx is None:
+                continue
+            if first_child[parent_idx] == -1:
+                first_child[parent_idx] = idx
+            else:
+                next_sibling[last_child[parent_idx]] = idx
+            last_child[parent_idx] = idx
+        self._parents = parents
+        return pks, values, roots, first_child, next_sibling
+
+    def _check_tree(self, root, tree_id, pks, values, first_child,
+                    next_sibling):
+        """
+        Walks a tree without recursion and records the folders whose values
+            are different from the expected ones.
+        """
+        nfields = len(self.fields)
+        # stack of [node index, lft, level, next child to visit]
+        stack = [[root, 1, 0, first_child[root]]]
+        counter = 1
+        while stack:
+            node = stack[-1]
+            child = node[3]
+            if child != -1:
+                node[3] = next_sibling[child]
+                counter += 1
+                stack.append([child, counter, node[2] + 1, first_child[child]])
+                continue
+            stack.pop()
+            counter += 1
+            idx = node[0]
+            expected = (node[1], counter, node[2], tree_id)
+            actual = tuple(values[idx * nfields:(idx + 1) * nfields])
+            if expected != actual:
+                pk = pks[idx]
+                self.corrupted_folders.setdefault(
+                    pk, self._build_diff_msg(expected, actual))
+                self.corrupted_roots.add(pks[root])
+                changes = self.changes.setdefault(pks[root], {})
+                for field, expected_value, actual_value in zip(
+                        self.fields, expected, actual):
+                    if expected_value != actual_value:
+                        changes.setdefault(field, {})[pk] = expected_value
 
     def check_corruptions(self):
         """
             * checks folder tree corruptions
             * based on django-mptt's rebuild method
             * checks if there are multiple root folders with the
-        same tree id(fixing this will require a full rebuild)
+        same tree id: the trees of the roots after the first one get new
+        tree ids
         """
-        tree_duplicates = self.manager.filter(parent=None).\
-            values_list('tree_id').\
-            annotate(count=Count('id')).filter(count__gt=1)
-        if len(tree_duplicates) > 0:
-            self.full_rebuild = True
-            self.corruption_check_done = True
-            return
-
-        pks = self.manager.filter(parent=None).\
-            order_by(*self.ordering).values_list('pk', flat=True)
-        idx = 0
-        for pk in pks:
-            idx += 1
-            self.check_tree(pk, 1, self.manager.get(pk=pk).tree_id)
+        pks, values, roots, first_child, next_sibling = self._load()
+        nfields = len(self.fields)
+        used_tree_ids = set()
+        next_tree_id = max(values[nfields - 1::nfields] or [0]) + 1
+        for root in roots:
+            tree_id = values[root * nfields + 3]
+            if tree_id in used_tree_ids:
+                self.full_rebuild = True
+                tree_id, next_tree_id = next_tree_id, next_tree_id + 1
+            used_tree_ids.add(tree_id)
+            self._check_tree(root, tree_id, pks, values, first_child,
+                             next_sibling)
 
         self.corruption_check_done = True
 
@@ -103,11 +163,10 @@ class TreeChecker(object):
         if not self.corruption_check_done:
             self.check_corruptions()
 
-        if self.full_rebuild:
-            self.manager.rebuild()
-        elif self.corrupted_folders:
-            for folder in self.get_corrupted_root_nodes():
-                # since we use an older version of djang-mptt and method
-                #   partial_rebuild does not exist ...
-                self.manager._rebuild_helper(
-                    folder.pk, 1, folder.tree_id)
+        # one short transaction per tree, so that the folders table is not
+        #   locked while all the trees are fixed
+        for root_pk in sorted(self.changes):
+            with transaction.atomic(using=self.manager.db):
+                for field, values_by_pk in self.changes[root_pk].items():
+                    bulk_update_field(
+                        self.manager.all(), field, values_by_pk)
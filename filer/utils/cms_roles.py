@@ -1,12 +1,23 @@
+import uuid
 from functools import wraps
 
+from django.contrib.auth import get_user_model, models as auth_models
 from django.contrib.sites.models import Site
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models import signals
 from django.utils.module_loading import import_string
 
+from filer import settings as filer_settings
 from filer.settings import FILER_ROLES_MANAGER
 
 
+RESTRICT_PERM = 'filer.can_restrict_operations'
+
+# attributes set on the user objects by get_or_fetch
+_FETCHED_ATTRS = set()
+
+
 def get_roles_manager():
     if hasattr(get_roles_manager, '_cache'):
         return get_roles_manager._cache
@@ -22,27 +33,111 @@ def get_roles_manager():
     return manager
 
 
+def _permissions_cache():
+    return caches[filer_settings.FILER_PERMISSIONS_CACHE]
+
+
+def _version_key(user_id=None):
+    if user_id is None:
+        return 'filer-permissions-version'
+    return 'filer-permissions-version-%s' % user_id
+
+
+def _get_versions(user):
+    """
+    Returns the permissions versions (of all the users and of the given
+        user) that the cached permissions of the user are keyed by.
+    """
+    if not hasattr(user, '_permissions_versions'):
+        cache = _permissions_cache()
+        keys = [_version_key(), _version_key(user.pk)]
+        versions = cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                # a missing version (never set or evicted) gets a new value
+                #   so that entries cached before can't be used again
+                cache.add(key, uuid.uuid4().hex, None)
+                versions[key] = cache.get(key)
+        user._permissions_versions = tuple(versions[key] for key in keys)
+    return user._permissions_versions
+
+
+def _permissions_cache_key(user, name):
+    if filer_settings.FILER_PERMISSIONS_CACHE_TIMEOUT <= 0 or not user.pk:
+        return None
+    # superusers get all the sites, inactive users none
+    flags = '%d%d' % (getattr(user, 'is_superuser', False),
+                      getattr(user, 'is_active', True))
+    return 'filer-permissions:%s:%s:%s:%s:%s' % (
+        _get_versions(user) + (user.pk, flags, name))
+
+
 def get_or_fetch(fetch_func):
     """
         Helper decorator that sets the result of the decorated function on
     a user request object. It is used to minimise the number of queries done
-    per request.
+    per request. When FILER_PERMISSIONS_CACHE_TIMEOUT is set the result is
+    also kept in the django cache, for all the requests of the user, until
+    it expires or the permissions are invalidated (see
+    invalidate_permissions).
     """
+    attr_name = '_%s' % fetch_func.__name__
+    _FETCHED_ATTRS.add(attr_name)
+
     @wraps(fetch_func)
     def wrapper(user, *args, **kwargs):
-        attr_name = '_%s' % fetch_func.__name__
         if not hasattr(user, attr_name):
-            result = fetch_func(user, *args, **kwargs)
+            key = _permissions_cache_key(user, fetch_func.__name__)
+            cached = _permissions_cache().get(key) if key else None
+            if cached is not None:
+                result = cached[0]
+            else:
+                result = fetch_func(user, *args, **kwargs)
+                if key:
+                    _permissions_cache().set(
+                        key, (result, ),
+                        filer_settings.FILER_PERMISSIONS_CACHE_TIMEOUT)
             setattr(user, attr_name, result)
         return getattr(user, attr_name)
     return wrapper
 
 
+def invalidate_permissions(user=None):
+    """
+    Forgets the permissions fetched for the given user (or for all the users
+        when no user is given). Call it when the roles of the users change
+        in ways not covered by the signal handlers below.
+    """
+    if user is not None:
+        for attr_name in _FETCHED_ATTRS | set(
+                ['_can_restrict_on_site', '_permissions_versions']):
+            user.__dict__.pop(attr_name, None)
+    if filer_settings.FILER_PERMISSIONS_CACHE_TIMEOUT > 0:
+        _permissions_cache().set(
+            _version_key(getattr(user, 'pk', None)), uuid.uuid4().hex, None)
+
+
 @get_or_fetch
 def has_admin_role(user):
     return get_roles_manager().is_site_admin(user)
 
 
+@get_or_fetch
+def get_restriction_sites_for_user(user):
+    """
+    Returns the ids of the sites, from the sites available to the user, on
+        which the user can restrict operations.
+    """
+    manager = get_roles_manager()
+    sites = get_sites_for_user(user)
+    if hasattr(manager, 'get_sites_with_perm'):
+        # one call for all the sites
+        return set(manager.get_sites_with_perm(user, RESTRICT_PERM)) & set(
+            sites)
+    return set(site_id for site_id in sites
+               if manager.has_perm_on_site(user, site_id, RESTRICT_PERM))
+
+
 def can_restrict_on_site(user, site):
     site_id = site
     if not str(site_id).isnumeric():
@@ -50,12 +145,14 @@ def can_restrict_on_site(user, site):
 
     def _fetch_perm_existance():
         manager = get_roles_manager()
-        return manager.has_perm_on_site(user, site_id, 'filer.can_restrict_operations')
+        return manager.has_perm_on_site(user, site_id, RESTRICT_PERM)
 
     if user.is_superuser or (site_id is None and has_admin_role(user)):
         return True
 
     if site_id:
+        if site_id in get_sites_for_user(user):
+            return site_id in get_restriction_sites_for_user(user)
         if not hasattr(user, '_can_restrict_on_site'):
             setattr(user, '_can_restrict_on_site', {})
         return user._can_restrict_on_site.setdefault(
@@ -66,9 +163,9 @@ def can_restrict_on_site(user, site):
 def get_sites_without_restriction_perm(user):
     if user.is_superuser:
         return []
-    return [site
-            for site in get_sites_for_user(user)
-            if can_restrict_on_site(user, site) is False]
+    restriction_sites = get_restriction_sites_for_user(user)
+    return [site for site in get_sites_for_user(user)
+            if site not in restriction_sites]
 
 
 @get_or_fetch
@@ -93,3 +190,55 @@ def get_sites_for_user(user):
     if user.is_superuser:
         return set(Site.objects.values_list('id', flat=True))
     return get_roles_manager().get_accessible_sites(user)
+
+
+def _invalidate_on_user_relations_change(instance, reverse, action, **kwargs):
+    if not action.startswith('post_'):
+        return
+    # the users of a group/permission changed when reverse
+    invalidate_permissions(None if reverse else instance)
+
+
+def _invalidate_on_group_permissions_change(action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_permissions()
+
+
+def _invalidate_on_roles_change(sender, **kwargs):
+    # roles are stored by the app of the roles manager
+    if (isinstance(FILER_ROLES_MANAGER, str) and
+            sender._meta.app_label == FILER_ROLES_MANAGER.split('.')[0]):
+        invalidate_permissions()
+
+
+def _invalidate_on_user_change(instance, **kwargs):
+    invalidate_permissions(instance)
+
+
+def _invalidate_on_site_change(**kwargs):
+    # superusers have access to all the sites
+    invalidate_permissions()
+
+
+def connect_signals():
+    """
+    Invalidates the cached permissions when the users, groups, sites or
+        roles change. Called once the apps are loaded since the user model can be
+        swapped.
+    """
+    user_model = get_user_model()
+    signals.post_save.connect(_invalidate_on_user_change, sender=user_model)
+    signals.post_delete.connect(_invalidate_on_user_change,
+                                sender=user_model)
+    for field_name in ('groups', 'user_permissions'):
+        # custom user models don't necessarily have these relations
+        relation = getattr(user_model, field_name, None)
+        if relation is not None:
+            signals.m2m_changed.connect(_invalidate_on_user_relations_change,
+                                        sender=relation.through)
+    signals.m2m_changed.connect(_invalidate_on_group_permissions_change,
+                                sender=auth_models.Group.permissions.through)
+    signals.post_save.connect(_invalidate_on_site_change, sender=Site)
+    signals.post_delete.connect(_invalidate_on_site_change, sender=Site)
+    signals.post_save.connect(_invalidate_on_roles_change)
+    signals.post_delete.connect(_invalidate_on_roles_change)
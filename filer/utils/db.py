@@ -0,0 +1,44 @@
+#-*- coding: utf-8 -*-
+"""
+Helpers for set-based database operations on large numbers of rows.
+"""
+import itertools
+
+from django.db.models import Case, Value, When
+
+from filer import settings as filer_settings
+
+
+def chunked(iterable, size=None):
+    """
+    Splits the iterable in lists of at most ``size`` (defaults to
+        ``FILER_BULK_BATCH_SIZE``) items.
+    """
+    size = size or filer_settings.FILER_BULK_BATCH_SIZE
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_update_field(queryset, field_name, values_by_pk, batch_size=None):
+    """
+    Sets a different value of the same field for many rows using one UPDATE
+        query per batch:
+
+        UPDATE ... SET field = CASE WHEN id = 1 THEN 'a' ... END
+        WHERE id IN (1, ...)
+
+    Model save methods and signals are not triggered.
+    """
+    field = queryset.model._meta.get_field(field_name)
+    updated = 0
+    for pks in chunked(values_by_pk, batch_size):
+        new_value = Case(
+            *[When(pk=pk, then=Value(values_by_pk[pk])) for pk in pks],
+            output_field=field)
+        updated += queryset.filter(pk__in=pks).update(
+            **{field_name: new_value})
+    return updated
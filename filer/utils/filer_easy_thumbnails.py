@@ -1,8 +1,16 @@
 #-*- coding: utf-8 -*-
-from easy_thumbnails.files import Thumbnailer
+from collections import OrderedDict
+from django.core.cache import caches
+from easy_thumbnails.files import Thumbnailer, ThumbnailFile
+from easy_thumbnails.models import Source, Thumbnail
+from easy_thumbnails.utils import get_storage_hash
+import hashlib
 import os
 import re
+import threading
+import time
 from filer import settings as filer_settings
+from filer.utils.storage_transfer import map_concurrently
 
 # match the source filename using `__` as the seperator. ``opts_and_ext`` is non
 # greedy so it should match the last occurence of `__`.
@@ -18,6 +26,148 @@ def thumbnail_to_original_filename(thumbnail_name):
     return None
 
 
+def delete_thumbnails_in_bulk(source_storage, thumbnail_storage, names):
+    """
+    Deletes the thumbnails (and their cache entries) of all the source files
+        with the given names. Same as ``Thumbnailer.delete_thumbnails`` but
+        with a constant number of queries.
+    """
+    source_ids = list(Source.objects.filter(
+        storage_hash=get_storage_hash(source_storage),
+        name__in=names).values_list('id', flat=True))
+    if not source_ids:
+        return 0
+    thumbnails = list(Thumbnail.objects.filter(
+        source__in=source_ids,
+        storage_hash=get_storage_hash(thumbnail_storage),
+    ).values_list('id', 'name'))
+    map_concurrently(thumbnail_storage.delete,
+                     [name for _, name in thumbnails])
+    Thumbnail.objects.filter(id__in=[pk for pk, _ in thumbnails]).delete()
+    Source.objects.filter(id__in=source_ids).delete()
+    for name in names:
+        thumbnail_manifest.invalidate(source_storage, name)
+    return len(thumbnails)
+
+
+class ThumbnailManifest(object):
+    """
+    Remembers the names and urls of the existing thumbnails of the source
+        files so that getting them doesn't need the storage (existence
+        check, url).
+
+    The entries are kept in the django cache named by
+        ``FILER_THUMBNAIL_MANIFEST_CACHE`` (the manifest is disabled without
+        it) so that they are invalidated for all the processes. The entries
+        of the last ``FILER_THUMBNAIL_MANIFEST_SIZE`` source files used are
+        also kept in memory for ``memory_ttl`` seconds.
+    """
+
+    # seconds during which an entry kept in memory is used without checking
+    #   the shared cache; it might have been invalidated by another process
+    memory_ttl = 5
+
+    def __init__(self):
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(filer_settings.FILER_THUMBNAIL_MANIFEST_SIZE and
+                    filer_settings.FILER_THUMBNAIL_MANIFEST_CACHE)
+
+    @property
+    def _cache(self):
+        alias = filer_settings.FILER_THUMBNAIL_MANIFEST_CACHE
+        return caches[alias] if alias else None
+
+    @staticmethod
+    def _get_source_key(storage, name):
+        source = '%s:%s' % (get_storage_hash(storage), name)
+        return 'filer-thumbnail-manifest-%s' % hashlib.md5(
+            source.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _get_options_key(thumbnail_options):
+        return repr(sorted(thumbnail_options.items()))
+
+    def _get_source(self, source_key):
+        with self._lock:
+            entry = self._sources.get(source_key)
+            if entry is not None and entry[0] > time.time():
+                self._sources.move_to_end(source_key)
+                return entry[1]
+        thumbnails = self._cache.get(source_key)
+        if thumbnails is None:
+            with self._lock:
+                self._sources.pop(source_key, None)
+        else:
+            self._set_source(source_key, thumbnails, shared=False)
+        return thumbnails
+
+    def _set_source(self, source_key, thumbnails, shared=True):
+        max_size = filer_settings.FILER_THUMBNAIL_MANIFEST_SIZE
+        with self._lock:
+            self._sources[source_key] = (
+                time.time() + self.memory_ttl, thumbnails)
+            self._sources.move_to_end(source_key)
+            while len(self._sources) > max_size:
+                self._sources.popitem(last=False)
+        if shared:
+            self._cache.set(source_key, thumbnails)
+
+    def get(self, storage, name, thumbnail_options):
+        """
+        Returns the (name, url) of the thumbnail or None if it's unknown.
+        """
+        if not self.enabled:
+            return None
+        thumbnails = self._get_source(self._get_source_key(storage, name))
+        if not thumbnails:
+            return None
+        return thumbnails.get(self._get_options_key(thumbnail_options))
+
+    def set(self, storage, name, thumbnail_options, thumbnail_name, url):
+        if not self.enabled:
+            return
+        source_key = self._get_source_key(storage, name)
+        thumbnails = dict(self._get_source(source_key) or {})
+        thumbnails[self._get_options_key(thumbnail_options)] = (
+            thumbnail_name, url)
+        self._set_source(source_key, thumbnails)
+
+    def invalidate(self, storage, name):
+        """
+        Forgets all the thumbnails of the given source file.
+        """
+        source_key = self._get_source_key(storage, name)
+        with self._lock:
+            self._sources.pop(source_key, None)
+        if self._cache is not None:
+            self._cache.delete(source_key)
+
+    def clear(self):
+        with self._lock:
+            self._sources.clear()
+
+
+thumbnail_manifest = ThumbnailManifest()
+
+
+class ManifestThumbnailFile(ThumbnailFile):
+    """
+    Thumbnail file whose url is known from the thumbnail manifest.
+    """
+
+    def __init__(self, name, url, storage):
+        super(ManifestThumbnailFile, self).__init__(name, storage=storage)
+        self._manifest_url = url
+
+    @property
+    def url(self):
+        return self._manifest_url
+
+
 class ThumbnailerNameMixin(object):
     thumbnail_basedir = ''
     thumbnail_subdir = ''
@@ -1,9 +1,11 @@
 #-*- coding: utf-8 -*-
+import hashlib
 import os
 from django.utils.text import get_valid_filename as get_valid_filename_django
 from django.template.defaultfilters import slugify
 from django.core.files.uploadedfile import SimpleUploadedFile
-from filer.settings import FILER_FILE_MODELS
+from django.core.files.uploadhandler import FileUploadHandler
+from filer.settings import FILER_FILE_MODELS, FILER_FILE_CHUNK_SIZE
 from filer.utils.loader import load_object
 
 
@@ -13,7 +15,59 @@ class UploadException(Exception):
     pass
 
 
+def sha1_for_file(file_obj, chunk_size=None):
+    """
+    Returns the sha1 hex digest of the file content. The content is read in
+    chunks so that big files are never fully loaded in memory.
+    """
+    sha = hashlib.sha1()
+    for chunk in file_obj.chunks(chunk_size or FILER_FILE_CHUNK_SIZE):
+        sha.update(chunk)
+    # to make sure later operations can read the whole file
+    file_obj.seek(0)
+    return sha.hexdigest()
+
+
+class Sha1UploadHandler(FileUploadHandler):
+    """
+    Computes the sha1 of the uploaded files while the request body is being
+    read. It only observes the data, the next handlers still build the
+    uploaded files.
+    """
+
+    def __init__(self, request=None):
+        super(Sha1UploadHandler, self).__init__(request)
+        self.digests = {}
+        self._sha = None
+
+    def new_file(self, *args, **kwargs):
+        super(Sha1UploadHandler, self).new_file(*args, **kwargs)
+        self._sha = hashlib.sha1()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._sha.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name] = self._sha.hexdigest()
+        return None
+
+
+def _install_sha1_upload_handler(request):
+    # handlers can only be changed before the request body is parsed
+    if hasattr(request, '_files'):
+        return None
+    handler = Sha1UploadHandler(request)
+    request.upload_handlers.insert(0, handler)
+    return handler
+
+
 def handle_upload(request):
+    """
+    Returns the uploaded file, its name and whether it was a raw upload.
+    The sha1 of the uploaded content is available as the ``sha1`` attribute
+    of the uploaded file.
+    """
     if not request.method == "POST":
         raise UploadException("AJAX request not valid: must be POST")
     if request.is_ajax():
@@ -30,7 +84,9 @@ def handle_upload(request):
         else:
             raise UploadException("Request is not valid: there is no request body.")
         upload = SimpleUploadedFile(name=filename, content=data)
+        upload.sha1 = hashlib.sha1(data).hexdigest()
     else:
+        sha1_handler = _install_sha1_upload_handler(request)
         if len(request.FILES) == 1:
             # FILES is a dictionary in Django but Ajax Upload gives the uploaded file an
             # ID based on a random number, so it cannot be guessed here in the code.
@@ -38,8 +94,10 @@ def handle_upload(request):
             # each upload is a separate request so FILES should only have one entry.
             # Thus, we can just grab the first (and only) value in the dict.
             is_raw = False
-            upload = list(request.FILES.values())[0]
+            field_name, upload = list(request.FILES.items())[0]
             filename = upload.name
+            digest = sha1_handler and sha1_handler.digests.get(field_name)
+            upload.sha1 = digest or sha1_for_file(upload)
         else:
             raise UploadException("AJAX request not valid: Bad Upload")
     return upload, filename, is_raw
@@ -0,0 +1,57 @@
+#-*- coding: utf-8 -*-
+from django.db.models import Count, Sum
+
+from filer.utils.db import bulk_update_field
+
+
+def rebuild_folder_counters(folder_model, file_model, tree_ids=None,
+                            root=None):
+    """
+    Recomputes from scratch the file/children/size counters of all the
+        folders (or only of the folders from the given trees or from the
+        subtree of the given root folder) and returns the number of folders
+        updated. The ancestors of the root folder are not updated.
+
+    Only the alive files and folders are counted. The model classes are
+        passed in so that this can also run from migrations.
+    """
+    folders = folder_model._base_manager.all()
+    if tree_ids is not None:
+        folders = folders.filter(tree_id__in=tree_ids)
+    if root is not None:
+        folders = folders.filter(
+            tree_id=root.tree_id, lft__gte=root.lft, rght__lte=root.rght)
+    files = file_model._base_manager.filter(
+        folder__in=folders, deleted_at__isnull=True).values_list(
+        'folder').annotate(count=Count('id'), size=Sum('_file_size'))
+    direct_files = dict((folder_id, (count, size or 0))
+                        for folder_id, count, size in files.order_by())
+    children = dict(folders.filter(
+        parent__isnull=False, deleted_at__isnull=True).values_list(
+        'parent').annotate(count=Count('id')).order_by())
+
+    subtree_files, subtree_size = {}, {}
+    # descendants come after their ancestors in the tree order so walking
+    #   the folders backwards adds the subtree of each folder to its parent
+    #   before the parent is added to its own parent
+    nodes = list(folders.values_list(
+        'id', 'parent_id', 'deleted_at').order_by('tree_id', 'lft'))
+    for folder_id, parent_id, deleted_at in reversed(nodes):
+        count, size = direct_files.get(folder_id, (0, 0))
+        subtree_files[folder_id] = subtree_files.get(folder_id, 0) + count
+        subtree_size[folder_id] = subtree_size.get(folder_id, 0) + size
+        if parent_id and deleted_at is None:
+            subtree_files[parent_id] = (subtree_files.get(parent_id, 0) +
+                                        subtree_files[folder_id])
+            subtree_size[parent_id] = (subtree_size.get(parent_id, 0) +
+                                       subtree_size[folder_id])
+
+    folder_ids = [node[0] for node in nodes]
+    bulk_update_field(folders, 'direct_file_count', dict(
+        (folder_id, direct_files.get(folder_id, (0, 0))[0])
+        for folder_id in folder_ids))
+    bulk_update_field(folders, 'direct_children_count', dict(
+        (folder_id, children.get(folder_id, 0)) for folder_id in folder_ids))
+    bulk_update_field(folders, 'subtree_file_count', subtree_files)
+    bulk_update_field(folders, 'subtree_size', subtree_size)
+    return len(folder_ids)
@@ -0,0 +1,44 @@
+#-*- coding: utf-8 -*-
+import hashlib
+
+from filer.utils.db import bulk_update_field
+
+
+def get_path_hash(path):
+    """
+    Returns the (fixed length) hash of a folder path; folders are looked up
+        by path through the indexed hash since the paths can be too long to
+        be indexed.
+    """
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+
+def update_path_hashes(folders):
+    """
+    Recomputes the path hashes of the given folders from their saved paths.
+    """
+    return bulk_update_field(folders, 'path_hash', dict(
+        (folder_id, get_path_hash(path))
+        for folder_id, path in folders.values_list('id', 'path')))
+
+
+def rebuild_folder_paths(folder_model, tree_ids=None):
+    """
+    Recomputes from scratch the materialized paths of all the folders (or
+        only of the folders from the given trees) and returns the number of
+        folders updated.
+
+    The model class is passed in so that this can also run from migrations.
+    """
+    folders = folder_model._base_manager.all()
+    if tree_ids is not None:
+        folders = folders.filter(tree_id__in=tree_ids)
+    paths = {}
+    # parents come before their children in the tree order
+    for folder_id, parent_id, name in folders.values_list(
+            'id', 'parent_id', 'name').order_by('tree_id', 'lft'):
+        paths[folder_id] = '%s/%s' % (paths.get(parent_id, ''), name)
+    bulk_update_field(folders, 'path', paths)
+    bulk_update_field(folders, 'path_hash', dict(
+        (folder_id, get_path_hash(path)) for folder_id, path in paths.items()))
+    return len(paths)
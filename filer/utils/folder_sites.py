@@ -0,0 +1,39 @@
+#-*- coding: utf-8 -*-
+from filer import settings as filer_settings
+from filer.utils.db import chunked
+
+
+def _visible_site_rows(folder_model, folders):
+    rows = set(folders.filter(site__isnull=False).values_list(
+        'id', 'site_id'))
+    rows.update(folder_model.shared.through.objects.filter(
+        folder__in=folders).values_list('folder_id', 'site_id'))
+    return rows
+
+
+def update_visible_sites(folder_model, visible_site_model, folder_ids=None):
+    """
+    Recomputes the sites where the given folders (or all the folders) are
+        visible: their own site and the sites they are shared with. Returns
+        the number of (folder, site) pairs stored.
+
+    The model classes are passed in so that this can also run from
+        migrations.
+    """
+    if folder_ids is None:
+        visible_site_model.objects.all().delete()
+        batches = [folder_model._base_manager.all()]
+    else:
+        batches = [folder_model._base_manager.filter(pk__in=ids)
+                   for ids in chunked(set(folder_ids))]
+    stored = 0
+    for folders in batches:
+        if folder_ids is not None:
+            visible_site_model.objects.filter(folder__in=folders).delete()
+        rows = _visible_site_rows(folder_model, folders)
+        visible_site_model.objects.bulk_create([
+            visible_site_model(folder_id=folder_id, site_id=site_id)
+            for folder_id, site_id in rows],
+            batch_size=filer_settings.FILER_BULK_BATCH_SIZE)
+        stored += len(rows)
+    return stored
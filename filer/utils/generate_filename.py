@@ -33,6 +33,8 @@ def _is_in_memory(file_):
 
 
 def _construct_logical_folder_path(filer_file):
+    if filer_file.folder is not None and filer_file.folder.path:
+        return filer_file.folder.path.lstrip('/')
     return os.path.join(*(folder.name for folder in filer_file.logical_path))
 
 
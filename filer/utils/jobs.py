@@ -0,0 +1,126 @@
+#-*- coding: utf-8 -*-
+"""
+Runs folder jobs (see filer.models.FolderJob) outside the admin request.
+
+Jobs are handed to the executor configured with ``FILER_JOB_EXECUTOR``:
+
+* ``thread_executor``: runs the jobs in a pool of ``FILER_JOB_WORKERS``
+  threads of the current process
+* ``celery_executor``: sends the jobs to the celery workers
+  (``filer.tasks.run_folder_job_task``)
+* ``immediate_executor``: runs the jobs right away, in the current thread
+
+Jobs that make no progress for ``FILER_JOB_TIMEOUT`` seconds (lost by their
+executor) are marked as failed. The ``resume_folder_jobs`` command submits
+again the jobs that were queued but never started.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib import messages
+from django.db import connections
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from filer import settings as filer_settings
+from filer.utils.loader import load_object
+
+
+logger = logging.getLogger(__name__)
+
+# number of times a worker looks for a job that is not committed yet
+JOB_LOOKUP_RETRIES = 10
+
+
+def _get_job(job_id):
+    from filer.models import FolderJob
+    for _retry in range(JOB_LOOKUP_RETRIES):
+        try:
+            return FolderJob.objects.get(pk=job_id)
+        except FolderJob.DoesNotExist:
+            # the transaction that created the job might not be committed
+            time.sleep(0.5)
+    return None
+
+
+def _get_job_handler(job):
+    # the actions are implemented by the folder admin
+    from django.contrib import admin
+    from filer.admin.folderadmin import FolderAdmin
+    from filer.models import Folder
+    model_admin = FolderAdmin(Folder, admin.site)
+    return getattr(model_admin, 'run_%s_job' % job.action)
+
+
+def run_job(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        logger.error('Folder job %s does not exist.' % job_id)
+        return
+    if not job.start():
+        # finished or already run by another worker
+        return
+    try:
+        _get_job_handler(job)(job)
+    except Exception as e:
+        logger.exception('Folder job %s failed.' % job_id)
+        job.add_message(_("%(action)s failed: %(error)s") % {
+            'action': job.get_action_display(), 'error': e},
+            level=messages.ERROR)
+        job.finish(failed=True)
+    else:
+        job.finish()
+
+
+def immediate_executor(job):
+    run_job(job.pk)
+
+
+def _run_job_in_thread(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        # threads get their own database connections
+        connections.close_all()
+
+
+def thread_executor(job):
+    if not hasattr(thread_executor, '_pool'):
+        thread_executor._pool = ThreadPoolExecutor(
+            max_workers=filer_settings.FILER_JOB_WORKERS)
+    thread_executor._pool.submit(_run_job_in_thread, job.pk)
+
+
+def celery_executor(job):
+    from filer.tasks import run_folder_job_task
+    run_folder_job_task.delay(job.pk)
+
+
+def get_job_executor():
+    if not hasattr(get_job_executor, '_cache'):
+        get_job_executor._cache = load_object(
+            filer_settings.FILER_JOB_EXECUTOR)
+    return get_job_executor._cache
+
+
+def resume_queued_jobs():
+    """
+    Submits again the jobs that were queued but not started (ex: the process
+        running them was restarted). Returns their number.
+    """
+    from filer.models import FolderJob
+    queued = list(FolderJob.objects.filter(status=FolderJob.QUEUED))
+    # the submitted jobs are not stale anymore
+    FolderJob.objects.filter(pk__in=[job.pk for job in queued]).update(
+        updated_at=timezone.now())
+    for job in queued:
+        submit_job(job)
+    return len(queued)
+
+
+def submit_job(job):
+    """
+    Hands the (saved) job to the configured executor.
+    """
+    get_job_executor()(job)
@@ -1,21 +1,89 @@
-import itertools
 from functools import reduce
+import operator
 
+from django.core.paginator import Paginator, Page, InvalidPage, EmptyPage
+from django.db import connections
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
 
-class MultiMoldelQuerysetChain(object):
+
+class InvalidCursor(Exception):
+    pass
+
+
+def count_querysets(qsets):
+    """
+    Returns the counts of the given querysets. When they all use the same
+    database the counts are fetched with only one query.
+    """
+    if len(set(qs.db for qs in qsets)) != 1:
+        return [qs.count() for qs in qsets]
+    selects, params = [], []
+    for index, qs in enumerate(qsets):
+        try:
+            sql, qs_params = qs.order_by().values('pk').query.sql_with_params()
+        except EmptyResultSet:
+            # qs.none()
+            selects.append('0')
+            continue
+        selects.append(
+            '(SELECT COUNT(*) FROM (%s) filer_count_%d)' % (sql, index))
+        params.extend(qs_params)
+    if all(select == '0' for select in selects):
+        return [0] * len(qsets)
+    cursor = connections[qsets[0].db].cursor()
+    try:
+        cursor.execute('SELECT %s' % ', '.join(selects), params)
+        return [int(count) for count in cursor.fetchone()]
+    finally:
+        cursor.close()
+
+
+class MultiModelQuerysetChain(object):
     """
     Allows passing a list of different models querysets to a paginator without
     transforming them into one list.
+
+    The querysets counts are computed once (with one query) and only the
+    querysets that overlap a requested slice are queried.
+    Besides index/slice access the chain supports keyset pagination: a cursor
+    (see get_cursor) points to an item and `after` returns the items that
+    follow it without using (large) OFFSETs.
     """
 
-    def __init__(self, qsets):
-        self._qsets = qsets
-        self._offsets = []
-        offset = 0
-        for q in qsets:
-            self._offsets.append(offset)
-            offset += q.count()
-        self.length = offset
+    def __init__(self, qsets, counts=None):
+        self._qsets = [self._with_unique_ordering(qs) for qs in qsets]
+        self._counts = list(counts) if counts is not None else None
+
+    @staticmethod
+    def _with_unique_ordering(qset):
+        # pk is used as a tiebreaker so that keyset pagination is stable
+        ordering = list(qset.query.order_by or qset.model._meta.ordering)
+        pk_names = ('pk', qset.model._meta.pk.name)
+        if not (ordering and isinstance(ordering[-1], str) and
+                ordering[-1].lstrip('-') in pk_names):
+            ordering.append('pk')
+        return qset.order_by(*ordering)
+
+    @property
+    def counts(self):
+        if self._counts is None:
+            self._counts = count_querysets(self._qsets)
+        return self._counts
+
+    @property
+    def _offsets(self):
+        offsets, offset = [], 0
+        for count in self.counts:
+            offsets.append(offset)
+            offset += count
+        return offsets
+
+    def count(self):
+        return sum(self.counts)
+
+    def __len__(self):
+        return self.count()
 
     def __getitem__(self, key):
         if isinstance(key, slice):
@@ -28,23 +96,195 @@ class MultiMoldelQuerysetChain(object):
     def _get_item(self, key):
         if key < 0:
             raise IndexError("index out of bounds {}".format(key))
-        for index, offset in enumerate(self._offsets):
-            qset = self._qsets[index]
-            if key-offset < qset.count():
-                return qset[key-offset]
+        for qset, count, offset in zip(
+                self._qsets, self.counts, self._offsets):
+            if key - offset < count:
+                return qset[key - offset]
         raise IndexError("index out of bounds {}".format(key))
 
     def _get_slice(self, key):
         assert key.start is not None
         assert key.stop is not None
         assert key.step is None
-        slices = (self.slice(qs, key.start-offset, key.stop-offset)
-                  for qs, offset in zip(self._qsets, self._offsets))
-        return reduce(lambda s1, s2: s1+s2, slices)
+        items = []
+        for qset, count, offset in zip(
+                self._qsets, self.counts, self._offsets):
+            start = max(key.start - offset, 0)
+            stop = min(key.stop - offset, count)
+            if start < stop:
+                items.extend(qset[start:stop])
+        return items
 
-    def slice(self, qset, start, stop):
-        start, stop = max(start, 0), max(stop, 0)
-        return list(qset[start:stop])
+    def get_cursor(self, item):
+        """
+        Returns the keyset pagination cursor that points to the given item.
+        """
+        for index, qset in enumerate(self._qsets):
+            if isinstance(item, qset.model):
+                return '%d-%d' % (index, item.pk)
+        raise ValueError("%r is not part of the chain" % item)
 
-    def __len__(self):
-        return self.length
+    def _get_anchor(self, cursor):
+        try:
+            index, pk = [int(bit) for bit in cursor.split('-')]
+            qset = self._qsets[index]
+        except (ValueError, IndexError, AttributeError):
+            raise InvalidCursor(cursor)
+        ordering = list(qset.query.order_by)
+        if not all(isinstance(field, str) and field != '?'
+                   for field in ordering):
+            raise InvalidCursor(cursor)
+        fields = [(field.lstrip('-'), field.startswith('-'))
+                  for field in ordering]
+        values = qset.filter(pk=pk).values_list(
+            *[name for name, _desc in fields])[:1]
+        if not values:
+            # the item is not part of the chain anymore
+            raise InvalidCursor(cursor)
+        return index, [(name, desc, value) for (name, desc), value in zip(
+            fields, values[0])]
+
+    def _after_anchor_q(self, index, anchor):
+        vendor = connections[self._qsets[index].db].vendor
+        nulls_largest = vendor in ('postgresql', 'oracle')
+        conditions, equal = [], []
+        for name, desc, value in anchor:
+            strictly_after = _strictly_after(name, desc, value, nulls_largest)
+            if strictly_after is not None:
+                conditions.append(reduce(operator.and_, equal + [
+                    strictly_after]))
+            if value is None:
+                equal.append(Q(**{'%s__isnull' % name: True}))
+            else:
+                equal.append(Q(**{name: value}))
+        # pk is always part of the ordering so there is at least a condition
+        return reduce(operator.or_, conditions)
+
+    def after(self, cursor, limit):
+        """
+        Returns at most `limit` items that follow the item the cursor points
+        to.
+        """
+        index, anchor = self._get_anchor(cursor)
+        after_q = self._after_anchor_q(index, anchor)
+        items = list(self._qsets[index].filter(after_q)[:limit])
+        for qset, count in zip(self._qsets[index + 1:],
+                               self.counts[index + 1:]):
+            if len(items) >= limit:
+                break
+            if count:
+                items.extend(qset[:limit - len(items)])
+        return items
+
+
+def _strictly_after(name, desc, value, nulls_largest):
+    """
+    Returns the condition matched by the values that are ordered after
+    `value` for the ordering field `name` or None if there are no such
+    values.
+    """
+    # NULLs are the largest values on some databases and the smallest on
+    #   others; descending orders reverse that
+    nulls_last = nulls_largest != desc
+    if value is None:
+        if nulls_last:
+            return None
+        return Q(**{'%s__isnull' % name: False})
+    after = Q(**{'%s__%s' % (name, 'lt' if desc else 'gt'): value})
+    if nulls_last:
+        after |= Q(**{'%s__isnull' % name: True})
+    return after
+
+
+# backwards compatibility
+MultiMoldelQuerysetChain = MultiModelQuerysetChain
+
+
+class MultiModelPage(Page):
+
+    @property
+    def next_cursor(self):
+        """
+        Keyset pagination cursor that can be used to request the next page.
+        """
+        if not self.has_next() or not self.object_list:
+            return None
+        return self.paginator.object_list.get_cursor(self.object_list[-1])
+
+
+class KeysetPage(MultiModelPage):
+    """
+    Page of the items that follow a cursor. Its number comes from the
+    request, the items before the cursor are not counted.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super(KeysetPage, self).__init__(object_list, number, paginator)
+        self._has_next = has_next
+        self.position = (number - 1) * paginator.per_page
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def start_index(self):
+        return self.position + 1 if self.object_list else 0
+
+    def end_index(self):
+        return self.position + len(self.object_list)
+
+
+class MultiModelPaginator(Paginator):
+    """
+    Paginator for MultiModelQuerysetChain that also supports keyset
+    pagination (see page_after).
+    """
+
+    def _get_page(self, *args, **kwargs):
+        return MultiModelPage(*args, **kwargs)
+
+    def page_after(self, cursor, number):
+        """
+        Returns the page (numbered `number`) of items that follow the item
+        the cursor points to, or the last page if no item follows it.
+        Raises InvalidCursor if the cursor doesn't point to an item anymore.
+        """
+        # one more item tells if there is a next page
+        object_list = self.object_list.after(cursor, self.per_page + 1)
+        if not object_list:
+            return self.page(self.num_pages)
+        return KeysetPage(object_list[:self.per_page], number, self,
+                          len(object_list) > self.per_page)
+
+
+def get_page(request, paginator):
+    """
+    Returns the page requested with the `after` (keyset cursor) or `page`
+    GET parameters.
+    """
+    # Make sure page request is an int. If not, deliver first page.
+    try:
+        page = int(request.GET.get('page', '1'))
+    except ValueError:
+        page = 1
+    cursor = request.GET.get('after', None)
+    if cursor:
+        try:
+            return paginator.page_after(cursor, page)
+        except InvalidCursor:
+            # the item was moved/deleted in the meantime; use the page number
+            pass
+
+    # If page request (9999) is out of range, deliver last page of results.
+    try:
+        return paginator.page(page)
+    except (EmptyPage, InvalidPage):
+        return paginator.page(paginator.num_pages)
@@ -1,4 +1,7 @@
 #-*- coding: utf-8 -*-
+from collections import namedtuple
+from datetime import datetime
+
 try:
     from PIL import Image
     from PIL import ExifTags
@@ -27,6 +30,71 @@ def get_exif_for_file(file_obj):
     return get_exif(im)
 
 
+ImageInfo = namedtuple(
+    'ImageInfo', ['width', 'height', 'exif', 'orientation', 'date_taken'])
+
+
+def parse_exif_datetime(value):
+    """
+    Returns the (naive) datetime of an EXIF date ('YYYY:MM:DD HH:MM:SS') or
+        None if it is not valid.
+    """
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'ignore')
+    try:
+        return datetime.strptime(value.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def probe_image(file_obj):
+    """
+    Returns the ImageInfo of the image, read with only one open of the
+        file (object) that doesn't need to be a local file. Only the
+        image header is read. Returns None if the file is not an image.
+    """
+    try:
+        im = Image.open(file_obj, 'r')
+    except Exception:
+        return None
+    exif = get_exif(im)
+    return ImageInfo(
+        width=im.size[0], height=im.size[1], exif=exif,
+        orientation=exif.get('Orientation'),
+        date_taken=parse_exif_datetime(exif.get('DateTimeOriginal')))
+
+
+def _serializable_exif_value(value):
+    if isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, (tuple, list)):
+        values = [_serializable_exif_value(item) for item in value]
+        if None not in values:
+            return values
+        return None
+    try:
+        # rationals (PIL.TiffImagePlugin.IFDRational)
+        return float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        # binary data (ex: MakerNote), nested IFDs, ...
+        return None
+
+
+def get_serializable_exif(exif_data):
+    """
+    Returns the subset of the (decoded) EXIF data that can be stored as
+        JSON: the named tags with text or numeric values.
+    """
+    ret = {}
+    for tag, value in exif_data.items():
+        if not isinstance(tag, str):
+            continue
+        value = _serializable_exif_value(value)
+        if value is not None:
+            ret[tag] = value
+    return ret
+
+
 def get_subject_location(exif_data):
     try:
         r = (int(exif_data['SubjectLocation'][0]), int(exif_data['SubjectLocation'][1]),)
@@ -0,0 +1,168 @@
+#-*- coding: utf-8 -*-
+"""
+Searches the files and folders shown by the directory listing.
+
+The backend is configured with ``FILER_SEARCH_BACKEND``:
+
+* ``QuerySearchBackend``: matches the terms anywhere in the names,
+  descriptions and original file names; no index is used so every search
+  scans the tables
+* ``TokenSearchBackend``: matches the terms at the start of the words of the
+  names, descriptions and original file names using an index of these words
+  (``filer.models.SearchToken``) that is updated when the files and folders
+  are saved, renamed or restored
+
+Both backends also match the terms against the owners' user names and first
+and last names and rank first the items whose name starts with the searched
+text.
+"""
+import re
+
+from django.contrib.auth import get_user_model
+from django.db.models import Q, Case, When, Value, IntegerField
+
+from filer import settings as filer_settings
+from filer.utils.db import chunked
+from filer.utils.loader import load_object
+
+
+RE_WORD = re.compile(r'\w+', re.UNICODE)
+
+FOLDER_FIELDS = ('name', )
+FILE_FIELDS = ('name', 'description', 'original_filename')
+
+
+def tokenize(text):
+    """
+    Returns the words of the given text, lowercased.
+    """
+    from filer.models import SearchToken
+    return set(word[:SearchToken.MAX_LENGTH]
+               for word in RE_WORD.findall((text or '').lower()))
+
+
+def _is_folder_model(model):
+    from filer.models import Folder
+    return issubclass(model, Folder)
+
+
+def get_search_text(obj):
+    """
+    Returns the text of the file or folder fields that are searched.
+    """
+    fields = FOLDER_FIELDS if _is_folder_model(type(obj)) else FILE_FIELDS
+    return '\n'.join(getattr(obj, field) or '' for field in fields)
+
+
+class QuerySearchBackend(object):
+
+    def index(self, obj):
+        pass
+
+    def index_many(self, objs):
+        for obj in objs:
+            self.index(obj)
+
+    def rebuild_index(self):
+        return None
+
+    def _owner_query(self, term):
+        users = get_user_model().objects.filter(
+            Q(username__icontains=term) |
+            Q(first_name__icontains=term) |
+            Q(last_name__icontains=term))
+        return Q(owner__in=users.values('pk'))
+
+    def _term_query(self, model, term):
+        fields = FOLDER_FIELDS if _is_folder_model(model) else FILE_FIELDS
+        query = Q()
+        for field in fields:
+            query |= Q(**{'%s__icontains' % field: term})
+        return query
+
+    def _rank(self, queryset, terms):
+        text = ' '.join(terms)
+        name_starts = Q(name__istartswith=text)
+        if not _is_folder_model(queryset.model):
+            # files without a name are shown with their original file name
+            name_starts |= (Q(name__isnull=True) | Q(name='')) & Q(
+                original_filename__istartswith=text)
+        return queryset.annotate(search_rank=Case(
+            When(name_starts, then=Value(1)), default=Value(0),
+            output_field=IntegerField()))
+
+    def search(self, queryset, terms):
+        """
+        Returns the items of the queryset that match all the terms, ranked.
+        """
+        terms = [term for term in terms if term]
+        for term in terms:
+            queryset = queryset.filter(
+                self._term_query(queryset.model, term) |
+                self._owner_query(term))
+        return self._rank(queryset, terms).order_by('-search_rank', 'name')
+
+
+class TokenSearchBackend(QuerySearchBackend):
+
+    def _indexed_field(self, model):
+        return 'folder' if _is_folder_model(model) else 'file'
+
+    def index(self, obj):
+        self.index_many([obj])
+
+    def index_many(self, objs):
+        from filer.models import SearchToken
+        by_field = {}
+        for obj in objs:
+            by_field.setdefault(
+                self._indexed_field(type(obj)), []).append(obj)
+        for field, field_objs in by_field.items():
+            SearchToken.objects.filter(**{'%s__in' % field: [
+                obj.pk for obj in field_objs]}).delete()
+            SearchToken.objects.bulk_create([
+                SearchToken(token=token, **{'%s_id' % field: obj.pk})
+                for obj in field_objs
+                for token in tokenize(get_search_text(obj))],
+                batch_size=filer_settings.FILER_BULK_BATCH_SIZE)
+
+    def rebuild_index(self):
+        """
+        Indexes all the files and folders from scratch. Returns the number of
+            items indexed.
+        """
+        from filer.models import SearchToken, File, Folder
+        SearchToken.objects.all().delete()
+        indexed = 0
+        for model, fields in ((Folder, FOLDER_FIELDS), (File, FILE_FIELDS)):
+            field = self._indexed_field(model)
+            rows = model._base_manager.values_list('pk', *fields)
+            for batch in chunked(rows.order_by('pk').iterator()):
+                SearchToken.objects.bulk_create([
+                    SearchToken(token=token, **{'%s_id' % field: row[0]})
+                    for row in batch
+                    for token in tokenize('\n'.join(
+                        value or '' for value in row[1:]))])
+                indexed += len(batch)
+        return indexed
+
+    def _term_query(self, model, term):
+        from filer.models import SearchToken
+        words = tokenize(term)
+        if not words:
+            # only punctuation
+            return super(TokenSearchBackend, self)._term_query(model, term)
+        field = self._indexed_field(model)
+        query = Q()
+        for word in words:
+            query &= Q(pk__in=SearchToken.objects.filter(**{
+                'token__startswith': word,
+                '%s__isnull' % field: False}).values(field))
+        return query
+
+
+def get_search_backend():
+    if not hasattr(get_search_backend, '_cache'):
+        get_search_backend._cache = load_object(
+            filer_settings.FILER_SEARCH_BACKEND)()
+    return get_search_backend._cache
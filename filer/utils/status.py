@@ -1,41 +1,51 @@
-import gc
+#-*- coding: utf-8 -*-
+"""
+Audits the filer files: checks that the files exist on their storage, that
+their urls are accessible and that their storage paths end with their logical
+paths.
+
+The files are checked in batches, in the order of their ids:
+
+* the storage directories of a batch are listed (concurrently) instead of
+  checking each file with ``storage.exists()``
+* the urls of a batch are requested (``HEAD``) by a pool of threads that
+  reuse their http connections
+* the files that have problems are written as JSON lines to the output
+  stream as soon as their batch is checked
+* the progress is saved in a checkpoint file after each batch so that an
+  interrupted audit can be resumed
+"""
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from collections import defaultdict
+
+from filer import settings as filer_settings
 from filer.models import File
 
 
-def chunked_items(qs, size=100):
-    pk = 0
-    last_pk = qs.order_by('-pk')[0].pk
-    queryset = qs.order_by('pk')
-    while pk < last_pk:
-        for row in queryset.filter(pk__gt=pk)[:size]:
-            pk = row.pk
-            yield row
-        gc.collect()
+MARKERS = ('path_mismatch', 'not_accessible', 'missing')
 
 
 class FileStats(object):
 
-    def __init__(self, total):
-        self.private = defaultdict(list)
-        self.private.setdefault('total' , 0)
-        self.public = defaultdict(list)
-        self.public.setdefault('total' , 0)
-
-        self.current_item = None
+    def __init__(self, total, index=0, public=None, private=None):
+        self.public = defaultdict(int, public or {})
+        self.private = defaultdict(int, private or {})
         self.current_stats = None
-        self.index = 0
+        self.index = index
         self.total = total
 
-    def set_current(self, asset, public=True):
-        self.current_item = asset
+    def set_current(self, public=True):
         self.current_stats = self.public if public else self.private
         self.current_stats['total'] += 1
         self.index += 1
 
     def mark_current(self, marker):
-        self.current_stats[marker].append(self.current_item)
+        self.current_stats[marker] += 1
 
     def progress(self):
         return "Checked {current} of {total} files".format(
@@ -50,37 +60,71 @@ class FileStats(object):
         }
         for prefix in ('public', 'private'):
             data.update({
-                "{prefix}_{marker}".format(prefix=prefix, marker=k): len(v)
-                for k, v in list(getattr(self, prefix).items())
-                if k != 'total'
+                "{prefix}_{marker}".format(prefix=prefix, marker=marker):
+                    getattr(self, prefix)[marker]
+                for marker in MARKERS
             })
         return data
 
-    def full_summary(self):
-        data = self.summary()
-        for prefix in ('public', 'private'):
-            data.update({
-                "{prefix}_{marker}".format(prefix=prefix, marker=k): v
-                for k, v in list(getattr(self, prefix).items())
-                if k != 'total'
-            })
-        return data
+    def as_dict(self):
+        return {'index': self.index,
+                'public': dict(self.public),
+                'private': dict(self.private)}
 
-    def as_string(self, full=False):
+    def as_string(self):
         to_title = lambda x: x.capitalize().replace('_', ' ')
-        join = lambda x: '\n\t' + '\n\t'.join(x)
-
-        data = self.full_summary() if full else self.summary()
         return '\n'.join(sorted([
-            "%s %s" % (to_title(k), join(v) if hasattr(v, '__iter__') else v)
-            for k, v in list(data.items())]))
+            "%s %s" % (to_title(k), v)
+            for k, v in list(self.summary().items())]))
+
+
+class StorageListing(object):
+    """
+    Remembers the names of the files from the last ``max_dirs`` listed
+        directories of a storage.
+    """
+
+    def __init__(self, storage, max_dirs=1000):
+        self.storage = storage
+        self.max_dirs = max_dirs
+        self._dirs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_listed(self, directory):
+        with self._lock:
+            return directory in self._dirs
+
+    def list(self, directory):
+        try:
+            files = set(self.storage.listdir(directory)[1])
+        except NotImplementedError:
+            files = None
+        except (IOError, OSError):
+            # the directory doesn't exist
+            files = set()
+        with self._lock:
+            self._dirs[directory] = files
+            while len(self._dirs) > self.max_dirs:
+                self._dirs.popitem(last=False)
+
+    def exists(self, name):
+        directory, basename = os.path.split(name)
+        if not self.is_listed(directory):
+            self.list(directory)
+        with self._lock:
+            files = self._dirs.get(directory)
+        if files is None:
+            # the storage can't list its directories
+            return self.storage.exists(name)
+        return basename in files
 
 
 class FileChecker(object):
 
-    def __init__(self, filer_file):
+    def __init__(self, filer_file, listing=None):
         self._file = filer_file
         self._logical_path = ''
+        self._listing = listing
 
     @property
     def storage(self):
@@ -97,14 +141,16 @@ class FileChecker(object):
         return self._logical_path
 
     def exists(self):
+        if self._listing is not None:
+            return self._listing.exists(self.file_path)
         return self.storage.exists(self.file_path)
 
     def path_logical(self):
         return self.file_path.endswith(self.logical_path)
 
-    def accessible(self):
+    def accessible(self, session=None):
         try:
-            response = requests.head(self._file.url)
+            response = (session or requests).head(self._file.url)
         except requests.exceptions.RequestException as exc:
             return False
         return response.status_code == requests.codes.ok
@@ -112,21 +158,126 @@ class FileChecker(object):
     def as_string(self):
         return "%s: %s" % (self._file.pk, self.logical_path, )
 
-    @classmethod
-    def check_all(cls, log_progress=None):
-        stats = FileStats(File.objects.count())
-        log_progress = log_progress or (lambda x: None)
 
-        for _file in chunked_items(File.objects.all()):
-            asset = cls(_file)
-            stats.set_current(asset.as_string(), _file.is_public)
+class FileAudit(object):
+    """
+    Checks all the filer files and writes the ones with problems to
+        ``output`` as JSON lines ({"id":, "path":, "public":, "problems":}).
+
+    When a ``checkpoint`` file name is given, the audit continues from the
+        progress saved in it by a previous (interrupted) audit.
+    """
+
+    def __init__(self, output, checkpoint=None, workers=None,
+                 batch_size=None, check_urls=True):
+        self.output = output
+        self.checkpoint = checkpoint
+        self.workers = workers or filer_settings.FILER_STORAGE_WORKERS
+        self.batch_size = batch_size or filer_settings.FILER_BULK_BATCH_SIZE
+        self.check_urls = check_urls
+        self._listings = {}
+        self._local = threading.local()
+
+    def _get_session(self):
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return self._local.session
+
+    def _get_listing(self, storage):
+        if id(storage) not in self._listings:
+            self._listings[id(storage)] = StorageListing(storage)
+        return self._listings[id(storage)]
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as checkpoint:
+            return json.load(checkpoint)
+
+    def save_checkpoint(self, last_pk, stats):
+        data = dict(stats.as_dict(), last_pk=last_pk,
+                    output_size=self._output_size())
+        tmp_name = '%s.tmp' % self.checkpoint
+        with open(tmp_name, 'w') as checkpoint:
+            json.dump(data, checkpoint)
+        os.replace(tmp_name, self.checkpoint)
+
+    def _output_size(self):
+        try:
+            return self.output.tell()
+        except (AttributeError, IOError, OSError):
+            return None
+
+    def _list_directories(self, executor, checkers):
+        pending = set()
+        for checker in checkers:
+            listing = self._get_listing(checker.storage)
+            directory = os.path.dirname(checker.file_path)
+            if not listing.is_listed(directory):
+                pending.add((listing, directory))
+        list(executor.map(lambda item: item[0].list(item[1]), pending))
+
+    def _check(self, checker):
+        problems = []
+        if not checker.path_logical():
+            problems.append('path_mismatch')
+        if self.check_urls and not checker.accessible(self._get_session()):
+            problems.append('not_accessible')
+        if not checker.exists():
+            problems.append('missing')
+        return problems
+
+    def _check_batch(self, executor, files, stats):
+        checkers = [
+            FileChecker(_file, self._get_listing(_file.file.storage))
+            for _file in files]
+        for checker in checkers:
+            # computed here since it might need database queries
+            checker.logical_path
+        self._list_directories(executor, checkers)
+        problems = executor.map(self._check, checkers)
+        for checker, file_problems in zip(checkers, problems):
+            stats.set_current(checker._file.is_public)
+            for marker in file_problems:
+                stats.mark_current(marker)
+            if file_problems:
+                self.output.write(json.dumps({
+                    'id': checker._file.pk,
+                    'path': checker.logical_path,
+                    'public': checker._file.is_public,
+                    'problems': file_problems,
+                }) + '\n')
+        self.output.flush()
 
-            if not asset.path_logical():
-                stats.mark_current('path_mismatch')
-            if not asset.accessible():
-                stats.mark_current('not_accessible')
-            if not asset.exists():
-                stats.mark_current('missing')
-            log_progress(stats)
+    def run(self, log_progress=None):
+        log_progress = log_progress or (lambda stats: None)
+        queryset = File.objects.non_polymorphic().select_related('folder')
+        stats = FileStats(queryset.count())
+        last_pk = 0
+        saved = self.load_checkpoint()
+        if saved:
+            last_pk = saved['last_pk']
+            stats = FileStats(stats.total, saved['index'],
+                              saved['public'], saved['private'])
+            if saved.get('output_size') is not None:
+                # drops the rows written after the checkpoint was saved
+                self.output.seek(saved['output_size'])
+                self.output.truncate()
 
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                files = list(queryset.filter(pk__gt=last_pk).order_by(
+                    'pk')[:self.batch_size])
+                if not files:
+                    break
+                self._check_batch(executor, files, stats)
+                last_pk = files[-1].pk
+                if self.checkpoint:
+                    self.save_checkpoint(last_pk, stats)
+                log_progress(stats)
         return stats
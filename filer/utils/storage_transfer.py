@@ -0,0 +1,217 @@
+#-*- coding: utf-8 -*-
+"""
+Copies and moves files between filer storages without loading their content
+in memory and deletes files from storages in batches.
+
+The actual copy is done by the first transfer backend from
+``FILER_FILE_TRANSFER_BACKENDS`` that can handle the source and destination
+storages. A transfer backend is a callable with the signature::
+
+    transfer(src_storage, src_name, dst_storage, dst_name)
+
+that returns the name under which the file was saved on the destination
+storage or ``None`` if it cannot copy between the given storages.
+"""
+import errno
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.base import File as DjangoFile
+
+from filer import settings as filer_settings
+from filer.utils.loader import load_object
+
+
+class ChunkedFile(DjangoFile):
+    """
+    File wrapper that makes storages read the content in chunks of
+        ``FILER_FILE_CHUNK_SIZE`` bytes.
+    """
+    DEFAULT_CHUNK_SIZE = filer_settings.FILER_FILE_CHUNK_SIZE
+
+
+def _local_path(storage, name):
+    try:
+        return storage.path(name)
+    except (NotImplementedError, AttributeError):
+        return None
+
+
+def _prepare_local_destination(storage, name):
+    directory = os.path.dirname(storage.path(name))
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # directory might have been created in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _copy_local_file(src_path, dst_path):
+    chunk_size = filer_settings.FILER_FILE_CHUNK_SIZE
+    with open(src_path, 'rb') as src, open(dst_path, 'xb') as dst:
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        if copy_file_range is not None:
+            try:
+                # data is copied in kernel space, without going through
+                #   python buffers
+                while copy_file_range(src.fileno(), dst.fileno(), chunk_size):
+                    pass
+                return
+            except OSError:
+                # not supported for these files; copy what is left
+                pass
+        shutil.copyfileobj(src, dst, chunk_size)
+
+
+def server_side_copy(src_storage, src_name, dst_storage, dst_name):
+    """
+    Lets the storage backend copy the file (ex: S3 copy object) when it
+        supports it.
+    """
+    if src_storage is dst_storage and hasattr(dst_storage, 'copy'):
+        dst_name = dst_storage.get_available_name(dst_name)
+        dst_storage.copy(src_name, dst_name)
+        return dst_name
+    copy_from = getattr(dst_storage, 'copy_from', None)
+    if copy_from is not None:
+        return copy_from(src_storage, src_name, dst_name)
+    return None
+
+
+def hard_link(src_storage, src_name, dst_storage, dst_name):
+    """
+    Creates a hard link for files on local storages that are on the same
+        filesystem. Storages never change files in place so the files can
+        share their content.
+    """
+    src_path = _local_path(src_storage, src_name)
+    if src_path is None or _local_path(dst_storage, dst_name) is None:
+        return None
+    _prepare_local_destination(dst_storage, dst_name)
+    while True:
+        dst_name = dst_storage.get_available_name(dst_name)
+        try:
+            os.link(src_path, dst_storage.path(dst_name))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                # destination was created in the meantime, try another name
+                continue
+            # ex: different filesystems or links are not supported
+            return None
+        return dst_name
+
+
+def local_copy(src_storage, src_name, dst_storage, dst_name):
+    """
+    Copies files between local storages (using copy_file_range when
+        available).
+    """
+    src_path = _local_path(src_storage, src_name)
+    if src_path is None or _local_path(dst_storage, dst_name) is None:
+        return None
+    _prepare_local_destination(dst_storage, dst_name)
+    while True:
+        dst_name = dst_storage.get_available_name(dst_name)
+        dst_path = dst_storage.path(dst_name)
+        try:
+            _copy_local_file(src_path, dst_path)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+        break
+    permissions = getattr(dst_storage, 'file_permissions_mode', None)
+    if permissions is not None:
+        os.chmod(dst_path, permissions)
+    return dst_name
+
+
+def streamed_copy(src_storage, src_name, dst_storage, dst_name):
+    """
+    Copies the file between any storages by streaming its content in
+        chunks.
+    """
+    src_file = src_storage.open(src_name, 'rb')
+    try:
+        # This is needed because most of the remote File Storage backend do
+        #   not open the file.
+        src_file.open()
+        return dst_storage.save(
+            dst_name, ChunkedFile(src_file, name=os.path.basename(src_name)))
+    finally:
+        src_file.close()
+
+
+def map_concurrently(func, items, workers=None):
+    """
+    Calls ``func`` for each of the items using a pool of
+        ``FILER_STORAGE_WORKERS`` threads and returns the results in the
+        order of the items. Should be used only for storage operations since
+        the threads don't share the database connection.
+    """
+    items = list(items)
+    workers = min(workers or filer_settings.FILER_STORAGE_WORKERS, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+def delete_files(storage, names, workers=None):
+    """
+    Deletes the given files from the storage, using the storage's batch
+        delete (ex: S3 multi-object delete) when it has one and a pool of
+        threads otherwise. Missing files are ignored.
+
+    Returns the names of the files that the batch delete reported as not
+        deleted; the errors of the other deletes are raised.
+    """
+    names = list(names)
+    if not names:
+        return []
+    delete_many = getattr(storage, 'delete_many', None)
+    if delete_many is not None:
+        return delete_many(names) or []
+
+    def delete(name):
+        try:
+            storage.delete(name)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+    map_concurrently(delete, names, workers)
+    return []
+
+
+def get_transfer_backends():
+    if not hasattr(get_transfer_backends, '_cache'):
+        get_transfer_backends._cache = [
+            load_object(backend)
+            for backend in filer_settings.FILER_FILE_TRANSFER_BACKENDS]
+    return get_transfer_backends._cache
+
+
+def copy_file(src_storage, src_name, dst_storage, dst_name):
+    """
+    Copies a file from a storage to another (or the same) storage.
+    Returns the name under which the file was saved.
+    """
+    for transfer in get_transfer_backends():
+        saved_as = transfer(src_storage, src_name, dst_storage, dst_name)
+        if saved_as is not None:
+            return saved_as
+    return streamed_copy(src_storage, src_name, dst_storage, dst_name)
+
+
+def move_file(src_storage, src_name, dst_storage, dst_name):
+    """
+    Moves a file from a storage to another (or the same) storage.
+    Returns the name under which the file was saved.
+    """
+    saved_as = copy_file(src_storage, src_name, dst_storage, dst_name)
+    if src_storage is not dst_storage or saved_as != src_name:
+        src_storage.delete(src_name)
+    return saved_as
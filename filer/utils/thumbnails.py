@@ -0,0 +1,119 @@
+#-*- coding: utf-8 -*-
+"""
+Renders the image thumbnails outside the request that needs them.
+
+Missing thumbnails are handed to the executor configured with
+``FILER_THUMBNAIL_EXECUTOR``:
+
+* ``thread_executor``: renders them in a pool of ``FILER_THUMBNAIL_WORKERS``
+  threads of the current process
+* ``celery_executor``: sends them to the celery workers
+  (``filer.tasks.render_thumbnails_task``)
+* ``immediate_executor``: renders them right away, in the current thread
+
+The same thumbnail of the same source (name, sha1 and options) is queued only
+once until it is rendered.
+"""
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connections
+
+from filer import settings as filer_settings
+from filer.utils.loader import load_object
+
+
+logger = logging.getLogger("filer")
+
+# seconds after which a queued thumbnail that was not rendered (ex: the
+#   worker died) can be queued again
+PENDING_TIMEOUT = 300
+
+
+def get_thumbnail_key(image, options):
+    """
+    Returns the key that identifies the thumbnail of the given image with
+        the given options while it's pending.
+    """
+    source = '%s:%s:%s' % (image.file.name, image.sha1,
+                           sorted(options.items()))
+    return 'filer-thumbnail-%s' % hashlib.sha1(
+        source.encode('utf-8')).hexdigest()
+
+
+def render_thumbnails(image_id, thumbnails):
+    """
+    Renders the thumbnails ({key: options}) of the given image.
+    """
+    from filer.models import Image
+    try:
+        image = Image.objects.get(pk=image_id)
+        for options in thumbnails.values():
+            try:
+                image.file.get_thumbnail(options)
+            except Exception as e:
+                if filer_settings.FILER_ENABLE_LOGGING:
+                    logger.error('Error while generating thumbnail: %s', e)
+                if filer_settings.FILER_DEBUG:
+                    raise
+    except Image.DoesNotExist:
+        # deleted in the meantime
+        pass
+    finally:
+        cache.delete_many(list(thumbnails.keys()))
+
+
+def immediate_executor(image_id, thumbnails):
+    render_thumbnails(image_id, thumbnails)
+    return True
+
+
+def _render_thumbnails_in_thread(image_id, thumbnails):
+    try:
+        render_thumbnails(image_id, thumbnails)
+    except Exception:
+        logger.exception('Rendering thumbnails of image %s failed.' % image_id)
+    finally:
+        # threads get their own database connections
+        connections.close_all()
+
+
+def thread_executor(image_id, thumbnails):
+    if not hasattr(thread_executor, '_pool'):
+        thread_executor._pool = ThreadPoolExecutor(
+            max_workers=filer_settings.FILER_THUMBNAIL_WORKERS)
+    thread_executor._pool.submit(
+        _render_thumbnails_in_thread, image_id, thumbnails)
+    return False
+
+
+def celery_executor(image_id, thumbnails):
+    from filer.tasks import render_thumbnails_task
+    render_thumbnails_task.delay(image_id, thumbnails)
+    return False
+
+
+def get_thumbnail_executor():
+    if not hasattr(get_thumbnail_executor, '_cache'):
+        get_thumbnail_executor._cache = load_object(
+            filer_settings.FILER_THUMBNAIL_EXECUTOR)
+    return get_thumbnail_executor._cache
+
+
+def queue_thumbnails(image, required_thumbnails):
+    """
+    Hands the given thumbnails ({name: options}) of the (saved) image to the
+        configured executor, skipping the ones that are already queued.
+
+    Returns True if the thumbnails were rendered before returning.
+    """
+    thumbnails = {}
+    for options in required_thumbnails.values():
+        key = get_thumbnail_key(image, options)
+        if cache.add(key, image.pk, PENDING_TIMEOUT):
+            thumbnails[key] = options
+    if not thumbnails:
+        return False
+    return get_thumbnail_executor()(image.pk, thumbnails)
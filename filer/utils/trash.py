@@ -0,0 +1,319 @@
+#-*- coding: utf-8 -*-
+"""
+Hard-deletes, in bulk, the files and folders that are in the trash for longer
+than ``FILER_TRASH_CLEAN_INTERVAL`` seconds.
+
+For each batch of expired files:
+
+* the storage names still used by alive files are found with one query
+* the thumbnails of the other storage names are deleted in bulk, per storage
+* the database rows are deleted with one bulk delete
+* the files are deleted from storage with the storage's batch delete (see
+  ``filer.utils.storage_transfer.delete_files``); the files it could not
+  delete are logged and counted as errors
+
+Expired folders are deleted in bulk too, only when neither them nor their
+descendants contain files or folders that are kept.
+
+The files of deleted folders are moved to their trash location on storage
+after the folders are moved to the trash, by the executor configured with
+``FILER_TRASH_MOVE_EXECUTOR``:
+
+* ``thread_executor``: moves them in a thread of the current process
+* ``celery_executor``: sends them to the celery workers
+  (``filer.tasks.move_files_to_trash_task``)
+* ``immediate_executor``: moves them right away, in the current thread
+
+The moves are recorded as file relocations (``filer.models.FileRelocation``).
+The moves that were not done (interrupted or lost by the executor) are
+finished by the ``take_out_filer_trash`` and ``resume_file_relocations``
+commands.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from filer import settings as filer_settings
+from filer.utils.db import chunked
+from filer.utils.filer_easy_thumbnails import delete_thumbnails_in_bulk
+from filer.utils.loader import load_object
+from filer.utils.storage_transfer import delete_files
+
+
+logger = logging.getLogger(__name__)
+
+# number of times a worker looks for a trashed folder that is not committed
+FOLDER_LOOKUP_RETRIES = 10
+# trash moves older than this are considered lost by their executor
+TRASH_MOVE_TIMEOUT = timedelta(minutes=30)
+
+
+def move_files_to_trash(folder_id):
+    """
+    Moves the files of the (trashed) folder's subtree to their trash
+        location on storage.
+    """
+    from filer.models import FileRelocation, Folder
+    for _retry in range(FOLDER_LOOKUP_RETRIES):
+        folder = Folder.trash.filter(pk=folder_id).first()
+        if folder is not None:
+            break
+        # the transaction that trashed the folder might not be committed
+        time.sleep(0.5)
+    else:
+        logger.error(
+            'Folder %s was not found in the trash, the files of its subtree '
+            'were not moved to the trash. They will be moved by the '
+            'take_out_filer_trash or resume_file_relocations commands.'
+            % folder_id)
+        return 0
+    return FileRelocation.objects.relocate(
+        FileRelocation.objects.for_folder(folder))
+
+
+def immediate_executor(folder_id):
+    move_files_to_trash(folder_id)
+
+
+def _move_files_in_thread(folder_id):
+    try:
+        move_files_to_trash(folder_id)
+    except Exception:
+        logger.exception(
+            'Moving the files of folder %s to trash failed.' % folder_id)
+    finally:
+        # threads get their own database connections
+        connections.close_all()
+
+
+def thread_executor(folder_id):
+    if not hasattr(thread_executor, '_pool'):
+        # moves are done one folder at a time; each one copies its files
+        #   concurrently
+        thread_executor._pool = ThreadPoolExecutor(max_workers=1)
+    thread_executor._pool.submit(_move_files_in_thread, folder_id)
+
+
+def celery_executor(folder_id):
+    from filer.tasks import move_files_to_trash_task
+    move_files_to_trash_task.delay(folder_id)
+
+
+def get_trash_move_executor():
+    if not hasattr(get_trash_move_executor, '_cache'):
+        get_trash_move_executor._cache = load_object(
+            filer_settings.FILER_TRASH_MOVE_EXECUTOR)
+    return get_trash_move_executor._cache
+
+
+def queue_trash_move(folder):
+    """
+    Hands the moves of the files of the (trashed) folder to the configured
+        executor.
+    """
+    get_trash_move_executor()(folder.pk)
+
+
+class PurgeStats(object):
+
+    def __init__(self):
+        self.files = 0
+        self.storage_files = 0
+        self.folders = 0
+        self.kept_folders = 0
+        self.errors = 0
+
+    def as_string(self):
+        return ("%s files (%s on storage) and %s folders deleted, %s folders "
+                "kept since they are not empty, %s errors." % (
+                    self.files, self.storage_files, self.folders,
+                    self.kept_folders, self.errors))
+
+
+class TrashPurge(object):
+    """
+    When ``dry_run`` is set nothing is deleted, only the stats are computed.
+    ``max_rate`` limits the number of files and folders deleted per second.
+    """
+
+    def __init__(self, older_than=None, dry_run=False, batch_size=None,
+                 max_rate=None, log=None):
+        if older_than is None:
+            older_than = timezone.now() - timedelta(
+                seconds=filer_settings.FILER_TRASH_CLEAN_INTERVAL)
+        self.older_than = older_than
+        self.dry_run = dry_run
+        self.batch_size = batch_size or filer_settings.FILER_BULK_BATCH_SIZE
+        self.max_rate = max_rate
+        self.log = log or (lambda msg: None)
+        self.stats = PurgeStats()
+        self._started = None
+        self._deleted = 0
+
+    def _throttle(self, count):
+        self._deleted += count
+        if not self.max_rate:
+            return
+        expected_duration = float(self._deleted) / self.max_rate
+        elapsed = time.time() - self._started
+        if expected_duration > elapsed:
+            time.sleep(expected_duration - elapsed)
+
+    def _file_models(self):
+        from filer.models import File
+        return File, File.trash.non_polymorphic().filter(
+            deleted_at__lt=self.older_than)
+
+    def _expired_file_chunks(self):
+        # ids are streamed by their order, the rows of a chunk are deleted
+        #   before the next chunk is read
+        File, expired = self._file_models()
+        last_pk = 0
+        while True:
+            rows = list(expired.filter(pk__gt=last_pk).order_by('pk').
+                        values_list('pk', 'file', 'is_public')
+                        [:self.batch_size])
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield rows
+
+    def _delete_thumbnails(self, to_delete):
+        File, expired = self._file_models()
+        field = File._meta.get_field('file')
+        for is_public, storage_names in list(to_delete.items()):
+            if storage_names:
+                key = 'public' if is_public else 'private'
+                delete_thumbnails_in_bulk(
+                    field.storages[key], field.thumbnail_storages[key],
+                    sorted(storage_names))
+
+    def _purge_files(self, rows):
+        File, expired = self._file_models()
+        names = set(name for _, name, _ in rows if name)
+        # storage names still used by alive files
+        referenced = set(File.objects.non_polymorphic().filter(
+            file__in=names).values_list('file', 'is_public'))
+        to_delete = {True: set(), False: set()}
+        for _, name, is_public in rows:
+            if name and (name, is_public) not in referenced:
+                to_delete[is_public].add(name)
+        self.stats.files += len(rows)
+        self.stats.storage_files += sum(map(len, list(to_delete.values())))
+        if self.dry_run:
+            return
+        self._delete_thumbnails(to_delete)
+        # the rows are deleted before the files on storage
+        with transaction.atomic():
+            expired.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+        storages = File._meta.get_field('file').storages
+        for is_public, storage_names in list(to_delete.items()):
+            failed = delete_files(
+                storages['public' if is_public else 'private'],
+                sorted(storage_names))
+            if failed:
+                # their rows are gone, the files are left on storage
+                self.stats.errors += len(failed)
+                self.log("Could not delete from storage: %s" %
+                         ', '.join(failed))
+
+    def purge_files(self):
+        for rows in self._expired_file_chunks():
+            try:
+                self._purge_files(rows)
+            except Exception as e:
+                self.stats.errors += 1
+                self.log("Error while deleting files %s-%s: %s" % (
+                    rows[0][0], rows[-1][0], e))
+            else:
+                if not self.dry_run:
+                    self.log("Deleted %s files." % len(rows))
+            self._throttle(len(rows))
+
+    def _purge_folders(self, rows, purged, non_empty):
+        from filer.models import Folder
+        ids = [pk for pk, _ in rows]
+        children = {}
+        for child_id, parent_id in Folder.all_objects.filter(
+                parent__in=ids).values_list('pk', 'parent'):
+            children.setdefault(parent_id, []).append(child_id)
+        # children come before their parents
+        deleted_ids = set()
+        for pk, parent_id in rows:
+            if pk in non_empty or not all(
+                    child in purged for child in children.get(pk, [])):
+                self.stats.kept_folders += 1
+                continue
+            purged.add(pk)
+            deleted_ids.add(pk)
+        self.stats.folders += len(deleted_ids)
+        if self.dry_run or not deleted_ids:
+            return len(deleted_ids)
+        kept_parents = set(parent_id for pk, parent_id in rows
+                           if pk in deleted_ids and parent_id and
+                           parent_id not in deleted_ids)
+        with transaction.atomic():
+            # subtrees whose parents are kept leave gaps in their trees;
+            #   they are closed from right to left
+            gaps = sorted(Folder.all_objects.filter(
+                pk__in=deleted_ids, parent__in=kept_parents).values_list(
+                'tree_id', 'lft', 'rght'), reverse=True)
+            Folder.all_objects.filter(pk__in=deleted_ids).delete()
+            for tree_id, lft, rght in gaps:
+                Folder._tree_manager._close_gap(
+                    rght - lft + 1, rght, tree_id)
+            Folder.all_objects.recount_children(kept_parents)
+        return len(deleted_ids)
+
+    def purge_folders(self):
+        from filer.models import File, Folder
+        rows = list(Folder.trash.filter(
+            deleted_at__lt=self.older_than).order_by(
+            'tree_id', '-level').values_list('pk', 'parent'))
+        purged = set()
+        for chunk in chunked(rows, self.batch_size):
+            files = File.all_objects.non_polymorphic().filter(
+                folder__in=[pk for pk, _ in chunk])
+            if self.dry_run:
+                # these would have been deleted by purge_files
+                files = files.exclude(deleted_at__lt=self.older_than)
+            non_empty = set(files.values_list('folder', flat=True))
+            try:
+                deleted = self._purge_folders(chunk, purged, non_empty)
+            except Exception as e:
+                self.stats.errors += 1
+                self.log("Error while deleting folders: %s" % e)
+            else:
+                if not self.dry_run:
+                    self.log("Deleted %s folders." % deleted)
+            self._throttle(len(chunk))
+
+    def finish_trash_moves(self):
+        """
+        Moves to their trash location the trashed files whose moves were not
+            done by the trash move executor (see queue_trash_move) and
+            returns their number.
+        """
+        from filer.models import FileRelocation
+        stale = FileRelocation.objects.filter(
+            file__deleted_at__isnull=False,
+            created_at__lt=timezone.now() - TRASH_MOVE_TIMEOUT)
+        if self.dry_run:
+            return stale.count()
+        return FileRelocation.objects.relocate(stale)
+
+    def has_expired_items(self):
+        from filer.models import Folder
+        File, expired = self._file_models()
+        return expired.exists() or Folder.trash.filter(
+            deleted_at__lt=self.older_than).exists()
+
+    def run(self):
+        self._started = time.time()
+        self.purge_files()
+        self.purge_folders()
+        return self.stats